@@ -0,0 +1,103 @@
+import unittest
+
+from freemindlatex import (
+  compilation_client_lib,
+  compilation_service_pb2,
+  metrics_lib,
+  server_fleet_test_lib)
+
+
+class TestBackendPool(unittest.TestCase):
+
+  def setUp(self):
+    self._fleet = server_fleet_test_lib.StandInServerFleet(num_servers=3)
+    self._pool = compilation_client_lib.BackendPool(
+      self._fleet.GetAddresses(), health_check_interval=0, load_slack=2)
+
+  def tearDown(self):
+    self._fleet.Stop()
+
+  def _ChooseServer(self, project_key):
+    return self._fleet.GetServerAt(
+      self._pool.ChooseBackend(project_key).address)
+
+  def testProjectsStickToTheirServer(self):
+    for i in range(10):
+      project_key = '/home/me/talk{}'.format(i)
+      self.assertIs(self._ChooseServer(project_key),
+                    self._ChooseServer(project_key))
+
+  def testProjectsSpreadAcrossServers(self):
+    chosen_servers = set(
+      self._ChooseServer('/home/me/talk{}'.format(i)) for i in range(30))
+    self.assertEquals(3, len(chosen_servers))
+
+  def testSkippingUnhealthyServer(self):
+    server = self._ChooseServer('/home/me/talk')
+    server.serving = False
+    self.assertIsNot(server, self._ChooseServer('/home/me/talk'))
+
+    server.serving = True
+    self.assertIs(server, self._ChooseServer('/home/me/talk'))
+
+  def testAvoidingOverloadedServer(self):
+    server = self._ChooseServer('/home/me/talk')
+    server.queue_depth = 2
+    server.running_compilations = 1
+    self.assertIsNot(server, self._ChooseServer('/home/me/talk'))
+
+  def testToleratingLoadWithinSlack(self):
+    server = self._ChooseServer('/home/me/talk')
+    server.running_compilations = 2
+    self.assertIs(server, self._ChooseServer('/home/me/talk'))
+
+
+class TestHedgedCompilationFuture(unittest.TestCase):
+
+  def setUp(self):
+    self._fleet = server_fleet_test_lib.StandInServerFleet(num_servers=2)
+    self._backends = [compilation_client_lib._Backend(address)
+                      for address in self._fleet.GetAddresses()]
+    self._budget = compilation_client_lib._HedgingBudget(fraction=1.0)
+    self._budget.RecordCompilation()
+    self._latencies = []
+
+  def tearDown(self):
+    self._fleet.Stop()
+
+  def _Compile(self, hedge_delay):
+    request = compilation_service_pb2.LatexCompilationRequest()
+    return compilation_client_lib.HedgedCompilationFuture(
+      lambda backend: backend.compilation_stub.CompilePackage.future(request),
+      self._backends[0],
+      compilation_client_lib._HedgingPlan(
+        self._backends[1], hedge_delay, self._budget),
+      on_success=self._latencies.append)
+
+  def testSecondServerAnswersFirst(self):
+    self._fleet.servers[0].delay_seconds = 5
+    hedges_won_before = metrics_lib.GetCounterValues().get('hedges_won', 0)
+
+    response = self._Compile(hedge_delay=0.05).result(timeout=4)
+    self.assertEquals(self._fleet.servers[1].address, response.pdf_content)
+    self.assertEquals(hedges_won_before + 1,
+                      metrics_lib.GetCounterValues()['hedges_won'])
+    self.assertEquals(1, len(self._latencies))
+
+  def testNoHedgingWhenPrimaryIsFast(self):
+    response = self._Compile(hedge_delay=2).result(timeout=4)
+    self.assertEquals(self._fleet.servers[0].address, response.pdf_content)
+    self.assertEquals([], self._fleet.servers[1].requests)
+
+  def testNoHedgingBeyondBudget(self):
+    self._budget = compilation_client_lib._HedgingBudget(fraction=0.1)
+    self._budget.RecordCompilation()
+    self._fleet.servers[0].delay_seconds = 0.5
+
+    response = self._Compile(hedge_delay=0.05).result(timeout=4)
+    self.assertEquals(self._fleet.servers[0].address, response.pdf_content)
+    self.assertEquals([], self._fleet.servers[1].requests)
+
+
+if __name__ == "__main__":
+  unittest.main()
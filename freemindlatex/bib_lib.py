@@ -0,0 +1,198 @@
+"""Citations of mindmaps, and the entries of the bib file they need.
+
+The bib file may hold a whole library. An index from the entries' keys to
+their offsets in the file, kept on disk, lets us extract the cited entries
+without parsing the library.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+import gflags
+
+gflags.DEFINE_string('bib_file', '~/Dropbox/bib.bib',
+                     'bib file location')
+gflags.DEFINE_string(
+  'bib_index_dir',
+  '~/.cache/freemindlatex',
+  "Directory keeping the indexes of the bib files, from the entries' keys "
+  "to their offsets in the file.")
+
+# The name of the cited entries in the working directory, where the HTML
+# citations read them from. It is also the file of the \bibliography the
+# templates have commented out.
+BIB_SUBSET_FILENAME = "bib.bib"
+
+# Same as how convert_lib finds the citations.
+_CITE_RE = re.compile(r'\\(?:new)?cite{(.*?)}')
+_ENTRY_START_RE = re.compile(r'\s*@\s*(\w+)\s*[{(]\s*([^,\s]*)')
+_CROSSREF_RE = re.compile(r'crossref\s*=\s*[{"]\s*([^}"\s]+)', re.IGNORECASE)
+
+# Entries every subset needs, as the cited ones may use them.
+_SHARED_ENTRY_TYPES = ['string', 'preamble']
+
+_INDEX_FORMAT_VERSION = 1
+
+
+def GetCitedKeys(mindmap_content):
+  """Finds the keys of the \\cite{} and \\newcite{} in the mindmap.
+
+  Args:
+    mindmap_content: content of mindmap.mm.
+
+  Returns:
+    A sorted list of keys, e.g. ['knuth84', 'lamport94']
+  """
+  return sorted(set(
+    key.strip() for keys in _CITE_RE.findall(mindmap_content)
+    for key in keys.split(',') if key.strip()))
+
+
+def GetBibFilePath():
+  """The bib file of the bib_file flag, with ~ expanded."""
+  return os.path.expanduser(gflags.FLAGS.bib_file)
+
+
+def _GetIndexPath(bib_path):
+  return os.path.join(
+    os.path.expanduser(gflags.FLAGS.bib_index_dir),
+    "{}.json".format(hashlib.sha1(os.path.abspath(bib_path)).hexdigest()))
+
+
+class BibIndex(object):
+  """Where each entry of a bib file is, to read only the cited ones.
+
+  The index is rebuilt when the bib file changes (its size or modification
+  time), with a single pass over its lines, and saved for the next runs.
+  """
+
+  def __init__(self, bib_path, index_path=None):
+    """
+    Args:
+      bib_path: path to the bib file.
+      index_path: where to keep the index. By default, in the bib_index_dir.
+    """
+    self.bib_path = bib_path
+    self._index_path = index_path or _GetIndexPath(bib_path)
+    self._lock = threading.Lock()
+    self._index = None
+
+  @staticmethod
+  def _GetFileVersion(bib_stat):
+    return [_INDEX_FORMAT_VERSION, bib_stat.st_size, bib_stat.st_mtime]
+
+  def _Load(self, file_version):
+    """The index saved on disk, or None when missing or stale."""
+    try:
+      with open(self._index_path) as ifile:
+        index = json.load(ifile)
+    except (IOError, ValueError) as _:
+      return None
+    if index.get('file_version') != file_version:
+      return None
+    return index
+
+  def _Build(self, file_version):
+    entries = {}
+    shared_ranges = []
+    # The current entry: (key or None for shared ones, start offset).
+    current = None
+    offset = 0
+    with open(self.bib_path, 'rb') as bib_file:
+      for line in bib_file:
+        mo = _ENTRY_START_RE.match(line)
+        if mo:
+          self._AddEntry(current, offset, entries, shared_ranges)
+          entry_type = mo.group(1).lower()
+          current = None
+          if entry_type in _SHARED_ENTRY_TYPES:
+            current = (None, offset)
+          elif entry_type != 'comment':
+            current = (mo.group(2).lower(), offset)
+        offset += len(line)
+    self._AddEntry(current, offset, entries, shared_ranges)
+    return {
+      'file_version': file_version,
+      'entries': entries,
+      'shared_ranges': shared_ranges,
+    }
+
+  @staticmethod
+  def _AddEntry(current, end_offset, entries, shared_ranges):
+    if current is None:
+      return
+    key, start_offset = current
+    byte_range = [start_offset, end_offset - start_offset]
+    if key is None:
+      shared_ranges.append(byte_range)
+    elif key not in entries:     # bibtex uses the first one, too.
+      entries[key] = byte_range
+
+  def _Save(self, index):
+    index_dir = os.path.dirname(self._index_path)
+    try:
+      if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+      temp_path = "{}.tmp{}".format(self._index_path, os.getpid())
+      with open(temp_path, 'w') as ofile:
+        json.dump(index, ofile)
+      os.rename(temp_path, self._index_path)
+    except (IOError, OSError) as e:
+      logging.warning("Unable to save the index of %s: %s",
+                      self.bib_path, e)
+
+  def _Refresh(self):
+    file_version = self._GetFileVersion(os.stat(self.bib_path))
+    if (self._index is not None and
+        self._index['file_version'] == file_version):
+      return
+    self._index = self._Load(file_version)
+    if self._index is None:
+      logging.info("Indexing %s", self.bib_path)
+      self._index = self._Build(file_version)
+      self._Save(self._index)
+
+  def GetSubset(self, keys):
+    """A bib file with only the entries of the keys, and what they use.
+
+    Args:
+      keys: keys of the cited entries, e.g. ['knuth84']
+
+    Returns:
+      The content of the bib file, with the @string and @preamble entries,
+      the entries of the keys, and those they cross-reference.
+
+    Raises:
+      OSError or IOError, when the bib file cannot be read.
+    """
+    with self._lock:
+      self._Refresh()
+      index = self._index
+
+    with open(self.bib_path, 'rb') as bib_file:
+      def ReadRange(byte_range):
+        bib_file.seek(byte_range[0])
+        return bib_file.read(byte_range[1])
+
+      pieces = [ReadRange(byte_range)
+                for byte_range in index['shared_ranges']]
+      pending_keys = [key.lower() for key in keys]
+      seen_keys = set()
+      while pending_keys:
+        key = pending_keys.pop(0)
+        if key in seen_keys:
+          continue
+        seen_keys.add(key)
+        if key not in index['entries']:
+          logging.warning("Citation not found in %s: %s",
+                          self.bib_path, key)
+          continue
+        entry = ReadRange(index['entries'][key])
+        pieces.append(entry)
+        pending_keys.extend(
+          crossref.lower() for crossref in _CROSSREF_RE.findall(entry))
+    return ''.join(pieces)
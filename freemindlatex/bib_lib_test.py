@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from freemindlatex import bib_lib
+
+_BIB_CONTENT = """@string{acm = "ACM"}
+
+@comment{Not an entry}
+@article{Knuth84,
+  title = {Literate Programming},
+  journal = acm,
+}
+
+@inproceedings{lamport94,
+  title = {How to write a proof},
+  crossref = {proceedings94},
+}
+
+@article{unused,
+  title = {Not cited},
+}
+
+@proceedings{proceedings94,
+  title = {Proceedings},
+}
+"""
+
+
+class TestCitedKeys(unittest.TestCase):
+
+  def testFindingCitations(self):
+    self.assertEquals(
+      ["a", "b", "c"],
+      bib_lib.GetCitedKeys(
+        '<node TEXT="As in \\cite{b, a}, and \\newcite{c}"/>'
+        '<node TEXT="\\cite{a}"/>'))
+
+
+class TestBibIndex(unittest.TestCase):
+
+  def setUp(self):
+    self._temp_dir = tempfile.mkdtemp()
+    self._bib_path = os.path.join(self._temp_dir, "library.bib")
+    self._index_path = os.path.join(self._temp_dir, "index", "library.json")
+    with open(self._bib_path, 'w') as ofile:
+      ofile.write(_BIB_CONTENT)
+
+  def tearDown(self):
+    shutil.rmtree(self._temp_dir)
+
+  def testExtractingCitedEntries(self):
+    subset = bib_lib.BibIndex(self._bib_path, self._index_path).GetSubset(
+      ["knuth84", "lamport94", "missing"])
+    self.assertIn('@string{acm = "ACM"}', subset)
+    self.assertIn("@article{Knuth84,", subset)
+    self.assertIn("@inproceedings{lamport94,", subset)
+    self.assertIn("@proceedings{proceedings94,", subset)
+    self.assertNotIn("unused", subset)
+    self.assertNotIn("Not an entry", subset)
+    # bibtex wants the cross-referenced entries last.
+    self.assertLess(subset.index("lamport94,"),
+                    subset.index("proceedings94,"))
+
+  def testKeepingTheIndexOnDisk(self):
+    bib_lib.BibIndex(self._bib_path, self._index_path).GetSubset(["unused"])
+    self.assertTrue(os.path.exists(self._index_path))
+
+    # Appending an entry makes the saved index stale.
+    with open(self._bib_path, 'a') as ofile:
+      ofile.write("@article{new, title = {New}}\n")
+    self.assertEquals(
+      "@article{new, title = {New}}\n",
+      bib_lib.BibIndex(self._bib_path, self._index_path).GetSubset(
+        ["new"]).split('"ACM"}\n\n')[1])
+
+
+if __name__ == "__main__":
+  unittest.main()
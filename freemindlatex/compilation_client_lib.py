@@ -1,22 +1,108 @@
 """Client-side of the latex compilation service.
 """
 
+import abc
+import bisect
+import collections
+import hashlib
 import logging
 import os
+import subprocess
+import threading
 import time
+from concurrent import futures
+from xml.dom import minidom
+from xml.parsers import expat
 
 import gflags
 import grpc
-from freemindlatex import compilation_service_pb2, compilation_service_pb2_grpc
+from freemindlatex import (
+  bib_lib,
+  compilation_service_pb2,
+  compilation_service_pb2_grpc,
+  metrics_lib,
+  profiling_lib)
 
-gflags.DEFINE_string("watched_file_extensions", "mm,png,jpg",
-                     "Files extensions to watch for LaTeX compilation.")
 gflags.DEFINE_integer(
-  "max_health_retries",
+  "upload_cache_max_bytes",
+  256 * 1024 * 1024,
+  "Total size of file contents to keep in memory between compilations.")
+gflags.DEFINE_integer(
+  "backend_health_check_interval",
   5,
-  "Number of health check retries before giving up.")
+  "Seconds between checking the health and load of the compilation "
+  "servers, when there are several of them.")
+gflags.DEFINE_integer(
+  "backend_load_slack",
+  2,
+  "How many more queued and running compilations than the least loaded "
+  "server a project's own server may have, before we route elsewhere.")
+gflags.DEFINE_boolean(
+  "hedge_compilations",
+  False,
+  "With several servers, when a compilation takes longer than 90% of the "
+  "project's recent compilations, send it to a second server too, and take "
+  "the first response. The hedges_sent and hedges_won metrics count them, "
+  "see --client_metrics_port.")
+gflags.DEFINE_float(
+  "hedging_budget",
+  0.1,
+  "At most this fraction of compilations get hedged.")
+gflags.DEFINE_string(
+  "shared_project_roots",
+  "",
+  "Comma-separated local_dir=server_dir pairs, for directories the "
+  "compilation server also mounts, e.g. /mnt/nfs=/srv/nfs. Projects under "
+  "them are compiled from the server's mount, without uploading files.")
 gflags.DEFINE_string("latex_error_log_filename", "latex.log",
                      "Log file for latex compilation errors.")
+gflags.DEFINE_boolean(
+  "print_phase_timings",
+  False,
+  "Print where the time of each compilation went, e.g. waiting for the "
+  "server, converting the mindmap, or each pdflatex pass.")
+gflags.DEFINE_integer(
+  "client_metrics_port",
+  None,
+  "When set, serves the metrics of the client, e.g. of the hedged "
+  "compilations, in the Prometheus text format at "
+  "http://127.0.0.1:<port>/metrics while editing. 0 for an unused port. "
+  "Otherwise, they only get logged upon exiting.")
+gflags.DEFINE_string(
+  "profile_request_id",
+  None,
+  "When set, asks the compilation server to profile the compilations, "
+  "writing the profiles named by this id into its --profile_dir.")
+
+
+MINDMAP_FILENAME = "mindmap.mm"
+
+
+def FormatPhaseTimings(phase_timings):
+  """Describes the phases of a compilation, for people to read.
+
+  The phases of targets compiling in parallel overlap, so that their total
+  may be more than the time the compilation took.
+
+  Args:
+    phase_timings: the phase_timings of a
+      compilation_service_pb2.LatexCompilationResponse.
+
+  Returns:
+    e.g. 'total 1520.3ms: queue_wait 0.1ms, parse 12.0ms, ...'
+  """
+  return "total {:.1f}ms: {}".format(
+    sum(timing.microseconds for timing in phase_timings) / 1e3,
+    ", ".join("{} {:.1f}ms".format(timing.phase, timing.microseconds / 1e3)
+              for timing in phase_timings))
+
+
+def _GetProfileMetadata():
+  """Metadata of the RPCs, asking for profiles with --profile_request_id."""
+  if gflags.FLAGS.profile_request_id is None:
+    return None
+  return [(profiling_lib.PROFILE_ID_METADATA_KEY,
+           gflags.FLAGS.profile_request_id)]
 
 
 def _GetMTime(filename):
@@ -28,48 +114,146 @@ def _GetMTime(filename):
     return None
 
 
-def GetMTimeListForDir(directory):
-  """Getting the modification time for all user files in a directory.
+def GetImagePathsInMindmap(mindmap_content):
+  """Finds the images referenced by the mindmap.
+
+  They are the "img src" of the richcontent nodes, as convert_lib.ImageNode
+  reads them. Paths leaving the directory are ignored, as we cannot upload
+  them.
 
-  Returns: a sorted list of pairs in form of ('file1', 1234567), where the paths
-    are relative paths
+  Args:
+    mindmap_content: content of the mindmap.mm file.
+
+  Returns:
+    A sorted list of relative paths, e.g. ['figs/plot.png']
   """
-  suffixes = [
-    '.%s' %
-    i for i in gflags.FLAGS.watched_file_extensions.split(',')]
-  mtime_list = []
-  for dirpath, _, filenames in os.walk(directory):
-    for filename in [f for f in filenames if any(
-        f.endswith(suf) for suf in suffixes)]:
-      filepath = os.path.join(dirpath, filename)
-      mtime_list.append(
-        (os.path.relpath(
-          filepath,
-          directory),
-          _GetMTime(filepath)))
-  return sorted(mtime_list)
+  image_paths = set()
+  dom = minidom.parseString(mindmap_content)
+  for richcontent in dom.getElementsByTagName('richcontent'):
+    imgs = richcontent.getElementsByTagName('img')
+    if not imgs or not imgs[0].hasAttribute('src'):
+      continue
+    image_path = os.path.normpath(imgs[0].getAttribute('src'))
+    if os.path.isabs(image_path) or image_path.startswith(os.pardir):
+      logging.warning("Ignoring image outside the directory: %s", image_path)
+      continue
+    image_paths.add(image_path)
+  return sorted(image_paths)
+
 
+class CompilationManifest(object):
+  """Files to compile in a directory: mindmap.mm and the images it references.
 
-class LatexCompilationClient(object):
-  """Client-side of latex compilation.
+  The list of images is re-read only when mindmap.mm changes, so checking for
+  modifications costs a few stat calls, regardless of the directory size.
   """
 
-  def __init__(self, server_address):
-    self._channel = grpc.insecure_channel(server_address)
-    self._healthz_stub = compilation_service_pb2_grpc.HealthStub(self._channel)
-    self._compilation_stub = compilation_service_pb2_grpc.LatexCompilationStub(
-      self._channel)
+  def __init__(self, directory):
+    self._directory = directory
+    self._mindmap_mtime = None
+    self._filepaths = [MINDMAP_FILENAME]
 
-  def CheckHealthy(self):
+  def _RefreshFilepaths(self):
+    mindmap_loc = os.path.join(self._directory, MINDMAP_FILENAME)
+    mindmap_mtime = _GetMTime(mindmap_loc)
+    if mindmap_mtime is None or mindmap_mtime == self._mindmap_mtime:
+      return
     try:
-      response = self._healthz_stub.Check(
-        compilation_service_pb2.HealthCheckRequest())
-    except grpc.RpcError as e:
-      if e.code() == grpc.StatusCode.UNAVAILABLE:
-        return False
-      raise
-    return (response.status ==
-            compilation_service_pb2.HealthCheckResponse.SERVING)
+      with open(mindmap_loc) as infile:
+        image_paths = GetImagePathsInMindmap(infile.read())
+    except (IOError, expat.ExpatError) as e:
+      # Probably half-written. Retry on the next check.
+      logging.warning("Unable to read the images in the mindmap: %s", e)
+      return
+    self._mindmap_mtime = mindmap_mtime
+    self._filepaths = sorted(set([MINDMAP_FILENAME] + image_paths))
+
+  def GetMTimeList(self):
+    """Getting the modification time for all the files in the manifest.
+
+    Returns: a sorted list of pairs in form of ('file1', 1234567), where the
+      paths are relative paths. The time is None for missing files.
+    """
+    self._RefreshFilepaths()
+    return [(filepath, _GetMTime(os.path.join(self._directory, filepath)))
+            for filepath in self._filepaths]
+
+
+class FileContentCache(object):
+  """Caches file contents in memory, keyed by (path, size, mtime).
+
+  Reading an unchanged file then costs a stat instead of a read. The cache
+  evicts the least recently used contents when their total size goes beyond
+  max_bytes.
+  """
+
+  def __init__(self, max_bytes):
+    self._max_bytes = max_bytes
+    self._total_bytes = 0
+    self._entries = collections.OrderedDict()  # From the least recent.
+    self._path_to_key = {}
+
+  @staticmethod
+  def _GetMTimeNs(file_stat):
+    mtime_ns = getattr(file_stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+      mtime_ns = int(file_stat.st_mtime * 1e9)
+    return mtime_ns
+
+  def _Remove(self, key):
+    _, content = self._entries.pop(key)
+    self._total_bytes -= len(content)
+    del self._path_to_key[key[0]]
+
+  def Read(self, filepath):
+    """Reads the file, from the cache when it did not change.
+
+    Args:
+      filepath: path to the file, e.g. /tmp/testdir/mindmap.mm
+
+    Returns:
+      A pair of (sha1 hex digest of the content, the content).
+
+    Raises:
+      OSError or IOError, when the file cannot be read.
+    """
+    file_stat = os.stat(filepath)
+    key = (filepath, file_stat.st_size, self._GetMTimeNs(file_stat))
+    if key in self._entries:
+      entry = self._entries.pop(key)
+      self._entries[key] = entry
+      return entry
+
+    if filepath in self._path_to_key:
+      self._Remove(self._path_to_key[filepath])
+    with open(filepath, 'rb') as infile:
+      content = infile.read()
+    entry = (hashlib.sha1(content).hexdigest(), content)
+    if len(content) > self._max_bytes:
+      return entry
+
+    self._entries[key] = entry
+    self._path_to_key[filepath] = key
+    self._total_bytes += len(content)
+    while self._total_bytes > self._max_bytes:
+      self._Remove(next(iter(self._entries)))
+    return entry
+
+
+class BaseCompilationClient(object):
+  """Client-side of latex compilation, independent of where it happens.
+
+  Subclasses implement StartCompilingDir and CheckHealthy.
+  """
+  __metaclass__ = abc.ABCMeta
+
+  def __init__(self):
+    self._manifests = {}
+    self._bib_index = None
+
+  @abc.abstractmethod
+  def CheckHealthy(self):
+    """Whether the compilations can happen, e.g. the server is up."""
 
   @staticmethod
   def GetCompiledDocPath(directory):
@@ -85,7 +269,73 @@ class LatexCompilationClient(object):
     return os.path.join(
       directory, "{}.pdf".format(os.path.basename(directory)))
 
-  def CompileDir(self, directory, mode):
+  @staticmethod
+  def GetTargetDocPath(directory, mode):
+    """Get path to the compiled PDF file of an additional target.
+
+    Args:
+      directory: The directory where the compilations happend.
+        e.g. /tmp/testdir
+      mode: e.g. compilation_service_pb2.LatexCompilationRequest.REPORT
+
+    Returns:
+      The file name of the output document, e.g. /tmp/testdir/testdir.report.pdf
+    """
+    return os.path.join(
+      directory, "{}.{}.pdf".format(
+        os.path.basename(directory),
+        compilation_service_pb2.LatexCompilationRequest.Mode.Name(
+          mode).lower()))
+
+  @staticmethod
+  def GetHtmlDocPath(directory):
+    """Get path to the page rendered in the HTML mode.
+
+    Args:
+      directory: The directory where the compilations happend.
+        e.g. /tmp/testdir
+
+    Returns:
+      The file name of the page, e.g. /tmp/testdir/testdir.html
+    """
+    return os.path.join(
+      directory, "{}.html".format(os.path.basename(directory)))
+
+  def GetManifest(self, directory):
+    """The CompilationManifest of the directory, reused across compilations.
+    """
+    if directory not in self._manifests:
+      self._manifests[directory] = CompilationManifest(directory)
+    return self._manifests[directory]
+
+  def GetBibSubset(self, directory):
+    """The entries of the bib_file which the mindmap cites.
+
+    Args:
+      directory: directory where user's files locate
+
+    Returns:
+      The content of a bib file, to compile along with the mindmap. None when
+      the mindmap cites nothing, or the bib file cannot be read.
+    """
+    try:
+      with open(os.path.join(directory, MINDMAP_FILENAME)) as infile:
+        cited_keys = bib_lib.GetCitedKeys(infile.read())
+    except IOError as _:
+      return None
+    if not cited_keys:
+      return None
+
+    bib_path = bib_lib.GetBibFilePath()
+    if self._bib_index is None or self._bib_index.bib_path != bib_path:
+      self._bib_index = bib_lib.BibIndex(bib_path)
+    try:
+      return self._bib_index.GetSubset(cited_keys)
+    except (IOError, OSError) as e:
+      logging.warning("Unable to read the bib file %s: %s", bib_path, e)
+      return None
+
+  def CompileDir(self, directory, mode, extra_modes=()):
     """Compiles the files in user's directory, and update the pdf file.
 
     The function will prepare the directory content, send it over for
@@ -97,42 +347,679 @@ class LatexCompilationClient(object):
       directory: directory where user's files locate
       mode: the way to compile,
         e.g. compilation_service_pb2.LatexCompilationRequest.BEAMER
+      extra_modes: more ways to compile the same files, each into its own
+        pdf file (see GetTargetDocPath).
 
     Returns: boolean indicating if the compilation was successful.
       When unceccessful, leaves log files.
     """
+    response = self.StartCompilingDir(directory, mode, extra_modes).result()
+    return self.SaveCompilationResult(directory, response)
 
-    filename_and_mtime_list = GetMTimeListForDir(directory)
-    compilation_request = compilation_service_pb2.LatexCompilationRequest()
-    for filename, _ in filename_and_mtime_list:
-      with open(os.path.join(directory, filename)) as infile:
-        new_file_info = compilation_request.file_infos.add()
-        new_file_info.filepath = filename
-        new_file_info.content = infile.read()
-    compilation_request.compilation_mode = mode
-    target_pdf_loc = self.GetCompiledDocPath(directory)
+  @abc.abstractmethod
+  def StartCompilingDir(self, directory, mode, extra_modes=()):
+    """Like CompileDir, but does not wait for the compilation to finish.
+
+    Returns:
+      A future of the compilation_service_pb2.LatexCompilationResponse.
+      Pass its result to SaveCompilationResult.
+    """
+
+  def SaveCompilationResult(self, directory, response):
+    """Writes the compiled pdf (or html page), and the error log if any.
+
+    Args:
+      directory: directory where user's files locate
+      response: a compilation_service_pb2.LatexCompilationResponse
+
+    Returns: boolean indicating if the compilation was successful.
+    """
+    if response.target_results:
+      targets = [
+        (self.GetCompiledDocPath(directory) if index == 0
+         else self.GetTargetDocPath(directory, target_result.mode),
+         target_result)
+        for index, target_result in enumerate(response.target_results)]
+    else:
+      targets = [(self.GetCompiledDocPath(directory), response)]
 
-    response = self._compilation_stub.CompilePackage(compilation_request)
-    if response.pdf_content:
-      open(target_pdf_loc, 'w').write(response.pdf_content)
+    error_logs = []
+    for target_pdf_loc, target_result in targets:
+      if target_result.pdf_content:
+        open(target_pdf_loc, 'w').write(target_result.pdf_content)
+      if target_result.html_content:
+        open(self.GetHtmlDocPath(directory), 'w').write(
+          target_result.html_content)
+      if (target_result.status !=
+          compilation_service_pb2.LatexCompilationResponse.SUCCESS):
+        error_logs.append(target_result.compilation_log)
 
-    if (response.status !=
-        compilation_service_pb2.LatexCompilationResponse.SUCCESS):
+    if error_logs:
       latex_log_file = os.path.join(
         directory, gflags.FLAGS.latex_error_log_filename)
       with open(latex_log_file, 'w') as ofile:
-        ofile.write(response.compilation_log)
+        ofile.write("\n".join(error_logs))
+
+    if response.phase_timings:
+      phases_description = FormatPhaseTimings(response.phase_timings)
+      logging.info("Compilation phases: %s", phases_description)
+      if gflags.FLAGS.print_phase_timings:
+        print "Compiled in %s" % phases_description
+
+    return not error_logs
+
+
+def GetServerProjectRoot(directory, shared_project_roots):
+  """Finds the project directory on the server's mount.
+
+  Args:
+    directory: the user's directory, e.g. /mnt/nfs/talk
+    shared_project_roots: the value of the shared_project_roots flag,
+      e.g. '/mnt/nfs=/srv/nfs'
+
+  Returns:
+    The directory on the server, e.g. /srv/nfs/talk. None when the directory
+    is not on a shared mount.
+  """
+  directory = os.path.abspath(directory)
+  for root_pair in shared_project_roots.split(','):
+    if not root_pair:
+      continue
+    local_root, server_root = root_pair.split('=', 1)
+    relative_path = os.path.relpath(directory, local_root)
+    if not relative_path.startswith(os.pardir):
+      return os.path.normpath(os.path.join(server_root, relative_path))
+  return None
+
+
+class _Backend(object):
+  """One compilation server, with its channel and its last known load.
+  """
+
+  def __init__(self, address):
+    self.address = address
+    self.channel = grpc.insecure_channel(address)
+    self.healthz_stub = compilation_service_pb2_grpc.HealthStub(self.channel)
+    self.compilation_stub = (
+      compilation_service_pb2_grpc.LatexCompilationStub(self.channel))
+    self.healthy = True
+    self.load = 0
+
+  def UpdateHealth(self, health_check_future):
+    try:
+      response = health_check_future.result()
+    except grpc.RpcError as e:
+      logging.warning("Compilation server %s unhealthy: %s", self.address, e)
+      self.healthy = False
+      return
+    self.healthy = (response.status ==
+                    compilation_service_pb2.HealthCheckResponse.SERVING)
+    self.load = response.queue_depth + response.running_compilations
+
+  def MarkUnavailableOnError(self, compilation_future):
+    """Done-callback of the compilations sent to the server.
+    """
+    if compilation_future.cancelled():
+      return
+    error = compilation_future.exception()
+    if (isinstance(error, grpc.RpcError) and
+        error.code() == grpc.StatusCode.UNAVAILABLE):
+      self.healthy = False
+
+
+class BackendPool(object):
+  """Routes compilations among several compilation servers.
+
+  Each project has its own order of preference among the servers, by
+  consistent hashing, so that it mostly goes to the same server and finds the
+  server's caches warm. We skip unhealthy servers, and servers busier than
+  the least loaded one by more than the load slack.
+  """
+  _VIRTUAL_NODES_PER_BACKEND = 64
+  _HEALTH_CHECK_TIMEOUT_SECONDS = 1
+
+  def __init__(self, addresses, health_check_interval, load_slack):
+    self.backends = [_Backend(address) for address in addresses]
+    self._health_check_interval = health_check_interval
+    self._load_slack = load_slack
+    self._last_health_check_time = None
+    self._ring = sorted(
+      (self._Hash('{}#{}'.format(backend.address, i)), backend_index)
+      for backend_index, backend in enumerate(self.backends)
+      for i in range(self._VIRTUAL_NODES_PER_BACKEND))
+
+  @staticmethod
+  def _Hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+  def RefreshHealth(self, force=False):
+    """Checks the health and load of all servers, when it is time to.
+    """
+    now = time.time()
+    if not force and self._last_health_check_time is not None and (
+        now - self._last_health_check_time < self._health_check_interval):
+      return
+    self._last_health_check_time = now
+    health_check_futures = [
+      backend.healthz_stub.Check.future(
+        compilation_service_pb2.HealthCheckRequest(),
+        timeout=self._HEALTH_CHECK_TIMEOUT_SECONDS)
+      for backend in self.backends]
+    for backend, health_check_future in zip(
+        self.backends, health_check_futures):
+      backend.UpdateHealth(health_check_future)
+
+  def GetPreferredBackends(self, project_key):
+    """All the servers, in the project's order of preference.
+    """
+    preferred_backends = []
+    seen_backend_indices = set()
+    start = bisect.bisect(self._ring, (self._Hash(project_key),))
+    for i in range(len(self._ring)):
+      _, backend_index = self._ring[(start + i) % len(self._ring)]
+      if backend_index not in seen_backend_indices:
+        seen_backend_indices.add(backend_index)
+        preferred_backends.append(self.backends[backend_index])
+    return preferred_backends
+
+  def ChooseBackend(self, project_key):
+    """Picks the server to compile the project.
+
+    Args:
+      project_key: identifies the project, e.g. its directory.
+
+    Returns:
+      A _Backend.
+    """
+    if len(self.backends) == 1:
+      return self.backends[0]
+
+    self.RefreshHealth()
+    preferred_backends = self.GetPreferredBackends(project_key)
+    healthy_backends = [
+      backend for backend in preferred_backends if backend.healthy]
+    if not healthy_backends:
+      return preferred_backends[0]
+    min_load = min(backend.load for backend in healthy_backends)
+    for backend in healthy_backends:
+      if backend.load <= min_load + self._load_slack:
+        return backend
+
+  def ChooseHedgeBackend(self, project_key, primary_backend):
+    """Picks a second server for the project, or None when there is none.
+    """
+    for backend in self.GetPreferredBackends(project_key):
+      if backend is not primary_backend and backend.healthy:
+        return backend
+    return None
+
+
+class _HedgingBudget(object):
+  """Allows hedging up to a fraction of the compilations.
+  """
+
+  def __init__(self, fraction):
+    self._fraction = fraction
+    self._lock = threading.Lock()
+    self._num_compilations = 0
+    self._num_hedges = 0
 
-    return (response.status ==
-            compilation_service_pb2.LatexCompilationResponse.SUCCESS)
+  def RecordCompilation(self):
+    with self._lock:
+      self._num_compilations += 1
+
+  def TryAcquire(self):
+    """Whether a hedge fits in the budget. If so, counts it.
+    """
+    with self._lock:
+      if self._num_hedges + 1 > self._fraction * self._num_compilations:
+        return False
+      self._num_hedges += 1
+      return True
 
 
-def WaitTillHealthy(server_address):
-  """Wait until the server is healthy, with RPC calls.
+class _HedgingPlan(object):
+  """Where and when to send the duplicate of a compilation.
   """
-  client = LatexCompilationClient(server_address)
-  retries = 0
-  while not client.CheckHealthy() and retries < gflags.FLAGS.max_health_retries:
-    retries += 1
-    logging.info("Compilation server not healthy yet (%d's retry)", retries)
-    time.sleep(1)
+
+  def __init__(self, backend, delay, budget):
+    """
+    Args:
+      backend: the _Backend for the duplicate. None to never hedge.
+      delay: seconds to wait before hedging. None to never hedge.
+      budget: the _HedgingBudget the duplicate has to fit in.
+    """
+    self.backend = backend
+    self.delay = delay
+    self.budget = budget
+
+
+class _LatencyTracker(object):
+  """Recent compilation latencies of each project.
+  """
+  _MAX_SAMPLES_PER_PROJECT = 100
+  _MIN_SAMPLES_FOR_PERCENTILE = 5
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._latencies = collections.defaultdict(
+      lambda: collections.deque(maxlen=self._MAX_SAMPLES_PER_PROJECT))
+
+  def Record(self, project_key, seconds):
+    with self._lock:
+      self._latencies[project_key].append(seconds)
+
+  def GetPercentile(self, project_key, percentile):
+    """Returns the latency percentile in seconds, or None without enough data.
+    """
+    with self._lock:
+      latencies = sorted(self._latencies[project_key])
+    if len(latencies) < self._MIN_SAMPLES_FOR_PERCENTILE:
+      return None
+    return latencies[int(percentile / 100.0 * (len(latencies) - 1))]
+
+
+class HedgedCompilationFuture(object):
+  """Future of a compilation, which may also be sent to a second server.
+
+  The compilation goes to the primary server. If it has not finished after
+  the hedge delay, and the budget allows, a duplicate goes to the hedge
+  server. The first successful response wins, and the other RPC gets
+  cancelled.
+
+  It has the methods of a grpc future that LatestWinsCompilationScheduler and
+  BaseCompilationClient use.
+  """
+
+  def __init__(self, send_fn, primary_backend, hedging_plan, on_success):
+    """Sends the compilation to the primary server.
+
+    Args:
+      send_fn: sends the compilation to a _Backend, returning a grpc future.
+      primary_backend: the _Backend to send the compilation to.
+      hedging_plan: a _HedgingPlan.
+      on_success: called with the latency in seconds upon success.
+    """
+    self._send_fn = send_fn
+    self._hedging_budget = hedging_plan.budget
+    self._on_success = on_success
+    self._start_time = time.time()
+    self._lock = threading.Lock()
+    self._finished = threading.Event()
+    self._rpc_futures = []
+    self._response = None
+    self._error = None
+    self._cancelled = False
+    self._hedge_timer = None
+
+    self._Send(primary_backend)
+    if hedging_plan.backend is not None and hedging_plan.delay is not None:
+      self._hedge_timer = threading.Timer(
+        hedging_plan.delay, self._SendHedge, [hedging_plan.backend])
+      self._hedge_timer.daemon = True
+      self._hedge_timer.start()
+
+  def _Send(self, backend):
+    rpc_future = self._send_fn(backend)
+    with self._lock:
+      too_late = self._finished.is_set()
+      if not too_late:
+        self._rpc_futures.append(rpc_future)
+    if too_late:
+      rpc_future.cancel()
+      return
+    rpc_future.add_done_callback(self._OnRpcDone)
+
+  def _SendHedge(self, backend):
+    with self._lock:
+      if self._finished.is_set():
+        return
+    if not self._hedging_budget.TryAcquire():
+      return
+    logging.info("Compilation is slow. Also sending it to %s.",
+                 backend.address)
+    _HEDGES_SENT.Increment()
+    self._Send(backend)
+
+  def _OnRpcDone(self, rpc_future):
+    with self._lock:
+      if self._finished.is_set() or rpc_future.cancelled():
+        return
+      error = rpc_future.exception()
+      if error is not None and any(
+          not other.done() for other in self._rpc_futures):
+        return                  # The other RPC may still succeed.
+      if error is None:
+        self._response = rpc_future.result()
+      self._error = error
+      self._finished.set()
+      won_by_hedge = rpc_future is not self._rpc_futures[0]
+      losers = [other for other in self._rpc_futures
+                if other is not rpc_future]
+
+    self._CancelPending(losers)
+    if error is None:
+      if won_by_hedge:
+        _HEDGES_WON.Increment()
+      self._on_success(time.time() - self._start_time)
+
+  def _CancelPending(self, rpc_futures):
+    if self._hedge_timer is not None:
+      self._hedge_timer.cancel()
+    for rpc_future in rpc_futures:
+      rpc_future.cancel()
+
+  def done(self):
+    return self._finished.is_set()
+
+  def cancelled(self):
+    return self._cancelled
+
+  def cancel(self):
+    with self._lock:
+      if self._finished.is_set():
+        return False
+      self._cancelled = True
+      self._finished.set()
+      rpc_futures = list(self._rpc_futures)
+    self._CancelPending(rpc_futures)
+    return True
+
+  def exception(self, timeout=None):
+    if not self._finished.wait(timeout):
+      raise grpc.FutureTimeoutError()
+    if self._cancelled:
+      raise grpc.FutureCancelledError()
+    return self._error
+
+  def result(self, timeout=None):
+    error = self.exception(timeout)
+    if error is not None:
+      raise error
+    return self._response
+
+
+class LatexCompilationClient(BaseCompilationClient):
+  """Client-side of latex compilation, sending the files to a server.
+
+  With several servers (comma-separated addresses), each compilation goes to
+  one of them, see BackendPool.
+
+  When the server runs on the same computer (e.g. listening to a unix domain
+  socket), share_filesystem lets it read the files and write the pdf in place,
+  so that no file content goes through the RPCs. Similarly, projects under
+  the shared_project_roots get compiled from the server's mount.
+  """
+
+  def __init__(self, server_address, share_filesystem=False):
+    super(LatexCompilationClient, self).__init__()
+    self._share_filesystem = share_filesystem
+    self._backend_pool = BackendPool(
+      server_address.split(','),
+      health_check_interval=gflags.FLAGS.backend_health_check_interval,
+      load_slack=gflags.FLAGS.backend_load_slack)
+    self._hedging_budget = _HedgingBudget(gflags.FLAGS.hedging_budget)
+    self._latency_tracker = _LatencyTracker()
+    self._file_cache = FileContentCache(
+      gflags.FLAGS.upload_cache_max_bytes)
+
+  def CheckHealthy(self):
+    """Whether any of the servers is serving.
+    """
+    for backend in self._backend_pool.backends:
+      try:
+        response = backend.healthz_stub.Check(
+          compilation_service_pb2.HealthCheckRequest())
+      except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.UNAVAILABLE:
+          continue
+        raise
+      if (response.status ==
+          compilation_service_pb2.HealthCheckResponse.SERVING):
+        return True
+    return False
+
+  def Render(self, mindmap_content, mode):
+    """Converts the mindmap on a server, without compiling it.
+
+    Requests for the same mindmap go to the same server, which caches them.
+
+    Args:
+      mindmap_content: content of mindmap.mm, as bytes.
+      mode: e.g. compilation_service_pb2.LatexCompilationRequest.BEAMER
+
+    Returns:
+      A compilation_service_pb2.RenderResponse, with the TeX (or HTML) and
+      where each frame starts.
+
+    Raises:
+      grpc.RpcError: with INVALID_ARGUMENT when the mindmap does not convert.
+    """
+    request = compilation_service_pb2.RenderRequest()
+    request.mindmap_content = mindmap_content
+    request.compilation_mode = mode
+    backend = self._backend_pool.ChooseBackend(
+      hashlib.sha1(mindmap_content).hexdigest())
+    return backend.compilation_stub.Render(
+      request, metadata=_GetProfileMetadata())
+
+  def _PrepareCompilationRequest(self, directory, mode, extra_modes):
+    """Reads the user's files in the manifest into a compilation request.
+    """
+    filename_and_mtime_list = self.GetManifest(directory).GetMTimeList()
+    compilation_request = compilation_service_pb2.LatexCompilationRequest()
+    compilation_request.compilation_mode = mode
+    if extra_modes:
+      compilation_request.target_modes.extend([mode] + list(extra_modes))
+    server_project_root = GetServerProjectRoot(
+      directory, gflags.FLAGS.shared_project_roots)
+    if server_project_root is not None:
+      compilation_request.project_root = server_project_root
+
+    for filename, mtime in filename_and_mtime_list:
+      if mtime is None:
+        logging.warning("Referenced file does not exist: %s", filename)
+        continue
+      if server_project_root is not None:
+        compilation_request.file_infos.add().filepath = filename
+        continue
+      if self._share_filesystem:
+        new_file_info = compilation_request.file_infos.add()
+        new_file_info.filepath = filename
+        new_file_info.local_path = os.path.abspath(
+          os.path.join(directory, filename))
+        continue
+      try:
+        _, content = self._file_cache.Read(os.path.join(directory, filename))
+      except (IOError, OSError) as e:
+        logging.warning("Unable to read %s: %s", filename, e)
+        continue
+      new_file_info = compilation_request.file_infos.add()
+      new_file_info.filepath = filename
+      new_file_info.content = content
+    if server_project_root is None:
+      # Only the cited entries, rather than the whole library.
+      bib_subset = self.GetBibSubset(directory)
+      if bib_subset is not None:
+        new_file_info = compilation_request.file_infos.add()
+        new_file_info.filepath = bib_lib.BIB_SUBSET_FILENAME
+        new_file_info.content = bib_subset
+    if self._share_filesystem and server_project_root is None:
+      compilation_request.pdf_output_path = os.path.abspath(
+        self.GetCompiledDocPath(directory))
+    return compilation_request
+
+  def StartCompilingDir(self, directory, mode, extra_modes=()):
+    """Like CompileDir, but does not wait for the compilation to finish.
+
+    The files are read right away, so the compilation works on a snapshot
+    of the directory at the time of the call.
+
+    Returns:
+      A grpc future of the compilation_service_pb2.LatexCompilationResponse.
+      Pass its result to SaveCompilationResult.
+    """
+    project_key = os.path.abspath(directory)
+    start_time = time.time()
+    request = self._PrepareCompilationRequest(directory, mode, extra_modes)
+    # Not part of the server's phases. The rest of the difference between
+    # their total and the compilation latency goes to the network.
+    logging.info("Read the files in %.1fms, sending %d bytes.",
+                 (time.time() - start_time) * 1e3, request.ByteSize())
+
+    def SendTo(backend):
+      compilation_future = backend.compilation_stub.CompilePackage.future(
+        request, metadata=_GetProfileMetadata())
+      compilation_future.add_done_callback(backend.MarkUnavailableOnError)
+      return compilation_future
+
+    _COMPILATIONS_SENT.Increment()
+    primary_backend = self._backend_pool.ChooseBackend(project_key)
+    if not gflags.FLAGS.hedge_compilations:
+      return SendTo(primary_backend)
+
+    self._hedging_budget.RecordCompilation()
+    return HedgedCompilationFuture(
+      SendTo,
+      primary_backend,
+      _HedgingPlan(
+        self._backend_pool.ChooseHedgeBackend(project_key, primary_backend),
+        self._latency_tracker.GetPercentile(project_key, 90),
+        self._hedging_budget),
+      on_success=lambda seconds: self._latency_tracker.Record(
+        project_key, seconds))
+
+
+class LatestWinsCompilationScheduler(object):
+  """Compiles a directory in the background, keeping only the latest version.
+
+  There is at most one compilation in flight, and at most one pending. When
+  the files change during a compilation, the in-flight RPC gets cancelled and
+  a new one starts from the latest files, so intermediate versions are
+  dropped instead of piling up. A compilation already running may not stop
+  upon cancelling (e.g. on the worker thread of a local compilation), so we
+  also drop its result once it finishes, rather than saving the outdated
+  document over the one to come.
+
+  The editing loop calls Submit() upon file changes, and Poll() on every tick.
+  """
+
+  def __init__(self, latex_client, directory, mode, extra_modes=()):
+    self._latex_client = latex_client
+    self._directory = directory
+    self._mode = mode
+    self._extra_modes = extra_modes
+    self._in_flight = None
+    self._in_flight_outdated = False
+    self._pending = False
+
+  def Submit(self):
+    """Requests a compilation of the latest files in the directory.
+    """
+    if self._in_flight is not None and not self._in_flight.done():
+      logging.info("Files changed during compilation. Cancelling it.")
+      self._in_flight.cancel()
+      self._in_flight_outdated = True
+    self._pending = True
+    self.Poll()
+
+  def Poll(self):
+    """Collects the finished compilation, and starts the pending one.
+
+    Returns:
+      None when no compilation finished since the last poll. Otherwise, a
+      boolean indicating if the compilation was successful.
+    """
+    compilation_result = None
+    if self._in_flight is not None:
+      if not self._in_flight.done():
+        return None
+      future, self._in_flight = self._in_flight, None
+      outdated, self._in_flight_outdated = self._in_flight_outdated, False
+      if outdated:
+        logging.info("Dropping the result of the outdated compilation.")
+      elif not future.cancelled():
+        try:
+          compilation_result = self._latex_client.SaveCompilationResult(
+            self._directory, future.result())
+        except grpc.RpcError as e:
+          logging.error("Compilation failed: %s", e)
+          compilation_result = False
+
+    if self._pending:
+      self._pending = False
+      self._in_flight = self._latex_client.StartCompilingDir(
+        self._directory, self._mode, self._extra_modes)
+    return compilation_result
+
+  def IsBusy(self):
+    """Whether a compilation is in flight.
+    """
+    return self._in_flight is not None
+
+  def Wait(self, timeout):
+    """Sleeps for the timeout, or until the in-flight compilation finishes.
+    """
+    if self._in_flight is None:
+      time.sleep(timeout)
+      return
+    try:
+      self._in_flight.exception(timeout=timeout)
+    except (grpc.FutureTimeoutError, grpc.FutureCancelledError,
+            futures.TimeoutError, futures.CancelledError) as _:
+      pass
+
+  def Cancel(self):
+    """Cancels the in-flight and the pending compilations.
+    """
+    self._pending = False
+    if self._in_flight is not None:
+      self._in_flight.cancel()
+      self._in_flight = None
+      self._in_flight_outdated = False
+
+
+_COMPILATIONS_SENT = metrics_lib.GetCounter(
+  'compilations_sent', 'Compilations sent to the servers.')
+_HEDGES_SENT = metrics_lib.GetCounter(
+  'hedges_sent', 'Compilations also sent to a second server, being slow.')
+_HEDGES_WON = metrics_lib.GetCounter(
+  'hedges_won', 'Hedged compilations where the second server answered first.')
+
+
+class ServerStartupError(Exception):
+  pass
+
+
+def LaunchServerProcess(app_command, server_flags=()):
+  """Starts a compilation server process, and waits till it listens.
+
+  The server reports its address through an inherited pipe (see
+  compilation_server_lib.RunServer), so there is no polling.
+
+  Args:
+    app_command: how to run freemindlatex_app_main, e.g.
+      ["python", "freemindlatex_app_main.py"]
+    server_flags: flags of the server, e.g. ["--port", "8117"]. We add the
+      --ready_fd flag, and the server command.
+
+  Returns:
+    A pair of the server's subprocess.Popen, and its address,
+    e.g. '127.0.0.1:8117' or 'unix:/tmp/freemindlatex.sock'.
+
+  Raises:
+    ServerStartupError: when the server exits before listening.
+  """
+  read_fd, write_fd = os.pipe()
+  server_proc = subprocess.Popen(
+    list(app_command) + list(server_flags) +
+    ["--ready_fd={}".format(write_fd), "server"],
+    close_fds=False)
+  os.close(write_fd)
+  with os.fdopen(read_fd) as ready_file:
+    address_line = ready_file.readline()
+  if not address_line:
+    raise ServerStartupError(
+      "Compilation server exited with code %r" % server_proc.wait())
+  return server_proc, address_line.strip()
+
@@ -1,6 +1,24 @@
+import os
+import shutil
+import sys
+import tempfile
 import unittest
+from concurrent import futures
 
-from freemindlatex import compilation_client_lib
+import gflags
+from freemindlatex import (compilation_client_lib, compilation_service_pb2,
+                           flags_test_lib)
+
+
+class _IdleCompilationClient(compilation_client_lib.BaseCompilationClient):
+  """Never compiles, for testing the parts common to all clients.
+  """
+
+  def CheckHealthy(self):
+    return True
+
+  def StartCompilingDir(self, directory, mode, extra_modes=()):
+    return futures.Future()
 
 
 class TestGettingCompiledDocPath(unittest.TestCase):
@@ -10,6 +28,276 @@ class TestGettingCompiledDocPath(unittest.TestCase):
       compilation_client_lib.LatexCompilationClient.GetCompiledDocPath(
         '/tmp/testdir'))
 
+  def testGettingTargetDocPath(self):
+    self.assertEquals(
+      '/tmp/testdir/testdir.report.pdf',
+      compilation_client_lib.LatexCompilationClient.GetTargetDocPath(
+        '/tmp/testdir', compilation_service_pb2.LatexCompilationRequest.REPORT))
+
+
+class TestSavingCompilationResult(unittest.TestCase):
+
+  def setUp(self):
+    self._test_dir = os.path.join(tempfile.mkdtemp(), 'talk')
+    os.mkdir(self._test_dir)
+    self._client = _IdleCompilationClient()
+
+  def tearDown(self):
+    shutil.rmtree(os.path.dirname(self._test_dir))
+
+  def _ReadFile(self, filename):
+    return open(os.path.join(self._test_dir, filename)).read()
+
+  def testSavingEachTarget(self):
+    response = compilation_service_pb2.LatexCompilationResponse()
+    for mode, status, content in [
+        (compilation_service_pb2.LatexCompilationRequest.BEAMER,
+         compilation_service_pb2.LatexCompilationResponse.SUCCESS, 'slides'),
+        (compilation_service_pb2.LatexCompilationRequest.REPORT,
+         compilation_service_pb2.LatexCompilationResponse.EMBEDDED, 'report')]:
+      target_result = response.target_results.add()
+      target_result.mode = mode
+      target_result.status = status
+      target_result.pdf_content = content
+      target_result.compilation_log = '{} log'.format(content)
+
+    self.assertFalse(
+      self._client.SaveCompilationResult(self._test_dir, response))
+    self.assertEquals('slides', self._ReadFile('talk.pdf'))
+    self.assertEquals('report', self._ReadFile('talk.report.pdf'))
+    self.assertEquals('report log', self._ReadFile('latex.log'))
+
+
+_MINDMAP_WITH_IMAGES = """<map version="1.0.1">
+<node ID="ID_1" TEXT="Title">
+<node ID="ID_2" TEXT="A slide">
+<richcontent TYPE="NODE"><html><body><img src="figs/plot.pdf"/></body></html>
+</richcontent>
+<richcontent TYPE="NODE"><html><body><img src="../outside.png"/></body></html>
+</richcontent>
+</node>
+</node>
+</map>
+"""
+
+
+class TestCompilationManifest(unittest.TestCase):
+
+  def setUp(self):
+    self._test_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._test_dir)
+
+  def testImagePathsInMindmap(self):
+    self.assertEquals(
+      ['figs/plot.pdf'],
+      compilation_client_lib.GetImagePathsInMindmap(_MINDMAP_WITH_IMAGES))
+
+  def testOnlyWatchingReferencedFiles(self):
+    with open(os.path.join(self._test_dir, 'mindmap.mm'), 'w') as ofile:
+      ofile.write(_MINDMAP_WITH_IMAGES)
+    with open(os.path.join(self._test_dir, 'screenshot.png'), 'w') as ofile:
+      ofile.write('unrelated')
+
+    manifest = compilation_client_lib.CompilationManifest(self._test_dir)
+    mtime_list = manifest.GetMTimeList()
+    self.assertEquals(['figs/plot.pdf', 'mindmap.mm'],
+                      [filepath for filepath, _ in mtime_list])
+    self.assertIsNone(dict(mtime_list)['figs/plot.pdf'])
+
+
+class TestFileContentCache(unittest.TestCase):
+
+  def setUp(self):
+    self._test_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._test_dir)
+
+  def _WriteFile(self, filename, content, mtime):
+    filepath = os.path.join(self._test_dir, filename)
+    with open(filepath, 'w') as ofile:
+      ofile.write(content)
+    os.utime(filepath, (mtime, mtime))
+    return filepath
+
+  def testUnchangedFilesAreNotReadAgain(self):
+    cache = compilation_client_lib.FileContentCache(max_bytes=100)
+    filepath = self._WriteFile('a.png', 'aaaa', mtime=1000)
+    content_hash, content = cache.Read(filepath)
+    self.assertEquals('aaaa', content)
+
+    # Same size and mtime: served from the cache.
+    self._WriteFile('a.png', 'bbbb', mtime=1000)
+    self.assertEquals((content_hash, 'aaaa'), cache.Read(filepath))
+
+    self._WriteFile('a.png', 'bbbb', mtime=2000)
+    self.assertEquals('bbbb', cache.Read(filepath)[1])
+
+  def testEvictingLeastRecentlyUsed(self):
+    cache = compilation_client_lib.FileContentCache(max_bytes=8)
+    a_path = self._WriteFile('a.png', 'aaaa', mtime=1000)
+    b_path = self._WriteFile('b.png', 'bbbb', mtime=1000)
+    c_path = self._WriteFile('c.png', 'cccc', mtime=1000)
+    cache.Read(a_path)
+    cache.Read(b_path)
+    cache.Read(a_path)
+    cache.Read(c_path)          # Evicts b.png
+
+    self._WriteFile('a.png', 'AAAA', mtime=1000)
+    self._WriteFile('b.png', 'BBBB', mtime=1000)
+    self.assertEquals('aaaa', cache.Read(a_path)[1])
+    self.assertEquals('BBBB', cache.Read(b_path)[1])
+
+
+class TestGettingServerProjectRoot(unittest.TestCase):
+
+  def testProjectOnSharedMount(self):
+    self.assertEquals(
+      '/srv/nfs/talks/thesis',
+      compilation_client_lib.GetServerProjectRoot(
+        '/mnt/nfs/talks/thesis', '/home/me=/srv/home,/mnt/nfs=/srv/nfs'))
+
+  def testProjectNotOnSharedMount(self):
+    self.assertIsNone(
+      compilation_client_lib.GetServerProjectRoot(
+        '/mnt/nfs2/thesis', '/mnt/nfs=/srv/nfs'))
+    self.assertIsNone(
+      compilation_client_lib.GetServerProjectRoot('/mnt/nfs/thesis', ''))
+
+
+class TestFormattingPhaseTimings(unittest.TestCase):
+
+  def testFormatting(self):
+    response = compilation_service_pb2.LatexCompilationResponse()
+    for phase, microseconds in [("parse", 1500), ("pdflatex:slides", 250000)]:
+      phase_timing = response.phase_timings.add()
+      phase_timing.phase = phase
+      phase_timing.microseconds = microseconds
+    self.assertEquals(
+      "total 251.5ms: parse 1.5ms, pdflatex:slides 250.0ms",
+      compilation_client_lib.FormatPhaseTimings(response.phase_timings))
+
+
+class TestGettingBibSubset(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    self._temp_dir = tempfile.mkdtemp()
+    self._project_dir = os.path.join(self._temp_dir, "talk")
+    os.mkdir(self._project_dir)
+    gflags.FLAGS.bib_file = os.path.join(self._temp_dir, "library.bib")
+    gflags.FLAGS.bib_index_dir = os.path.join(self._temp_dir, "index")
+    with open(gflags.FLAGS.bib_file, 'w') as ofile:
+      ofile.write("@article{a, title={A}}\n@article{b, title={B}}\n")
+
+  def tearDown(self):
+    shutil.rmtree(self._temp_dir)
+
+  def _GetBibSubset(self, mindmap_content):
+    with open(os.path.join(self._project_dir, "mindmap.mm"), 'w') as ofile:
+      ofile.write(mindmap_content)
+    return _IdleCompilationClient().GetBibSubset(
+      self._project_dir)
+
+  def testOnlyCitedEntries(self):
+    self.assertEquals(
+      "@article{b, title={B}}\n",
+      self._GetBibSubset('<node TEXT="As in \\cite{b}"/>'))
+
+  def testNoCitation(self):
+    self.assertIsNone(self._GetBibSubset('<node TEXT="Nothing cited"/>'))
+
+
+_FAKE_APP = """
+import os
+import sys
+
+with open(sys.argv[1], 'w') as ofile:
+  ofile.write(" ".join(sys.argv[2:]))
+os.write(int(sys.argv[-2][len("--ready_fd="):]), "unix:/tmp/fake.sock\\n")
+"""
+
+
+class TestLaunchingServerProcess(unittest.TestCase):
+
+  def setUp(self):
+    self._temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._temp_dir)
+
+  def testHandshake(self):
+    args_path = os.path.join(self._temp_dir, "args.txt")
+    server_proc, server_address = compilation_client_lib.LaunchServerProcess(
+      [sys.executable, "-c", _FAKE_APP, args_path],
+      ["--unix_socket", "/tmp/fake.sock"])
+    server_proc.wait()
+    self.assertEquals("unix:/tmp/fake.sock", server_address)
+    self.assertRegexpMatches(
+      open(args_path).read(),
+      r"^--unix_socket /tmp/fake.sock --ready_fd=\d+ server$")
+
+  def testServerExitingBeforeListening(self):
+    with self.assertRaisesRegexp(compilation_client_lib.ServerStartupError,
+                                 "code 3"):
+      compilation_client_lib.LaunchServerProcess(
+        [sys.executable, "-c", "import sys; sys.exit(3)"])
+
+
+class FakeLatexClient(object):
+  """Hands out futures that the test resolves by hand.
+  """
+
+  def __init__(self):
+    self.started = []
+    self.saved_responses = []
+
+  def StartCompilingDir(self, directory, mode, extra_modes=()):
+    future = futures.Future()
+    self.started.append(future)
+    return future
+
+  def SaveCompilationResult(self, directory, response):
+    self.saved_responses.append(response)
+    return True
+
+
+class TestLatestWinsCompilationScheduler(unittest.TestCase):
+
+  def setUp(self):
+    self._client = FakeLatexClient()
+    self._scheduler = compilation_client_lib.LatestWinsCompilationScheduler(
+      self._client, '/tmp/testdir', mode=None)
+
+  def testNewerSubmissionCancelsTheInFlightOne(self):
+    self._scheduler.Submit()
+    self._scheduler.Submit()
+    self.assertEquals(2, len(self._client.started))
+    self.assertTrue(self._client.started[0].cancelled())
+
+    self._client.started[1].set_result('second')
+    self.assertTrue(self._scheduler.Poll())
+    self.assertEquals(['second'], self._client.saved_responses)
+
+  def testDroppingTheResultOfTheRunningOne(self):
+    self._scheduler.Submit()
+    # Running, it can no longer get cancelled.
+    self.assertTrue(self._client.started[0].set_running_or_notify_cancel())
+    self._scheduler.Submit()
+    self.assertFalse(self._client.started[0].cancelled())
+
+    self._client.started[0].set_result('first')
+    self.assertIsNone(self._scheduler.Poll())
+    self.assertEquals(2, len(self._client.started))
+    self._client.started[1].set_result('second')
+    self.assertTrue(self._scheduler.Poll())
+    self.assertEquals(['second'], self._client.saved_responses)
+
+  def testPollingWithoutFinishedCompilation(self):
+    self._scheduler.Submit()
+    self.assertIsNone(self._scheduler.Poll())
+    self.assertEquals([], self._client.saved_responses)
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -1,29 +1,139 @@
 import codecs
 import collections
+import contextlib
 import errno
+import hashlib
+import io
 import logging
+import math
+import multiprocessing
 import os
 import re
+import resource
 import shutil
+import signal
 import subprocess
 import tempfile
+import threading
 import time
 from concurrent import futures
 
+import gflags
 import grpc
 from freemindlatex import (
+  bib_lib,
   compilation_service_pb2,
   compilation_service_pb2_grpc,
-  convert_lib)
+  convert_lib,
+  gevent_lib,
+  metrics_lib,
+  profiling_lib)
 
 _LATEX_MAIN_FILE_BASENAME_MAP = {
   compilation_service_pb2.LatexCompilationRequest.BEAMER: 'slides',
-  compilation_service_pb2.LatexCompilationRequest.REPORT: 'report'
+  compilation_service_pb2.LatexCompilationRequest.REPORT: 'report',
+  compilation_service_pb2.LatexCompilationRequest.HANDOUT: 'handout'
 }
 _LATEX_CONTENT_TEX_FILE_NAME = "mindmap.tex"
+_PRINT_FORMAT_MAP = {
+  compilation_service_pb2.LatexCompilationRequest.BEAMER: 'beamer_latex',
+  compilation_service_pb2.LatexCompilationRequest.REPORT: 'latex',
+  compilation_service_pb2.LatexCompilationRequest.HANDOUT: 'beamer_latex',
+  compilation_service_pb2.LatexCompilationRequest.HTML: 'html'
+}
+# When compiling several targets, each one compiles in its own directory
+# under this one, linking to the files of the working directory.
+_TARGETS_DIR_NAME = "targets"
+
+gflags.DEFINE_boolean(
+  "allow_local_paths",
+  False,
+  "Whether to accept requests reading and writing files on the server's "
+  "filesystem (local_path and pdf_output_path). Only for servers running on "
+  "the same computer as their clients.")
+gflags.DEFINE_string(
+  "allowed_project_roots",
+  "",
+  "Comma-separated directories on the server (e.g. shared mounts), under "
+  "which requests may name a project_root to compile from.")
+gflags.DEFINE_integer(
+  "max_concurrent_compilations",
+  4,
+  "Number of compilations to run at the same time. Others wait in a queue.")
+gflags.DEFINE_enum(
+  "server_implementation",
+  "threads",
+  ["threads", "gevent"],
+  "How the server handles requests: a pool of threads, or gevent "
+  "greenlets, where waiting on RPCs and TeX processes costs no thread. "
+  "gevent only listens to ports, not to unix domain sockets, and needs "
+  "--conversion_processes.")
+gflags.DEFINE_integer(
+  "gevent_max_concurrent_rpcs",
+  1000,
+  "With the gevent server implementation, the number of RPCs handled at the "
+  "same time.")
+gflags.DEFINE_integer(
+  "tex_wall_time_limit_seconds",
+  120,
+  "Kills pdflatex or bibtex runs taking longer than this. 0 for no limit.")
+gflags.DEFINE_integer(
+  "tex_cpu_time_limit_seconds",
+  60,
+  "Kills pdflatex or bibtex runs using more CPU time than this. 0 for no "
+  "limit.")
+gflags.DEFINE_integer(
+  "tex_memory_limit_mb",
+  2048,
+  "Address space limit of pdflatex and bibtex processes. 0 for no limit.")
+gflags.DEFINE_integer(
+  "tex_output_limit_mb",
+  256,
+  "Size limit of each file written by pdflatex and bibtex. 0 for no limit.")
+gflags.DEFINE_integer(
+  "max_latex_errors",
+  1,
+  "Stops pdflatex once its output shows this many errors, to start "
+  "embedding the errors into the frames sooner. The passes embedding them "
+  "repeat until no frame has errors. 0 for never stopping.")
+gflags.DEFINE_integer(
+  "conversion_processes",
+  0,
+  "Number of worker processes converting mindmaps into TeX, so that "
+  "concurrent compilations use several cores. When 0, converts in the "
+  "request's thread.")
+gflags.DEFINE_integer(
+  "render_cache_entries",
+  256,
+  "Number of documents produced by the Render RPC to keep in memory.")
+gflags.DEFINE_integer(
+  "bibtex_cache_entries",
+  64,
+  "Number of bibliographies (.bbl files) produced by bibtex to keep in "
+  "memory, keyed by the cited keys, the bib files and the style.")
+gflags.DEFINE_integer(
+  "image_dpi",
+  0,
+  "When positive, downscales the images to this resolution at the size the "
+  "document shows them, before running TeX. Needs PIL. 0 for keeping the "
+  "images as they are.")
+gflags.DEFINE_integer(
+  "image_cache_entries",
+  64,
+  "Number of downscaled images to keep in memory.")
+gflags.DEFINE_integer(
+  "metrics_port",
+  None,
+  "When set, serves the metrics in the Prometheus text format at "
+  "http://<host>:<port>/metrics. 0 for an unused port.")
+gflags.DEFINE_integer(
+  "max_snapshot_attempts",
+  3,
+  "Number of times to try taking a consistent snapshot of a project_root "
+  "whose files keep changing.")
 
 
-def _MkdirP(directory):
+def MkdirP(directory):
   """Makes sure the directory exists. Otherwise, will try creating it.
 
   Args:
@@ -45,7 +155,263 @@ def _MkdirP(directory):
       raise
 
 
-def _CompileLatexAtDir(working_dir, compilation_mode):
+class CompilationCancelledError(Exception):
+  pass
+
+
+_LIMIT_KILL_COUNTERS = {
+  'wall_time': metrics_lib.GetCounter(
+    'tex_killed_wall_time', 'TeX processes killed for running too long.'),
+  'cpu_time': metrics_lib.GetCounter(
+    'tex_killed_cpu_time', 'TeX processes killed for using too much CPU.'),
+  'memory': metrics_lib.GetCounter(
+    'tex_killed_memory', 'TeX processes failing on the memory limit.'),
+  'output_size': metrics_lib.GetCounter(
+    'tex_killed_output_size', 'TeX processes killed for writing too much.'),
+}
+
+
+class ResourceLimitExceededError(Exception):
+  """A TeX process got stopped for exceeding one of its limits.
+  """
+
+  def __init__(self, limit, output):
+    """
+    Args:
+      limit: which limit, a key of _LIMIT_KILL_COUNTERS, e.g. 'cpu_time'.
+      output: the standard output of the process, till it got stopped.
+    """
+    super(ResourceLimitExceededError, self).__init__(
+      "Exceeded the {} limit".format(limit))
+    self.limit = limit
+    self.output = output
+
+
+def _GetProcessLimitsSetter():
+  """Gets the preexec_fn of TeX processes.
+
+  It starts a new process group, and sets the limits of the tex_*_limit flags.
+  """
+  rlimits = []
+  cpu_seconds = gflags.FLAGS.tex_cpu_time_limit_seconds
+  if cpu_seconds > 0:
+    # SIGXCPU at the soft limit, SIGKILL at the hard one.
+    rlimits.append((resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1)))
+  memory_bytes = gflags.FLAGS.tex_memory_limit_mb * 1024 * 1024
+  if memory_bytes > 0:
+    rlimits.append((resource.RLIMIT_AS, (memory_bytes, memory_bytes)))
+  output_bytes = gflags.FLAGS.tex_output_limit_mb * 1024 * 1024
+  if output_bytes > 0:
+    rlimits.append((resource.RLIMIT_FSIZE, (output_bytes, output_bytes)))
+
+  def SetProcessLimits():
+    os.setsid()
+    # Python ignores SIGXFSZ, and children inherit it.
+    signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+    for rlimit, values in rlimits:
+      resource.setrlimit(rlimit, values)
+
+  return SetProcessLimits
+
+
+_RUNNING_PROCESSES = metrics_lib.GetGauge(
+  'running_tex_processes', 'TeX processes running, across compilations.')
+
+
+# How the programs report on their standard error that allocating memory
+# failed. Not "TeX capacity exceeded": that is TeX's own tables filling up,
+# e.g. upon runaway recursion, an error of the document.
+_MEMORY_ERROR_MESSAGES = ["memory exhausted", "Cannot allocate memory"]
+
+
+def _GetExceededLimit(return_code, stderr, wall_seconds):
+  """Tells from how the process ended which limit it exceeded, if any.
+
+  Args:
+    return_code: the return code of the process.
+    stderr: its standard error.
+    wall_seconds: how long it ran.
+  """
+  if return_code == -signal.SIGXCPU:
+    return 'cpu_time'
+  cpu_seconds = gflags.FLAGS.tex_cpu_time_limit_seconds
+  if (return_code == -signal.SIGKILL and cpu_seconds > 0 and
+      wall_seconds >= cpu_seconds + 1):
+    # Besides our own kills, which are told apart earlier, the hard CPU limit
+    # sends SIGKILL. TeX runs in a single thread, which uses no more CPU time
+    # than wall time, so quicker kills come from elsewhere.
+    return 'cpu_time'
+  if return_code == -signal.SIGXFSZ:
+    return 'output_size'
+  # The standard output echoes the lines of the document, which may say
+  # anything, so only the allocator's failure on the standard error counts.
+  if (return_code != 0 and gflags.FLAGS.tex_memory_limit_mb > 0 and any(
+      message in stderr for message in _MEMORY_ERROR_MESSAGES)):
+    return 'memory'
+  return None
+
+
+class PhaseTimer(object):
+  """Measures the time spent in each phase of a compilation.
+
+  Targets compiling in parallel record their phases into the same timer.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._timings = []
+
+  def Record(self, phase, seconds):
+    with self._lock:
+      self._timings.append((phase, int(seconds * 1e6)))
+
+  @contextlib.contextmanager
+  def Time(self, phase):
+    """Records the time spent in the with statement."""
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self.Record(phase, time.time() - start_time)
+
+  def GetTimings(self):
+    """A list of (phase, microseconds), in the order they got recorded."""
+    with self._lock:
+      return list(self._timings)
+
+
+def _AddPhaseTimings(response, timings):
+  """Adds (phase, microseconds) pairs to the LatexCompilationResponse."""
+  for phase, microseconds in timings:
+    phase_timing = response.phase_timings.add()
+    phase_timing.phase = phase
+    phase_timing.microseconds = microseconds
+
+
+class CompilationJob(object):
+  """State of one compilation, shared by its steps.
+
+  Cancelling the job (e.g. when the client goes away) kills its running TeX
+  processes, and stops it from starting new ones. Its timer measures the
+  phases of the compilation. With a profile_id, its Python work gets
+  profiled, see profiling_lib. With a bibtex_cache, its targets restore the
+  bibliographies they already had.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._processes = set()
+    self.cancelled = False
+    self.timer = PhaseTimer()
+    self.profile_id = None
+    self.bibtex_cache = None
+
+  @staticmethod
+  def _Kill(proc):
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except OSError as _:
+      pass                      # Already exited.
+
+  def Cancel(self):
+    with self._lock:
+      self.cancelled = True
+      processes = list(self._processes)
+    for proc in processes:
+      self._Kill(proc)
+
+  def _StreamOutput(self, proc, output_line_callback):
+    lines = []
+    # Not iterating over the file, which reads ahead in large blocks.
+    for line in iter(proc.stdout.readline, ''):
+      lines.append(line)
+      if output_line_callback(line):
+        self._Kill(proc)
+        break
+    proc.stdout.close()
+    proc.wait()
+    return ''.join(lines)
+
+  def RunProcess(self, args, working_dir, output_line_callback=None):
+    """Runs the command in its own process group, and waits for it.
+
+    The command runs under the time and resource limits set by the tex_*_limit
+    flags.
+
+    Args:
+      args: the command, e.g. ["bibtex", "slides"]
+      working_dir: where to run the command.
+      output_line_callback: if given, called with each line of the standard
+        output, as the command produces it. When it returns True, the command
+        gets killed.
+
+    Returns:
+      A pair of the return code, and the standard output.
+
+    Raises:
+      CompilationCancelledError: when the job gets cancelled.
+      ResourceLimitExceededError: when the command exceeds one of its limits.
+    """
+    stopped_on_output = []
+
+    def _OutputLineCallback(line):
+      if output_line_callback(line):
+        stopped_on_output.append(True)
+        return True
+      return False
+
+    stderr_file = tempfile.TemporaryFile()
+    with self._lock:
+      if self.cancelled:
+        raise CompilationCancelledError
+      proc = subprocess.Popen(
+        args, cwd=working_dir, stdout=subprocess.PIPE, stderr=stderr_file,
+        preexec_fn=_GetProcessLimitsSetter())
+      self._processes.add(proc)
+    _RUNNING_PROCESSES.Increment()
+    start_time = time.time()
+
+    timed_out = []
+
+    def _KillOnTimeout():
+      timed_out.append(True)
+      self._Kill(proc)
+
+    wall_timer = None
+    if gflags.FLAGS.tex_wall_time_limit_seconds > 0:
+      wall_timer = threading.Timer(
+        gflags.FLAGS.tex_wall_time_limit_seconds, _KillOnTimeout)
+      wall_timer.start()
+    try:
+      if output_line_callback is None:
+        stdout, _ = proc.communicate()
+      else:
+        stdout = self._StreamOutput(proc, _OutputLineCallback)
+    finally:
+      if wall_timer is not None:
+        wall_timer.cancel()
+      with self._lock:
+        self._processes.discard(proc)
+      _RUNNING_PROCESSES.Increment(-1)
+    if self.cancelled:
+      raise CompilationCancelledError
+
+    stderr_file.seek(0)
+    stderr = stderr_file.read()
+    stderr_file.close()
+    exceeded_limit = None
+    if timed_out:
+      exceeded_limit = 'wall_time'
+    elif not stopped_on_output:
+      exceeded_limit = _GetExceededLimit(
+        proc.returncode, stderr, time.time() - start_time)
+    if exceeded_limit is not None:
+      _LIMIT_KILL_COUNTERS[exceeded_limit].Increment()
+      raise ResourceLimitExceededError(exceeded_limit, stdout)
+    return proc.returncode, stdout
+
+
+def _CompileLatexAtDir(working_dir, compilation_mode, job, error_parser=None):
   """Runs pdflatex at the working directory.
 
   Args:
@@ -53,6 +419,9 @@ def _CompileLatexAtDir(working_dir, compilation_mode):
       Normally a temporary directory (e.g. /tmp/123).
     compilation_mode:
       e.g. compilation_service_pb2.LatexCompilationRequest.BEAMER or REPORT
+    job: the CompilationJob.
+    error_parser: if given, a LatexErrorParser fed with the log while pdflatex
+      runs. pdflatex gets stopped once it has seen enough errors.
 
   Returns:
     A compilation_service_pb2.LatexCompilationResponse, whose status is either
@@ -60,12 +429,13 @@ def _CompileLatexAtDir(working_dir, compilation_mode):
     or compilation_service_pb2.LatexCompilationResponse.ERROR
   """
   basename = _LATEX_MAIN_FILE_BASENAME_MAP[compilation_mode]
-  proc = subprocess.Popen(
-    ["pdflatex", "-interaction=nonstopmode",
-     "{}.tex".format(basename)], cwd=working_dir,
-    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  stdout, _ = proc.communicate()
-  return_code = proc.returncode
+  output_line_callback = None
+  if error_parser is not None:
+    output_line_callback = error_parser.FeedLineAndCheckEnough
+  with job.timer.Time("pdflatex:{}".format(basename)):
+    return_code, stdout = job.RunProcess(
+      ["pdflatex", "-interaction=nonstopmode",
+       "{}.tex".format(basename)], working_dir, output_line_callback)
 
   result = compilation_service_pb2.LatexCompilationResponse()
   result.compilation_log = stdout
@@ -89,7 +459,7 @@ class BibtexCompilationError(Exception):
   pass
 
 
-def _CompileBibtexAtDir(working_dir, compilation_mode):
+def _CompileBibtexAtDir(working_dir, compilation_mode, job):
   """Runs bibtex at the working directory.
 
   Args:
@@ -97,116 +467,722 @@ def _CompileBibtexAtDir(working_dir, compilation_mode):
       e.g. /tmp/123
     compilation_mode:
       e.g. compilation_service_pb2.LatexCompilationRequest.BEAMER or REPORT
+    job: the CompilationJob.
 
   Raises:
     BibtexCompilationError: when bibtex compilation encounters some errors
       or warnings
   """
-  proc = subprocess.Popen(
-    ["bibtex",
-     _LATEX_MAIN_FILE_BASENAME_MAP[compilation_mode]],
-    cwd=working_dir, stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE)
-  stdout, _ = proc.communicate()
-  if proc.returncode != 0:
+  basename = _LATEX_MAIN_FILE_BASENAME_MAP[compilation_mode]
+  with job.timer.Time("bibtex:{}".format(basename)):
+    return_code, stdout = job.RunProcess(["bibtex", basename], working_dir)
+  if return_code != 0:
     raise BibtexCompilationError(stdout)
 
 
-def _ParseNodeIdAndErrorMessageMapping(
-    latex_content, latex_compilation_error_msg):
-  """Parse the latex compilation error message, to see which frames have errors.
+class _LruCache(object):
+  """Keeps the most recently used entries, up to a number of them.
+  """
+
+  def __init__(self, max_entries):
+    self._max_entries = max_entries
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()  # From the least recent.
+
+  def Get(self, key):
+    """The cached value, or None."""
+    with self._lock:
+      if key not in self._entries:
+        return None
+      value = self._entries.pop(key)
+      self._entries[key] = value
+      return value
+
+  def Put(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def GetNumEntries(self):
+    with self._lock:
+      return len(self._entries)
+
+
+_AUX_CITATION_RE = re.compile(r'\\citation\{([^}]*)\}')
+_AUX_BIBDATA_RE = re.compile(r'\\bibdata\{([^}]*)\}')
+_AUX_BIBSTYLE_RE = re.compile(r'\\bibstyle\{([^}]*)\}')
+
+
+def _GetFileDigest(path):
+  """The sha1 of the file content, or None when it does not exist."""
+  try:
+    with open(path, 'rb') as ifile:
+      return hashlib.sha1(ifile.read()).hexdigest()
+  except IOError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    return None
+
+
+class BibtexCache(_LruCache):
+  """Bibliographies produced by bibtex, i.e. the content of the .bbl files.
+
+  The .bbl only depends on what the .aux file cites, on the bib files and on
+  the bibliography style, so compilations sharing them need no bibtex run.
+  """
+
+  @staticmethod
+  def GetKey(working_dir, basename):
+    """What bibtex would read, after a first pdflatex pass.
+
+    Args:
+      working_dir: the working directory, with the .aux file of the pass.
+      basename: basename of the main TeX file, e.g. 'slides'.
+
+    Returns:
+      A key of the cache, or None when the document has no bibliography.
+    """
+    aux_path = os.path.join(working_dir, "{}.aux".format(basename))
+    try:
+      aux_content = open(aux_path).read()
+    except IOError as _:
+      return None
+    bib_names = [
+      name.strip() for names in _AUX_BIBDATA_RE.findall(aux_content)
+      for name in names.split(',')]
+    if not bib_names:
+      return None
+    cited_keys = sorted(set(
+      key.strip() for keys in _AUX_CITATION_RE.findall(aux_content)
+      for key in keys.split(',')))
+    bib_digests = []
+    for name in bib_names:
+      if not name.endswith('.bib'):
+        name += '.bib'
+      # Bib files outside of the directory are looked up by name only.
+      bib_digests.append(
+        (name, _GetFileDigest(os.path.join(working_dir, name))))
+    styles = _AUX_BIBSTYLE_RE.findall(aux_content)
+    style_digests = [
+      (style, _GetFileDigest(os.path.join(
+        working_dir, "{}.bst".format(style))))
+      for style in styles]
+    return hashlib.sha1(repr(
+      (cited_keys, bib_digests, style_digests))).hexdigest()
+
+
+_BIBTEX_CACHE_HITS = metrics_lib.GetCounter(
+  'bibtex_cache_hits', 'Bibliographies restored without running bibtex.')
+_BIBTEX_CACHE_MISSES = metrics_lib.GetCounter(
+  'bibtex_cache_misses', 'Bibliographies produced by running bibtex.')
+_LATEX_PASSES_SKIPPED = metrics_lib.GetCounter(
+  'latex_passes_skipped',
+  'Extra pdflatex passes skipped, as their inputs had not changed.')
+
+
+def _CompileOrRestoreBibliography(
+    working_dir, compilation_mode, job, bibtex_cache):
+  """Runs bibtex, unless the cache has the bibliography already.
 
   Args:
-    latex_content: the mindmap.tex file content, including frames'
-      node markers. We use it to extract mappings between line numbers and
-      frames
-    latex_compilation_error_msg: the latex compilation error message, containing
-      line numbers and error messages.
+    working_dir: the working directory, after a first pdflatex pass.
+    compilation_mode:
+      e.g. compilation_service_pb2.LatexCompilationRequest.BEAMER or REPORT
+    job: the CompilationJob.
+    bibtex_cache: a BibtexCache, or None for always running bibtex.
+  """
+  basename = _LATEX_MAIN_FILE_BASENAME_MAP[compilation_mode]
+  key = BibtexCache.GetKey(working_dir, basename)
+  if key is None:
+    return                      # No \bibdata, bibtex would fail anyway.
+
+  bbl_path = os.path.join(working_dir, "{}.bbl".format(basename))
+  if bibtex_cache is not None:
+    bbl_content = bibtex_cache.Get(key)
+    if bbl_content is not None:
+      _BIBTEX_CACHE_HITS.Increment()
+      with open(bbl_path, 'wb') as ofile:
+        ofile.write(bbl_content)
+      return
+    _BIBTEX_CACHE_MISSES.Increment()
+
+  try:
+    _CompileBibtexAtDir(working_dir, compilation_mode, job)
+  except BibtexCompilationError as _:
+    return
+  if bibtex_cache is not None and os.path.exists(bbl_path):
+    bibtex_cache.Put(key, open(bbl_path, 'rb').read())
+
+
+# Files written by a pdflatex pass and read by the next one.
+_LATEX_RERUN_FILE_EXTENSIONS = ["aux", "bbl", "toc", "nav", "snm", "out"]
+
+# Number of pdflatex passes after bibtex, when the files keep changing.
+_MAX_EXTRA_LATEX_PASSES = 2
+
+
+# Width of the text in the templates, in inches. The report's is the widest.
+_TEXT_WIDTH_INCHES = 6.5
+
+# pdflatex's px unit.
+_INCHES_PER_PX = 1 / 72.0
+
+# How convert_lib.OutputImage shows the images.
+_INCLUDEGRAPHICS_RE = re.compile(
+  r'\\includegraphics\[width=([\d.]+)(\\textwidth|px)\]\{([^}]*)\}')
+
+
+def GetImageDisplayWidths(latex_content):
+  """How wide the document shows its images.
+
+  Args:
+    latex_content: the mindmap converted into TeX.
 
   Returns:
-    A map of frame IDs and the compilation errors within it. For example:
-    { "node12345" : ["nested too deep"] }
+    A dictionary from the paths of the images to their largest width in the
+    document, in inches, e.g. {'figs/plot.png': 4.55}
+  """
+  widths = {}
+  for width, unit, path in _INCLUDEGRAPHICS_RE.findall(latex_content):
+    if unit == 'px':
+      inches = float(width) * _INCHES_PER_PX
+    else:
+      inches = float(width) * _TEXT_WIDTH_INCHES
+    widths[path] = max(widths.get(path, 0), inches)
+  return widths
+
+
+class ImageCache(_LruCache):
+  """Downscaled images, keyed by the original content and the target width.
+
+  The values are the content of the downscaled images, or an empty string for
+  the images better kept as they are.
+  """
+
+  @staticmethod
+  def GetKey(image_content, width_px):
+    return (hashlib.sha1(image_content).hexdigest(), width_px)
+
+
+def CreateImageCache():
+  """An ImageCache when --image_dpi enables downscaling, or None.
   """
-  result = collections.defaultdict(list)
+  if gflags.FLAGS.image_dpi <= 0:
+    return None
+  try:
+    import PIL  # pylint: disable=unused-variable
+  except ImportError as _:
+    logging.warning("Keeping the images as they are: PIL is not installed.")
+    return None
+  return ImageCache(gflags.FLAGS.image_cache_entries)
+
+
+_IMAGE_CACHE_HITS = metrics_lib.GetCounter(
+  'image_cache_hits', 'Images whose downscaled version was cached.')
+_IMAGE_CACHE_MISSES = metrics_lib.GetCounter(
+  'image_cache_misses', 'Images decoded to check whether to downscale them.')
+_IMAGES_DOWNSCALED = metrics_lib.GetCounter(
+  'images_downscaled', 'Images replaced by a smaller version before TeX.')
+
+
+def _DownscaleImage(image_content, width_px):
+  """Shrinks a PNG or JPEG image to the width, keeping its format.
+
+  Returns:
+    The content of the smaller image, or None when it would not be smaller.
+  """
+  from PIL import Image
+
+  image = Image.open(io.BytesIO(image_content))
+  if image.format not in ('PNG', 'JPEG') or image.size[0] <= width_px:
+    return None
+  height_px = max(
+    1, int(round(image.size[1] * float(width_px) / image.size[0])))
+  downscaled_image = image.resize((width_px, height_px), Image.ANTIALIAS)
+  output = io.BytesIO()
+  if image.format == 'JPEG':
+    downscaled_image.save(output, 'JPEG', quality=85, optimize=True)
+  else:
+    downscaled_image.save(output, 'PNG', optimize=True)
+  if output.tell() >= len(image_content):
+    return None
+  return output.getvalue()
+
+
+def _DownscaleImagesAtWorkDir(work_dir, latex_contents, image_cache):
+  """Replaces the images in the working directory by downscaled versions.
+
+  Args:
+    work_dir: the working directory, with the images.
+    latex_contents: the TeX of the targets, telling how wide they show the
+      images.
+    image_cache: the ImageCache.
+  """
+  widths = {}
+  for latex_content in latex_contents:
+    for path, inches in GetImageDisplayWidths(latex_content).items():
+      widths[path] = max(widths.get(path, 0), inches)
+
+  for path, inches in sorted(widths.items()):
+    try:
+      image_path = _GetPathInside(work_dir, path)
+    except ValueError as _:
+      continue
+    if not os.path.isfile(image_path):
+      continue
+    with open(image_path, 'rb') as image_file:
+      image_content = image_file.read()
+    width_px = int(math.ceil(inches * gflags.FLAGS.image_dpi))
+    key = ImageCache.GetKey(image_content, width_px)
+    downscaled_content = image_cache.Get(key)
+    if downscaled_content is not None:
+      _IMAGE_CACHE_HITS.Increment()
+    else:
+      _IMAGE_CACHE_MISSES.Increment()
+      try:
+        downscaled_content = _DownscaleImage(image_content, width_px) or ''
+      except (IOError, ValueError) as e:
+        logging.warning("Unable to downscale %s: %s", path, e)
+        downscaled_content = ''
+      image_cache.Put(key, downscaled_content)
+    if not downscaled_content:
+      continue
+    # It may be a link to the user's file, which must stay as it is.
+    os.remove(image_path)
+    with open(image_path, 'wb') as image_file:
+      image_file.write(downscaled_content)
+    _IMAGES_DOWNSCALED.Increment()
+
+
+def _GetLatexInputsDigest(working_dir, compilation_mode):
+  """A digest of the files pdflatex reads from its previous passes.
+
+  When a pass leaves it unchanged, another pass would produce the same pdf.
+  """
+  basename = _LATEX_MAIN_FILE_BASENAME_MAP[compilation_mode]
+  return [
+    _GetFileDigest(os.path.join(
+      working_dir, "{}.{}".format(basename, extension)))
+    for extension in _LATEX_RERUN_FILE_EXTENSIONS]
 
-  lineno_frameid_map = {}
 
-  frame_node_id = None
-  for line_no, line in enumerate(latex_content.split("\n")):
-    line_no = line_no + 1
-    if line.startswith("%%frame: "):
-      frame_node_id = re.match(r'%%frame: (.*)%%', line).group(1)
+class LatexErrorParser(object):
+  """Finds the frames with errors, reading the pdflatex log line by line.
 
-    if frame_node_id is not None:
-      lineno_frameid_map[line_no] = frame_node_id
+  Each error is mapped to its frame as soon as its line number shows up, so
+  that pdflatex can get stopped early. Errors outside of frames, e.g. in the
+  title or a section name, are mapped to their node.
+  """
+
+  def __init__(self, source_map, max_errors=0):
+    """
+    Args:
+      source_map: the convert_lib.SourceMap of mindmap.tex, telling which
+        frame each line belongs to.
+      max_errors: number of errors after which FeedLineAndCheckEnough returns
+        True. 0 for never.
+    """
+    self._source_map = source_map
+    self._max_errors = max_errors
+
+    self._error_message = None
+    self._node_id_error_messages_map = collections.defaultdict(list)
+    self._errors_outside_frames = collections.defaultdict(list)
+    self._has_errors_outside_nodes = False
+    self.num_errors = 0
 
-  lineno_and_errors = []
-  error_message = None
-  for line in latex_compilation_error_msg.split("\n"):
+  def FeedLine(self, line):
+    line = line.rstrip("\n")
     if line.startswith("! "):
-      error_message = line[2:]
+      self._error_message = line[2:]
     mo = re.match(r'l.(\d+)', line)
     if mo is not None:
-      lineno_and_errors.append((int(mo.group(1)), error_message))
+      self.num_errors += 1
+      lineno = int(mo.group(1))
+      frame_node_id = self._source_map.GetFrameNodeId(lineno)
+      node_id = self._source_map.GetNodeId(lineno)
+      if frame_node_id is not None:
+        self._node_id_error_messages_map[frame_node_id].append(
+          self._error_message)
+      elif node_id is not None:
+        self._errors_outside_frames[node_id].append(self._error_message)
+      else:
+        logging.info("Error outside of nodes, at line %d", lineno)
+        self._has_errors_outside_nodes = True
 
-  for lineno, error in lineno_and_errors:
-    frame_id = lineno_frameid_map[lineno]
-    result[frame_id].append(error)
+  def FeedLineAndCheckEnough(self, line):
+    """Feeds the line, and returns whether we have seen enough errors."""
+    self.FeedLine(line)
+    return 0 < self._max_errors <= self.num_errors
 
-  return result
+  def GetNodeIdAndErrorMessageMapping(self):
+    """Gets the frames with errors, so far.
+
+    Returns:
+      A map of frame IDs and the compilation errors within it. For example:
+      { "node12345" : ["nested too deep"] }
+
+    Raises:
+      KeyError: when some errors are outside of the nodes.
+    """
+    if self._has_errors_outside_nodes:
+      raise KeyError("Compilation errors outside of the nodes.")
+    return dict(self._node_id_error_messages_map)
+
+  def GetErrorsOutsideFrames(self):
+    """Gets the nodes outside of frames with errors, so far.
 
+    Returns:
+      A map of node IDs and the compilation errors within their own text,
+      e.g. the title or a section name.
+    """
+    return dict(self._errors_outside_frames)
+
+
+def _ConvertMindmap(mindmap_content, print_formats, profile_path_prefix=None,
+                    bib_path=None):
+  """Converts the mindmap into TeX, parsing it once for all the formats.
+
+  Args:
+    mindmap_content: content of mindmap.mm, as unicode.
+    print_formats: a list of 'latex', 'beamer_latex' or 'html'
+    profile_path_prefix: if given, where to write the profile of the
+      conversion, see profiling_lib.GetProfilePathPrefix.
+    bib_path: the bib file the citations in HTML come from. By default, the
+      bib_file flag's.
 
-def _LatexCompileOrTryEmbedErrorMessage(org, work_dir, compilation_mode):
+  Returns:
+    A pair of:
+      A dictionary from the print format to the convert_lib.ConvertedDocument
+      of mindmap.tex (or the html page).
+      The seconds spent in each phase, as a list of (phase, seconds).
+  """
+  phase_seconds = []
+  content_map = {}
+  with profiling_lib.Profile(profile_path_prefix), \
+      convert_lib.BibDatabase.Using(bib_path):
+    start_time = time.time()
+    org = convert_lib.Organization(mindmap_content)
+    phase_seconds.append(("parse", time.time() - start_time))
+    for print_format in print_formats:
+      start_time = time.time()
+      content_map[print_format] = org.GetOutputAndSourceMap(print_format)
+      phase_seconds.append(
+        ("emit:{}".format(print_format), time.time() - start_time))
+  return content_map, phase_seconds
+
+
+def _ConvertMindmapWithErrorsEmbedded(
+    mindmap_content, frame_and_error_message_map, node_errors,
+    profile_path_prefix=None):
+  """Converts the mindmap into beamer TeX, showing errors instead of frames.
+
+  Args:
+    mindmap_content: content of mindmap.mm, as unicode.
+    frame_and_error_message_map: the frames with errors, see
+      LatexErrorParser.GetNodeIdAndErrorMessageMapping.
+    node_errors: the other nodes with errors, see
+      LatexErrorParser.GetErrorsOutsideFrames.
+    profile_path_prefix: see _ConvertMindmap.
+
+  Returns:
+    The convert_lib.ConvertedDocument of mindmap.tex.
+  """
+  with profiling_lib.Profile(profile_path_prefix):
+    org = convert_lib.Organization(mindmap_content)
+    org.LabelErrorsOnFrames(frame_and_error_message_map, node_errors)
+    return org.GetOutputAndSourceMap('beamer_latex')
+
+
+def _InitConversionWorker():
+  """Warms up a conversion worker process, loading the bib database.
+  """
+  convert_lib.BibDatabase.GetTheDB()
+
+
+class MindmapConverter(object):
+  """Runs the mindmap conversions, in a pool of worker processes.
+
+  Converting is pure-Python CPU-bound work, which would hold the GIL and
+  serialize concurrent compilations. The worker processes only receive the
+  mindmap content, and send back the TeX.
+
+  The pool must get created before the gRPC server, as forking after
+  starting gRPC is unsafe. Under gevent, multiprocessing.Pool hangs, so the
+  workers are a gevent_lib.ProcessPool instead, created after
+  gevent_lib.SetUp.
+  """
+
+  def __init__(self, num_processes):
+    """
+    Args:
+      num_processes: number of worker processes. When 0, converts in the
+        calling thread, or greenlet, which blocks all the others meanwhile.
+    """
+    self._pool = None
+    if num_processes > 0 and gevent_lib.IsSetUp():
+      self._pool = gevent_lib.ProcessPool(
+        num_processes, initializer=_InitConversionWorker)
+    elif num_processes > 0:
+      self._pool = multiprocessing.Pool(
+        num_processes, initializer=_InitConversionWorker)
+
+  def Close(self):
+    """Stops the worker processes."""
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
+
+  def _Run(self, func, *args):
+    if self._pool is None:
+      return func(*args)
+    return self._pool.apply(func, args)
+
+  def Convert(self, mindmap_content, print_formats, timer=None,
+              profile_path_prefix=None, bib_path=None):
+    """See _ConvertMindmap.
+
+    Args:
+      timer: a PhaseTimer, to record the time spent parsing and emitting.
+
+    Returns:
+      The dictionary from the print formats to the converted documents.
+    """
+    content_map, phase_seconds = self._Run(
+      _ConvertMindmap, mindmap_content, print_formats, profile_path_prefix,
+      bib_path)
+    if timer is not None:
+      for phase, seconds in phase_seconds:
+        timer.Record(phase, seconds)
+    return content_map
+
+  def ConvertWithErrorsEmbedded(
+      self, mindmap_content, frame_and_error_message_map, node_errors,
+      profile_path_prefix=None):
+    """See _ConvertMindmapWithErrorsEmbedded."""
+    return self._Run(_ConvertMindmapWithErrorsEmbedded, mindmap_content,
+                     frame_and_error_message_map, node_errors,
+                     profile_path_prefix)
+
+
+_IN_THREAD_CONVERTER = MindmapConverter(0)
+
+
+def _WriteLatexContent(work_dir, latex_content):
+  with codecs.open(os.path.join(work_dir, _LATEX_CONTENT_TEX_FILE_NAME),
+                   'w', 'utf8') as ofile:
+    ofile.write(latex_content)
+
+
+def _LatexCompileOrTryEmbedErrorMessage(
+    converter, mindmap_content, document, work_dir, compilation_mode, job):
   """Try compiling. If fails, try embedding error messages into the frame.
 
   Args:
-    org: the in-memory slides organization
+    converter: a MindmapConverter.
+    mindmap_content: content of mindmap.mm, as unicode.
+    document: the convert_lib.ConvertedDocument of the mindmap in TeX.
     work_dir: Directory containing the running files: mindmap.mm,
       and the image files.
+    compilation_mode:
+      e.g. compilation_service_pb2.LatexCompilationRequest.BEAMER or REPORT
+    job: the CompilationJob.
 
   Returns:
     A compilation_service_pb2.LatexCompilationResponse object.
   """
-  output_tex_file_loc = os.path.join(work_dir, "mindmap.tex")
-  if compilation_mode == compilation_service_pb2.LatexCompilationRequest.BEAMER:
-    org.OutputToBeamerLatex(output_tex_file_loc)
-  elif (compilation_mode ==
-        compilation_service_pb2.LatexCompilationRequest.REPORT):
-    org.OutputToLatex(output_tex_file_loc)
-  else:
-    raise ValueError
+  _WriteLatexContent(work_dir, document.content)
 
-  # First attempt
-  result = _CompileLatexAtDir(work_dir, compilation_mode)
+  basename = _LATEX_MAIN_FILE_BASENAME_MAP[compilation_mode]
+  # First attempt, stopping at the first errors. The profile shows the log
+  # parsing, besides waiting for pdflatex.
+  error_parser = LatexErrorParser(
+    document.source_map, gflags.FLAGS.max_latex_errors)
+  with profiling_lib.Profile(profiling_lib.GetProfilePathPrefix(
+      job.profile_id, "log_parsing-{}".format(basename))):
+    result = _CompileLatexAtDir(work_dir, compilation_mode, job, error_parser)
 
   if result.status == compilation_service_pb2.LatexCompilationResponse.SUCCESS:
     return result
 
-  # Second attempt
-  try:
-    frame_and_error_message_map = _ParseNodeIdAndErrorMessageMapping(
-      result.source_code, result.compilation_log)
-  except KeyError as _:
-    logging.error(
-      "Error parsing node-id from error message: %s",
-      result.compilation_log)
-    result.status = compilation_service_pb2.LatexCompilationResponse.CANNOTFIX
-    return result
+  # Then embedding the errors into their frames (or nodes), until a pass
+  # succeeds. As pdflatex stops at the first errors, each pass may find errors
+  # in more frames.
+  frame_errors = {}
+  node_errors = {}
+  while True:
+    try:
+      new_frame_errors = error_parser.GetNodeIdAndErrorMessageMapping()
+    except KeyError as _:
+      logging.error(
+        "Error parsing node-id from error message: %s",
+        result.compilation_log)
+      result.status = (
+        compilation_service_pb2.LatexCompilationResponse.CANNOTFIX)
+      return result
+    new_node_errors = error_parser.GetErrorsOutsideFrames()
+    if (not set(new_frame_errors) - set(frame_errors) and
+        not set(new_node_errors) - set(node_errors)):
+      # Errors in frames showing errors already, or unknown errors.
+      result.status = (
+        compilation_service_pb2.LatexCompilationResponse.CANNOTFIX)
+      return result
+    frame_errors.update(new_frame_errors)
+    node_errors.update(new_node_errors)
 
-  org.LabelErrorsOnFrames(frame_and_error_message_map)
-  org.OutputToBeamerLatex(output_tex_file_loc)
+    with job.timer.Time("embed_errors:{}".format(basename)):
+      document = converter.ConvertWithErrorsEmbedded(
+        mindmap_content, frame_errors, node_errors,
+        profiling_lib.GetProfilePathPrefix(
+          job.profile_id, "embed_errors-{}".format(basename)))
+    _WriteLatexContent(work_dir, document.content)
 
-  second_attempt_result = _CompileLatexAtDir(work_dir, compilation_mode)
-  if (second_attempt_result.status ==
-      compilation_service_pb2.LatexCompilationResponse.SUCCESS):
-    result.status = compilation_service_pb2.LatexCompilationResponse.EMBEDDED
+    error_parser = LatexErrorParser(
+      document.source_map, gflags.FLAGS.max_latex_errors)
+    attempt_result = _CompileLatexAtDir(
+      work_dir, compilation_mode, job, error_parser)
+    if (attempt_result.status ==
+        compilation_service_pb2.LatexCompilationResponse.SUCCESS):
+      result.status = (
+        compilation_service_pb2.LatexCompilationResponse.EMBEDDED)
+      result.pdf_content = attempt_result.pdf_content
+      return result
 
-  else:
-    result.status = compilation_service_pb2.LatexCompilationResponse.CANNOTFIX
-  return result
 
+def _WriteFileAtomically(filepath, content):
+  """Writes the file, so that readers never see it half-written.
+  """
+  temp_filepath = "{}.tmp".format(filepath)
+  with open(temp_filepath, 'w') as ofile:
+    ofile.write(content)
+  os.rename(temp_filepath, filepath)
+
+
+class ProjectSnapshotError(Exception):
+  pass
+
+
+def _GetPathInside(directory, relative_path):
+  """Joins the paths, making sure the result stays inside the directory.
+
+  Raises:
+    ValueError: when the relative path leaves the directory, e.g. ../a.png
+  """
+  normalized_path = os.path.normpath(relative_path)
+  if os.path.isabs(normalized_path) or normalized_path.startswith(os.pardir):
+    raise ValueError("Path outside the directory: {}".format(relative_path))
+  return os.path.join(directory, normalized_path)
+
+
+def _IsAllowedProjectRoot(project_root):
+  real_project_root = os.path.realpath(project_root)
+  for allowed_root in gflags.FLAGS.allowed_project_roots.split(','):
+    if not allowed_root:
+      continue
+    real_allowed_root = os.path.join(os.path.realpath(allowed_root), '')
+    if real_project_root.startswith(real_allowed_root):
+      return True
+  return False
+
+
+def _GetMTimeManifest(directory, filepaths):
+  """Sizes and modification times of the files, to detect modifications.
+
+  Raises:
+    ProjectSnapshotError: when a file is missing or unreadable.
+  """
+  manifest = []
+  for filepath in filepaths:
+    try:
+      file_stat = os.stat(os.path.join(directory, filepath))
+    except OSError as e:
+      raise ProjectSnapshotError(
+        "Unable to read {} in {}: {}".format(filepath, directory, e.strerror))
+    manifest.append((filepath, file_stat.st_size, file_stat.st_mtime))
+  return manifest
+
+
+def _GetRealPathInside(directory, relative_path):
+  """Like _GetPathInside, resolving the symbolic links on the way.
+
+  Returns:
+    The path, without symbolic links.
+
+  Raises:
+    ValueError: when the path, or a symbolic link on the way, leaves the
+      directory.
+  """
+  real_path = os.path.realpath(_GetPathInside(directory, relative_path))
+  if not real_path.startswith(
+      os.path.join(os.path.realpath(directory), '')):
+    raise ValueError("Path outside the directory: {}".format(relative_path))
+  return real_path
+
+
+def _SnapshotProjectFiles(project_root, filepaths, work_dir):
+  """Links the project's files into the working directory.
+
+  Hard links are used when possible, falling back to copies across
+  filesystems. Editors normally replace files when saving, so the links keep
+  the content at the time of the snapshot. When files change while linking,
+  we take the snapshot again.
+
+  Args:
+    project_root: the directory of the project on the server.
+    filepaths: paths of the files relative to the project root,
+      e.g. ['mindmap.mm', 'figs/plot.png']
+    work_dir: the working directory to put the files in.
+
+  Raises:
+    ProjectSnapshotError: when the files keep changing, or cannot be read.
+    ValueError: when a path, or a symbolic link, leaves the project root.
+  """
+  # Links to the files the symbolic links point to, once checked.
+  source_locs = [_GetRealPathInside(project_root, filepath)
+                 for filepath in filepaths]
+  for _ in range(gflags.FLAGS.max_snapshot_attempts):
+    manifest_before = _GetMTimeManifest(project_root, filepaths)
+    for filepath, source_loc in zip(filepaths, source_locs):
+      target_loc = _GetPathInside(work_dir, filepath)
+      MkdirP(os.path.dirname(target_loc))
+      if os.path.exists(target_loc):
+        os.remove(target_loc)
+      try:
+        os.link(source_loc, target_loc)
+      except OSError as _:
+        shutil.copy2(source_loc, target_loc)
+    if _GetMTimeManifest(project_root, filepaths) == manifest_before:
+      return
+    logging.info("Files changed while taking the snapshot of %s. Retrying.",
+                 project_root)
+  raise ProjectSnapshotError(
+    "Files in {} keep changing.".format(project_root))
+
+
+def _PrepareFilesFromRequest(request, work_dir):
+  """Puts the files of the compilation request into the working directory.
+  """
+  if request.project_root:
+    _SnapshotProjectFiles(
+      request.project_root,
+      [file_info.filepath for file_info in request.file_infos],
+      work_dir)
+    return
+
+  for file_info in request.file_infos:
+    target_loc = _GetPathInside(work_dir, file_info.filepath)
+    MkdirP(os.path.dirname(target_loc))
+    if file_info.local_path:
+      os.symlink(file_info.local_path, target_loc)
+      continue
+    with open(target_loc, 'w') as ofile:
+      ofile.write(file_info.content)
 
-def _PrepareCompilationBaseDirectory(directory):
+
+def PrepareCompilationBaseDirectory(directory):
   """Copies the template (slides.tex) into the empty directory.
   """
   static_file_dir = os.path.join(
@@ -219,9 +1195,414 @@ def _PrepareCompilationBaseDirectory(directory):
         directory, filename))
 
 
+def _CompileTarget(
+    work_dir, compilation_mode, converter, mindmap_content, converted, job):
+  """Compiles the TeX of one target into a pdf.
+
+  After bibtex, runs pdflatex again until the files it reads from the
+  previous pass stop changing, at most _MAX_EXTRA_LATEX_PASSES times.
+
+  Args:
+    converted: the convert_lib.ConvertedDocument of the target.
+    job: the CompilationJob, whose bibtex_cache, when set, saves bibtex runs.
+  """
+  inputs_digest = _GetLatexInputsDigest(work_dir, compilation_mode)
+  initial_compilation_result = _LatexCompileOrTryEmbedErrorMessage(
+    converter, mindmap_content, converted, work_dir, compilation_mode, job)
+  if (initial_compilation_result.status ==
+      compilation_service_pb2.LatexCompilationResponse.CANNOTFIX):
+    return initial_compilation_result
+
+  _CompileOrRestoreBibliography(
+    work_dir, compilation_mode, job, job.bibtex_cache)
+  result = initial_compilation_result
+  for num_passes in range(_MAX_EXTRA_LATEX_PASSES):
+    new_inputs_digest = _GetLatexInputsDigest(work_dir, compilation_mode)
+    if new_inputs_digest == inputs_digest:
+      _LATEX_PASSES_SKIPPED.Increment(_MAX_EXTRA_LATEX_PASSES - num_passes)
+      break
+    inputs_digest = new_inputs_digest
+    result.pdf_content = _CompileLatexAtDir(
+      work_dir, compilation_mode, job).pdf_content
+  return result
+
+
+def _CompileTargetOrReportTimeout(
+    work_dir, compilation_mode, converter, mindmap_content, converted, job):
+  """Like _CompileTarget, turning exceeded limits into a TIMEOUT result.
+  """
+  try:
+    return _CompileTarget(
+      work_dir, compilation_mode, converter, mindmap_content, converted, job)
+  except ResourceLimitExceededError as e:
+    logging.info("Compilation stopped: %s", e)
+    result = compilation_service_pb2.LatexCompilationResponse()
+    result.status = compilation_service_pb2.LatexCompilationResponse.TIMEOUT
+    result.compilation_log = "{}\n\nfreemindlatex: {}.\n".format(
+      e.output, e)
+    latex_content_path = os.path.join(work_dir, _LATEX_CONTENT_TEX_FILE_NAME)
+    if os.path.exists(latex_content_path):
+      result.source_code = open(latex_content_path).read()
+    return result
+
+
+def _RenderHtmlTarget(html_content):
+  """The result of an HTML target, which needs no TeX at all.
+
+  The page refers to the images by their paths relative to the mindmap, so
+  it shows them when placed next to it.
+  """
+  result = compilation_service_pb2.LatexCompilationResponse()
+  result.status = compilation_service_pb2.LatexCompilationResponse.SUCCESS
+  result.html_content = html_content.encode('utf8')
+  return result
+
+
+def _LinkWorkDir(work_dir, target_dir):
+  """Makes a directory linking to all the files of the working directory.
+  """
+  MkdirP(target_dir)
+  for filename in os.listdir(work_dir):
+    if filename != _TARGETS_DIR_NAME:
+      os.symlink(os.path.join(work_dir, filename),
+                 os.path.join(target_dir, filename))
+
+
+def CompileTargetsAtWorkDir(
+    work_dir, compilation_modes, converter=None, job=None, bibtex_cache=None,
+    image_cache=None):
+  """Compiles the mindmap in a prepared working directory, into several pdfs.
+
+  The mindmap gets parsed once, and the targets compile concurrently, each in
+  its own directory.
+
+  Args:
+    work_dir: Directory containing the template files (see
+      PrepareCompilationBaseDirectory), mindmap.mm and the image files.
+    compilation_modes: a list of modes, e.g.
+      [compilation_service_pb2.LatexCompilationRequest.BEAMER,
+       compilation_service_pb2.LatexCompilationRequest.REPORT]
+    converter: the MindmapConverter to use. By default, converts in the
+      calling thread.
+    job: the CompilationJob, to be able to cancel the compilation.
+    bibtex_cache: a BibtexCache, to skip bibtex when the bibliography has
+      not changed. By default, always runs bibtex.
+    image_cache: an ImageCache, to downscale the images before running TeX
+      (see CreateImageCache). By default, keeps them as they are.
+
+  Returns:
+    A list of compilation_service_pb2.LatexCompilationResponse objects, one
+    per mode. Their status is TIMEOUT when a TeX process exceeded its time or
+    resource limits. HTML targets carry the page in html_content.
+
+  Raises:
+    ValueError: for unknown modes.
+    CompilationCancelledError: when the job gets cancelled.
+  """
+  if any(mode not in _PRINT_FORMAT_MAP for mode in compilation_modes):
+    raise ValueError
+  converter = converter or _IN_THREAD_CONVERTER
+  job = job or CompilationJob()
+  job.bibtex_cache = bibtex_cache
+  mindmap_content = codecs.open(
+    os.path.join(
+      work_dir,
+      "mindmap.mm"),
+    'r',
+    'utf8').read()
+  # The cited entries, when sent along with the mindmap.
+  bib_path = os.path.join(work_dir, bib_lib.BIB_SUBSET_FILENAME)
+  content_map = converter.Convert(
+    mindmap_content,
+    [_PRINT_FORMAT_MAP[mode] for mode in compilation_modes],
+    job.timer,
+    profiling_lib.GetProfilePathPrefix(job.profile_id, "convert"),
+    bib_path if os.path.exists(bib_path) else None)
+
+  results = [None] * len(compilation_modes)
+  tex_targets = []
+  for index, mode in enumerate(compilation_modes):
+    if mode == compilation_service_pb2.LatexCompilationRequest.HTML:
+      results[index] = _RenderHtmlTarget(content_map['html'].content)
+    else:
+      tex_targets.append((index, mode))
+
+  if image_cache is not None and tex_targets:
+    with job.timer.Time("downscale_images"):
+      _DownscaleImagesAtWorkDir(
+        work_dir,
+        [content_map[_PRINT_FORMAT_MAP[mode]].content
+         for _, mode in tex_targets],
+        image_cache)
+
+  if len(tex_targets) == 1:
+    index, mode = tex_targets[0]
+    results[index] = _CompileTargetOrReportTimeout(
+      work_dir, mode, converter, mindmap_content,
+      content_map[_PRINT_FORMAT_MAP[mode]], job)
+
+  elif tex_targets:
+    executor = futures.ThreadPoolExecutor(max_workers=len(tex_targets))
+    try:
+      target_futures = []
+      for index, mode in tex_targets:
+        target_dir = os.path.join(
+          work_dir, _TARGETS_DIR_NAME, _LATEX_MAIN_FILE_BASENAME_MAP[mode])
+        _LinkWorkDir(work_dir, target_dir)
+        target_futures.append((index, executor.submit(
+          _CompileTargetOrReportTimeout, target_dir, mode, converter,
+          mindmap_content, content_map[_PRINT_FORMAT_MAP[mode]], job)))
+      for index, target_future in target_futures:
+        results[index] = target_future.result()
+    finally:
+      executor.shutdown(wait=False)
+
+  return results
+
+
+def CompileAtWorkDir(work_dir, compilation_mode, converter=None, job=None,
+                     bibtex_cache=None, image_cache=None):
+  """Compiles the mindmap in a prepared working directory.
+
+  Args:
+    work_dir: Directory containing the template files (see
+      PrepareCompilationBaseDirectory), mindmap.mm and the image files.
+    compilation_mode:
+      e.g. compilation_service_pb2.LatexCompilationRequest.BEAMER or REPORT
+    converter: the MindmapConverter to use. By default, converts in the
+      calling thread.
+    job: the CompilationJob, to be able to cancel the compilation.
+    bibtex_cache: see CompileTargetsAtWorkDir.
+    image_cache: see CompileTargetsAtWorkDir.
+
+  Returns:
+    A compilation_service_pb2.LatexCompilationResponse object. Its status is
+    TIMEOUT when a TeX process exceeded its time or resource limits.
+
+  Raises:
+    CompilationCancelledError: when the job gets cancelled.
+  """
+  return CompileTargetsAtWorkDir(
+    work_dir, [compilation_mode], converter, job, bibtex_cache,
+    image_cache)[0]
+
+
+def GetTargetOutputPath(pdf_output_path, compilation_mode):
+  """Where to write the pdf of an additional target.
+
+  Args:
+    pdf_output_path: where the pdf of the first target goes,
+      e.g. /home/user/talk/talk.pdf
+    compilation_mode:
+      e.g. compilation_service_pb2.LatexCompilationRequest.REPORT
+
+  Returns:
+    e.g. /home/user/talk/talk.report.pdf
+  """
+  return "{}.{}.pdf".format(
+    os.path.splitext(pdf_output_path)[0],
+    compilation_service_pb2.LatexCompilationRequest.Mode.Name(
+      compilation_mode).lower())
+
+
+def CompileRequestedTargetsAtWorkDir(
+    work_dir, request, converter=None, job=None, bibtex_cache=None,
+    image_cache=None):
+  """Compiles the targets of the request.
+
+  Args:
+    work_dir: see CompileTargetsAtWorkDir.
+    request: a compilation_service_pb2.LatexCompilationRequest. When it has
+      target_modes, compiles them instead of its compilation_mode.
+    converter: see CompileTargetsAtWorkDir.
+    job: see CompileTargetsAtWorkDir.
+    bibtex_cache: see CompileTargetsAtWorkDir.
+    image_cache: see CompileTargetsAtWorkDir.
+
+  Returns:
+    A compilation_service_pb2.LatexCompilationResponse object. With
+    target_modes, it carries one target result per mode, and the status of
+    the first one. Its phase_timings tell where the time went.
+  """
+  job = job or CompilationJob()
+  if not request.target_modes:
+    result = CompileAtWorkDir(
+      work_dir, request.compilation_mode, converter, job, bibtex_cache,
+      image_cache)
+    _AddPhaseTimings(result, job.timer.GetTimings())
+    return result
+
+  target_responses = CompileTargetsAtWorkDir(
+    work_dir, list(request.target_modes), converter, job, bibtex_cache,
+    image_cache)
+  result = compilation_service_pb2.LatexCompilationResponse()
+  result.status = target_responses[0].status
+  for mode, target_response in zip(request.target_modes, target_responses):
+    target_result = result.target_results.add()
+    target_result.mode = mode
+    target_result.status = target_response.status
+    target_result.source_code = target_response.source_code
+    target_result.compilation_log = target_response.compilation_log
+    target_result.pdf_content = target_response.pdf_content
+    target_result.html_content = target_response.html_content
+  _AddPhaseTimings(result, job.timer.GetTimings())
+  return result
+
+
+class CompilationLoad(object):
+  """Limits the number of concurrent compilations, and keeps count of them.
+  """
+
+  def __init__(self, max_concurrent_compilations):
+    self._slots = threading.BoundedSemaphore(max_concurrent_compilations)
+    self._lock = threading.Lock()
+    self.queue_depth = 0
+    self.running_compilations = 0
+
+  @contextlib.contextmanager
+  def CompilationSlot(self):
+    """Waits for a free slot, and holds it during the with statement.
+    """
+    with self._lock:
+      self.queue_depth += 1
+    self._slots.acquire()
+    with self._lock:
+      self.queue_depth -= 1
+      self.running_compilations += 1
+    try:
+      yield
+    finally:
+      with self._lock:
+        self.running_compilations -= 1
+      self._slots.release()
+
+
+class RenderCache(_LruCache):
+  """Documents produced by the Render RPC, keyed by the mindmap and format.
+
+  The values are compilation_service_pb2.RenderResponse objects.
+  """
+
+  @staticmethod
+  def GetKey(mindmap_content, compilation_mode):
+    return (hashlib.sha1(mindmap_content).hexdigest(), compilation_mode)
+
+
+_RENDER_CACHE_HITS = metrics_lib.GetCounter(
+  'render_cache_hits', 'Render requests answered from the cache.')
+_RENDER_CACHE_MISSES = metrics_lib.GetCounter(
+  'render_cache_misses', 'Render requests converting the mindmap.')
+_RENDER_SECONDS = metrics_lib.GetHistogram(
+  'render_seconds', 'Time to answer a Render request.', ['mode'])
+_COMPILATION_SECONDS = metrics_lib.GetHistogram(
+  'compilation_seconds',
+  'Time to compile a package, including the wait for a slot.', ['mode'])
+_COMPILATION_PHASE_SECONDS = metrics_lib.GetHistogram(
+  'compilation_phase_seconds',
+  'Time spent in each phase of the compilations, see PhaseTimer.',
+  ['phase'])
+_COMPILATION_STATUS_COUNTERS = dict(
+  (status, metrics_lib.GetCounter(
+    'compilations_{}'.format(status.lower()),
+    'Compilation targets finishing with the {} status.'.format(status)))
+  for status in
+  compilation_service_pb2.LatexCompilationResponse.Status.keys())
+_COMPILATIONS_ABORTED = metrics_lib.GetCounter(
+  'compilations_aborted',
+  'Compilations cancelled by the client, or rejected.')
+
+
+def _GetModesName(modes):
+  """e.g. 'BEAMER', or 'BEAMER,REPORT' for several targets."""
+  return ','.join(
+    compilation_service_pb2.LatexCompilationRequest.Mode.Name(mode)
+    for mode in modes)
+
+
+def _GetDirectorySize(directory):
+  """Total size of the files in the directory, not following links."""
+  total_bytes = 0
+  for dirpath, _, filenames in os.walk(directory):
+    for filename in filenames:
+      try:
+        total_bytes += os.lstat(os.path.join(dirpath, filename)).st_size
+      except OSError as _:
+        pass                    # Removed in the meantime.
+  return total_bytes
+
+
 class CompilationServer(compilation_service_pb2_grpc.LatexCompilationServicer):
 
-  def CompilePackage(self, request, context):  # pylint: disable=no-self-use
+  def __init__(self, load, converter, render_cache, bibtex_cache,
+               image_cache=None):
+    self._load = load
+    self._converter = converter
+    self._render_cache = render_cache
+    self._bibtex_cache = bibtex_cache
+    self._image_cache = image_cache
+    self._compile_dirs_lock = threading.Lock()
+    self._compile_dirs = set()
+
+  def GetWorkDirBytes(self):
+    """Disk space taken by the working directories of the compilations."""
+    with self._compile_dirs_lock:
+      compile_dirs = list(self._compile_dirs)
+    return sum(_GetDirectorySize(compile_dir) for compile_dir in compile_dirs)
+
+  def Render(self, request, context):
+    """Converts the mindmap into TeX or HTML, without compiling it.
+
+    Args:
+      A compilation_service_pb2.RenderRequest object.
+
+    Returns:
+      A compilation_service_pb2.RenderResponse object.
+    """
+    start_time = time.time()
+    response = self._Render(request, context)
+    _RENDER_SECONDS.Observe(
+      time.time() - start_time, _GetModesName([request.compilation_mode]))
+    return response
+
+  def _Render(self, request, context):
+    if request.compilation_mode not in _PRINT_FORMAT_MAP:
+      context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                    "Unknown mode: {}".format(request.compilation_mode))
+    key = RenderCache.GetKey(
+      request.mindmap_content, request.compilation_mode)
+    response = self._render_cache.Get(key)
+    if response is not None:
+      _RENDER_CACHE_HITS.Increment()
+      return response
+
+    _RENDER_CACHE_MISSES.Increment()
+    print_format = _PRINT_FORMAT_MAP[request.compilation_mode]
+    try:
+      source, source_map = self._converter.Convert(
+        request.mindmap_content.decode('utf8'), [print_format],
+        profile_path_prefix=profiling_lib.GetProfilePathPrefix(
+          profiling_lib.GetRequestProfileId(context), "render"))[print_format]
+    except Exception as e:  # pylint: disable=broad-except
+      # Whatever the converter raises on a broken mindmap.
+      context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                    "Cannot convert the mindmap: {!r}".format(e))
+
+    response = compilation_service_pb2.RenderResponse()
+    response.source = source
+    for line_no, node_id in source_map.GetFrames():
+      frame = response.frames.add()
+      frame.node_id = node_id
+      frame.line = line_no
+    for node_id, (first_line, last_line) in sorted(
+        source_map.GetNodeLines().items(), key=lambda item: item[1]):
+      node_lines = response.nodes.add()
+      node_lines.node_id = node_id
+      node_lines.first_line = first_line
+      node_lines.last_line = last_line
+    self._render_cache.Put(key, response)
+    return response
+
+  def CompilePackage(self, request, context):
     """Compile the mindmap along with the files attached in the request.
 
     We will create a working directory, prepare its content, and compile.
@@ -235,74 +1616,229 @@ class CompilationServer(compilation_service_pb2_grpc.LatexCompilationServicer):
       A compilation_service_pb2.LatexCompilationRequest object, containing
       all the involved file content.
     """
+    start_time = time.time()
+    try:
+      result = self._CompilePackage(request, context)
+    except Exception:
+      _COMPILATIONS_ABORTED.Increment()
+      raise
+
+    _COMPILATION_SECONDS.Observe(
+      time.time() - start_time,
+      _GetModesName(request.target_modes or [request.compilation_mode]))
+    for phase_timing in result.phase_timings:
+      _COMPILATION_PHASE_SECONDS.Observe(
+        phase_timing.microseconds / 1e6, phase_timing.phase)
+    for target_result in result.target_results or [result]:
+      _COMPILATION_STATUS_COUNTERS[
+        compilation_service_pb2.LatexCompilationResponse.Status.Name(
+          target_result.status)].Increment()
+    return result
+
+  def _CompilePackage(self, request, context):
+    uses_local_paths = request.pdf_output_path or any(
+      file_info.local_path for file_info in request.file_infos)
+    if uses_local_paths and not gflags.FLAGS.allow_local_paths:
+      context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                    "This server does not accept local paths.")
+    if request.project_root and not _IsAllowedProjectRoot(
+        request.project_root):
+      context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                    "Project root not allowed: {}".format(
+                      request.project_root))
+
+    # Called when the RPC terminates, including when the client cancels it
+    # or disconnects. By then, a finished job has no process to kill.
+    job = CompilationJob()
+    job.profile_id = profiling_lib.GetRequestProfileId(context)
+    context.add_callback(job.Cancel)
+    queue_start_time = time.time()
+    with self._load.CompilationSlot():
+      job.timer.Record("queue_wait", time.time() - queue_start_time)
+      try:
+        return self._CompileRequest(request, context, job)
+      except CompilationCancelledError as _:
+        logging.info("Compilation cancelled by the client.")
+        context.abort(grpc.StatusCode.CANCELLED, "Compilation cancelled.")
+
+  def _CompileRequest(self, request, context, job):
+    """Compiles in a temporary working directory.
+    """
+    if not context.is_active():
+      raise CompilationCancelledError
+
     compile_dir = tempfile.mkdtemp()
     work_dir = os.path.join(compile_dir, "working")
     logging.info("Compiling at %s", work_dir)
-    _MkdirP(work_dir)
-
-    # Preparing the temporary directory content
-    _PrepareCompilationBaseDirectory(work_dir)
-    for file_info in request.file_infos:
-      target_loc = os.path.join(work_dir, file_info.filepath)
-      dirname = os.path.dirname(target_loc)
-      _MkdirP(dirname)
-      with open(target_loc, 'w') as ofile:
-        ofile.write(file_info.content)
-
-    # Compile
-    org = convert_lib.Organization(
-      codecs.open(
-        os.path.join(
-          work_dir,
-          "mindmap.mm"),
-        'r',
-        'utf8').read())
-
-    initial_compilation_result = _LatexCompileOrTryEmbedErrorMessage(
-      org, work_dir, request.compilation_mode)
-    if (initial_compilation_result.status ==
-        compilation_service_pb2.LatexCompilationResponse.CANNOTFIX):
-      return initial_compilation_result
+    MkdirP(work_dir)
+    with self._compile_dirs_lock:
+      self._compile_dirs.add(compile_dir)
 
     try:
-      _CompileBibtexAtDir(work_dir, request.compilation_mode)
-    except BibtexCompilationError as _:
-      pass
-    _CompileLatexAtDir(work_dir, request.compilation_mode)
-    final_compilation_result = _CompileLatexAtDir(
-      work_dir, request.compilation_mode)
-
-    result = initial_compilation_result
-    result.pdf_content = final_compilation_result.pdf_content
+      # Preparing the temporary directory content
+      with job.timer.Time("write_files"):
+        PrepareCompilationBaseDirectory(work_dir)
+        try:
+          _PrepareFilesFromRequest(request, work_dir)
+        except (ValueError, ProjectSnapshotError) as e:
+          context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
 
-    # Clean-up
-    shutil.rmtree(compile_dir)
+      result = CompileRequestedTargetsAtWorkDir(
+        work_dir, request, self._converter, job, self._bibtex_cache,
+        self._image_cache)
+      pdf_output_path = request.pdf_output_path
+      if request.project_root:
+        pdf_output_path = os.path.join(
+          request.project_root,
+          "{}.pdf".format(os.path.basename(
+            os.path.normpath(request.project_root))))
+      if pdf_output_path:
+        write_timer = PhaseTimer()
+        with write_timer.Time("write_pdf"):
+          for index, target_result in enumerate(
+              [result] + list(result.target_results)):
+            if not target_result.pdf_content:
+              continue
+            # Without target_modes, the response itself carries the pdf.
+            # Otherwise, the first target goes to pdf_output_path.
+            target_pdf_path = pdf_output_path
+            if index > 1:
+              target_pdf_path = GetTargetOutputPath(
+                pdf_output_path, target_result.mode)
+            _WriteFileAtomically(target_pdf_path, target_result.pdf_content)
+            target_result.pdf_path = target_pdf_path
+            target_result.ClearField('pdf_content')
+        _AddPhaseTimings(result, write_timer.GetTimings())
+      return result
 
-    return result
+    finally:
+      # Clean-up
+      with self._compile_dirs_lock:
+        self._compile_dirs.discard(compile_dir)
+      shutil.rmtree(compile_dir)
 
 
 class HealthzServer(compilation_service_pb2_grpc.HealthServicer):
 
-  def Check(self, request, context):  # pylint: disable=no-self-use
+  def __init__(self, load):
+    self._load = load
+
+  def Check(self, request, context):
     response = compilation_service_pb2.HealthCheckResponse()
     response.status = compilation_service_pb2.HealthCheckResponse.SERVING
+    response.queue_depth = self._load.queue_depth
+    response.running_compilations = self._load.running_compilations
+    for name, value in metrics_lib.GetCounterValues().items():
+      response.counters[name] = value
     return response
 
 
-def RunServerAtPort(port):
-  """Run the latex compilation server at port, and wait till termination.
+def _SetUpServerGauges(load, compilation_server, render_cache, bibtex_cache,
+                       image_cache):
+  """Reports the state of the server through gauges, read when scraped."""
+  metrics_lib.GetGauge(
+    'queue_depth', 'Compilations waiting for a slot.').SetFunction(
+      lambda: load.queue_depth)
+  metrics_lib.GetGauge(
+    'running_compilations', 'Compilations holding a slot.').SetFunction(
+      lambda: load.running_compilations)
+  metrics_lib.GetGauge(
+    'work_dir_bytes',
+    'Disk space of the working directories of the compilations.').SetFunction(
+      compilation_server.GetWorkDirBytes)
+  for name, cache in [('render', render_cache), ('bibtex', bibtex_cache),
+                      ('image', image_cache)]:
+    if cache is not None:
+      metrics_lib.GetGauge(
+        '{}_cache_entries'.format(name),
+        'Entries in the {} cache.'.format(name)).SetFunction(
+          cache.GetNumEntries)
+
+
+class ServerBindError(Exception):
+  pass
+
+
+def RunServer(listen_address, ready_fd=None):
+  """Run the latex compilation server, and wait till termination.
+
+  Args:
+    listen_address: where to listen to, e.g. '[::]:8117', or
+      'unix:/tmp/freemindlatex.sock' for a unix domain socket. With port 0,
+      will pick an unused port.
+    ready_fd: when set, a file descriptor to write the server's address into,
+      once the server is listening. It gets closed afterwards.
+
+  Raises:
+    ServerBindError: when unable to listen to the address, e.g. the port is
+      taken.
+    ValueError: with the gevent server implementation, when listening to a
+      unix domain socket, which gRPC does not support under gevent, when
+      converting without worker processes, which would block the greenlets
+      of all the other requests, or when gevent_lib has not been set up at
+      the start of the process.
   """
-  logging.info("Running the LaTeX compilation server at port %d", port)
+  max_concurrent_rpcs = 10
+  if gflags.FLAGS.server_implementation == 'gevent':
+    if listen_address.startswith('unix:'):
+      raise ValueError(
+        "The gevent server implementation cannot listen to the unix domain "
+        "socket {}, use a port instead".format(listen_address))
+    if gflags.FLAGS.conversion_processes <= 0:
+      raise ValueError(
+        "The gevent server implementation needs --conversion_processes, as "
+        "converting in the request's greenlet blocks all the others")
+    if not gevent_lib.IsSetUp():
+      raise ValueError(
+        "The gevent server implementation needs gevent_lib.SetUp() at the "
+        "start of the process, before grpc and threading get imported")
+    max_concurrent_rpcs = gflags.FLAGS.gevent_max_concurrent_rpcs
 
-  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+  converter = MindmapConverter(gflags.FLAGS.conversion_processes)
+  load = CompilationLoad(gflags.FLAGS.max_concurrent_compilations)
+  render_cache = RenderCache(gflags.FLAGS.render_cache_entries)
+  bibtex_cache = BibtexCache(gflags.FLAGS.bibtex_cache_entries)
+  image_cache = CreateImageCache()
+  compilation_server = CompilationServer(
+    load, converter, render_cache, bibtex_cache, image_cache)
+  server = grpc.server(
+    futures.ThreadPoolExecutor(max_workers=max_concurrent_rpcs))
   compilation_service_pb2_grpc.add_LatexCompilationServicer_to_server(
-    CompilationServer(), server)
+    compilation_server, server)
   compilation_service_pb2_grpc.add_HealthServicer_to_server(
-    HealthzServer(), server)
-  server.add_insecure_port('[::]:%d' % port)
+    HealthzServer(load), server)
+  port = server.add_insecure_port(listen_address)
+  if port == 0:
+    raise ServerBindError("Unable to listen to {}".format(listen_address))
   server.start()
+
+  if listen_address.startswith('unix:'):
+    server_address = listen_address
+  else:
+    server_address = '127.0.0.1:{}'.format(port)
+  logging.info("Running the LaTeX compilation server at %s", server_address)
+  if gflags.FLAGS.metrics_port is not None:
+    _SetUpServerGauges(load, compilation_server, render_cache, bibtex_cache,
+                       image_cache)
+    metrics_port = metrics_lib.StartMetricsServer(gflags.FLAGS.metrics_port)
+    logging.info("Serving the metrics at http://127.0.0.1:%d/metrics",
+                 metrics_port)
+  if ready_fd is not None:
+    os.write(ready_fd, "%s\n" % server_address)
+    os.close(ready_fd)
   try:
     while True:
       time.sleep(60 * 60 * 24)
   except KeyboardInterrupt:
     server.stop(0)
+    converter.Close()
+
+
+def RunServerAtPort(port, ready_fd=None):
+  """Run the latex compilation server at port, and wait till termination.
+
+  Args:
+    port: the port to listen to. When 0, will pick an unused port.
+    ready_fd: see RunServer.
+  """
+  RunServer('[::]:%d' % port, ready_fd=ready_fd)
@@ -0,0 +1,895 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import gflags
+import grpc
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+from freemindlatex import (compilation_server_lib, compilation_service_pb2,
+                           compilation_service_pb2_grpc, convert_lib,
+                           fake_tex_test_lib, flags_test_lib)
+
+
+class TestCompilationJob(unittest.TestCase):
+
+  def testRunningProcess(self):
+    job = compilation_server_lib.CompilationJob()
+    return_code, stdout = job.RunProcess(
+      ["sh", "-c", "echo hello; exit 3"], tempfile.gettempdir())
+    self.assertEquals(3, return_code)
+    self.assertEquals("hello\n", stdout)
+
+  def testCancellingKillsRunningProcesses(self):
+    job = compilation_server_lib.CompilationJob()
+    timer = threading.Timer(0.2, job.Cancel)
+    timer.start()
+    start_time = time.time()
+    # The child of the shell is in the same process group, and gets killed
+    # as well; otherwise it would hold the output pipe open.
+    with self.assertRaises(compilation_server_lib.CompilationCancelledError):
+      job.RunProcess(["sh", "-c", "sleep 30; true"], tempfile.gettempdir())
+    self.assertLess(time.time() - start_time, 10)
+    timer.join()
+
+  def testNoProcessStartsAfterCancelling(self):
+    job = compilation_server_lib.CompilationJob()
+    job.Cancel()
+    with self.assertRaises(compilation_server_lib.CompilationCancelledError):
+      job.RunProcess(["true"], tempfile.gettempdir())
+
+  def testStoppingOnOutputLine(self):
+    job = compilation_server_lib.CompilationJob()
+    start_time = time.time()
+    return_code, stdout = job.RunProcess(
+      ["sh", "-c", "echo a; echo stop; sleep 30; echo b"],
+      tempfile.gettempdir(), lambda line: line == "stop\n")
+    self.assertLess(time.time() - start_time, 10)
+    self.assertNotEquals(0, return_code)
+    self.assertEquals("a\nstop\n", stdout)
+
+
+class TestProcessLimits(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+
+  def _AssertExceedsLimit(self, limit, command):
+    counter = compilation_server_lib._LIMIT_KILL_COUNTERS[limit]
+    kills = counter.GetValue()
+    job = compilation_server_lib.CompilationJob()
+    with self.assertRaises(
+        compilation_server_lib.ResourceLimitExceededError) as cm:
+      job.RunProcess(["sh", "-c", command], tempfile.gettempdir())
+    self.assertEquals(limit, cm.exception.limit)
+    self.assertEquals(kills + 1, counter.GetValue())
+
+  def testWallTime(self):
+    gflags.FLAGS.tex_wall_time_limit_seconds = 1
+    self._AssertExceedsLimit('wall_time', "echo started; sleep 30")
+
+  def testCPUTime(self):
+    gflags.FLAGS.tex_cpu_time_limit_seconds = 1
+    self._AssertExceedsLimit('cpu_time', "while true; do :; done")
+
+  def testKillsBeforeReachingTheCPULimit(self):
+    gflags.FLAGS.tex_cpu_time_limit_seconds = 10
+    job = compilation_server_lib.CompilationJob()
+    self.assertEquals(
+      (-signal.SIGKILL, "started\n"),
+      job.RunProcess(["sh", "-c", "echo started; kill -9 $$"],
+                     tempfile.gettempdir()))
+
+  def testMemory(self):
+    gflags.FLAGS.tex_memory_limit_mb = 50
+    self._AssertExceedsLimit(
+      'memory', "head -c 200000000 /dev/zero | tail -n 1 > /dev/null")
+
+  def _AssertExceedsNoLimit(self, command, expected_stdout):
+    job = compilation_server_lib.CompilationJob()
+    self.assertEquals(
+      (1, expected_stdout),
+      job.RunProcess(["sh", "-c", command], tempfile.gettempdir()))
+
+  def testTeXCapacityIsADocumentError(self):
+    gflags.FLAGS.tex_memory_limit_mb = 1000
+    self._AssertExceedsNoLimit(
+      "echo '! TeX capacity exceeded, sorry [main memory size=5000000].'; "
+      "exit 1",
+      "! TeX capacity exceeded, sorry [main memory size=5000000].\n")
+
+  def testMemoryMessageEchoedFromTheDocument(self):
+    gflags.FLAGS.tex_memory_limit_mb = 1000
+    self._AssertExceedsNoLimit(
+      "echo 'l.12 when memory exhausted'; exit 1",
+      "l.12 when memory exhausted\n")
+
+  def testMemoryMessageWithoutMemoryLimit(self):
+    gflags.FLAGS.tex_memory_limit_mb = 0
+    self._AssertExceedsNoLimit(
+      "echo 'sh: Cannot allocate memory' >&2; exit 1", "")
+
+  def testOutputSize(self):
+    gflags.FLAGS.tex_output_limit_mb = 1
+    output_dir = tempfile.mkdtemp()
+    try:
+      self._AssertExceedsLimit(
+        'output_size',
+        "exec head -c 2000000 /dev/zero > {}/big".format(output_dir))
+    finally:
+      shutil.rmtree(output_dir)
+
+
+class TestBibtexCache(unittest.TestCase):
+
+  def setUp(self):
+    self._work_dir = tempfile.mkdtemp()
+    self._WriteFile("bib.bib", "@article{a, title={A}}\n@article{b}\n")
+
+  def tearDown(self):
+    shutil.rmtree(self._work_dir)
+
+  def _WriteFile(self, filename, content):
+    with open(os.path.join(self._work_dir, filename), 'w') as ofile:
+      ofile.write(content)
+
+  def _GetKey(self, aux_content):
+    self._WriteFile("slides.aux", aux_content)
+    return compilation_server_lib.BibtexCache.GetKey(self._work_dir, "slides")
+
+  def testKeyingByCitedKeysBibAndStyle(self):
+    key = self._GetKey(
+      "\\citation{b,a}\n\\bibstyle{plain}\n\\bibdata{bib}\n")
+    self.assertEquals(key, self._GetKey(
+      "\\citation{a}\n\\citation{b}\n\\bibstyle{plain}\n"
+      "\\bibdata{bib.bib}\n"))
+    self.assertNotEquals(key, self._GetKey(
+      "\\citation{a}\n\\bibstyle{plain}\n\\bibdata{bib}\n"))
+    self.assertNotEquals(key, self._GetKey(
+      "\\citation{b,a}\n\\bibstyle{alpha}\n\\bibdata{bib}\n"))
+    self._WriteFile("bib.bib", "@article{a, title={B}}\n@article{b}\n")
+    self.assertNotEquals(key, self._GetKey(
+      "\\citation{b,a}\n\\bibstyle{plain}\n\\bibdata{bib}\n"))
+
+  def testNoBibliography(self):
+    self.assertIsNone(self._GetKey("\\citation{a}\n"))
+    self.assertIsNone(
+      compilation_server_lib.BibtexCache.GetKey(self._work_dir, "report"))
+
+  def testRestoringWithoutRunningBibtex(self):
+    key = self._GetKey("\\citation{a}\n\\bibdata{bib}\n")
+    bibtex_cache = compilation_server_lib.BibtexCache(10)
+    bibtex_cache.Put(key, "\\begin{thebibliography}{1}")
+    hits = compilation_server_lib._BIBTEX_CACHE_HITS.GetValue()
+    # A cancelled job fails to start any process.
+    job = compilation_server_lib.CompilationJob()
+    job.Cancel()
+    compilation_server_lib._CompileOrRestoreBibliography(
+      self._work_dir, compilation_service_pb2.LatexCompilationRequest.BEAMER,
+      job, bibtex_cache)
+    self.assertEquals(
+      "\\begin{thebibliography}{1}",
+      open(os.path.join(self._work_dir, "slides.bbl")).read())
+    self.assertEquals(
+      hits + 1, compilation_server_lib._BIBTEX_CACHE_HITS.GetValue())
+
+
+class TestImageDownscaling(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    self._temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._temp_dir)
+
+  def testDisplayWidths(self):
+    self.assertEquals(
+      {"a.png": 0.7 * 6.5, "b.png": 1.0},
+      compilation_server_lib.GetImageDisplayWidths(
+        "\\includegraphics[width=.7\\textwidth]{a.png}\n"
+        "\\includegraphics[width=0.30\\textwidth]{a.png}\n"
+        "\\includegraphics[width=72.00px]{b.png}"))
+
+  @unittest.skipIf(Image is None, "PIL is not installed")
+  def testDownscalingLinkedImage(self):
+    gflags.FLAGS.image_dpi = 10
+    user_image_path = os.path.join(self._temp_dir, "user.png")
+    Image.effect_noise((2000, 1000), 50).convert('RGB').save(user_image_path)
+    work_dir = os.path.join(self._temp_dir, "working")
+    os.mkdir(work_dir)
+    os.symlink(user_image_path, os.path.join(work_dir, "big.png"))
+
+    image_cache = compilation_server_lib.ImageCache(10)
+    hits = compilation_server_lib._IMAGE_CACHE_HITS.GetValue()
+    for _ in range(2):
+      compilation_server_lib._DownscaleImagesAtWorkDir(
+        work_dir, ["\\includegraphics[width=.5\\textwidth]{big.png}"],
+        image_cache)
+      self.assertEquals(
+        (33, 17), Image.open(os.path.join(work_dir, "big.png")).size)
+      self.assertEquals((2000, 1000), Image.open(user_image_path).size)
+      os.remove(os.path.join(work_dir, "big.png"))
+      os.symlink(user_image_path, os.path.join(work_dir, "big.png"))
+    self.assertEquals(
+      hits + 1, compilation_server_lib._IMAGE_CACHE_HITS.GetValue())
+
+
+_MINDMAP = """<map version="1.0.1">
+<node ID="ID_1" TEXT="Title">
+<node ID="ID_2" TEXT="A slide">
+<node ID="ID_3" TEXT="Some point"/>
+</node>
+</node>
+</map>
+"""
+
+_MINDMAP_WITH_TWO_SLIDES = """<map version="1.0.1">
+<node ID="ID_1" TEXT="Title">
+<node ID="ID_2" TEXT="A slide">
+<node ID="ID_3" TEXT="content $"/>
+</node>
+<node ID="ID_4" TEXT="Another slide">
+<node ID="ID_5" TEXT="\\undefined"/>
+<node ID="ID_6" TEXT="\\undefined"/>
+</node>
+</node>
+</map>
+"""
+
+_MINDMAP_WITH_ERRORS_IN_TWO_SLIDES = """<map version="1.0.1">
+<node ID="ID_1" TEXT="Title">
+<node ID="ID_2" TEXT="A slide">
+<node ID="ID_3" TEXT="\\undefined"/>
+</node>
+<node ID="ID_4" TEXT="Another slide">
+<node ID="ID_5" TEXT="Fine"/>
+<node ID="ID_6" TEXT="\\undefined"/>
+</node>
+</node>
+</map>
+"""
+
+
+class TestLatexErrorParser(unittest.TestCase):
+
+  def setUp(self):
+    self._latex_content, self._source_map = convert_lib.Organization(
+      _MINDMAP_WITH_TWO_SLIDES).GetOutputAndSourceMap('beamer_latex')
+
+  def _GetLineNo(self, text):
+    return self._latex_content.split("\n").index(text) + 1
+
+  def _Feed(self, parser, log):
+    for line in log.split("\n"):
+      parser.FeedLine(line)
+
+  def testMappingErrorsToFrames(self):
+    parser = compilation_server_lib.LatexErrorParser(self._source_map)
+    self._Feed(parser,
+               "! Missing $ inserted.\n<inserted text>\nl.{} content $\n"
+               "! Undefined control sequence.\nl.{} \\undefined\n"
+               "! Undefined control sequence.\nl.{} \\undefined".format(
+                 self._GetLineNo("\\begin{frame}{A slide}content $"),
+                 self._GetLineNo("\\begin{frame}{Another slide}\\undefined"),
+                 self._GetLineNo("\\undefined")))
+    self.assertEquals(3, parser.num_errors)
+    self.assertEquals(
+      {"ID_2": ["Missing $ inserted."],
+       "ID_4": ["Undefined control sequence.",
+                "Undefined control sequence."]},
+      parser.GetNodeIdAndErrorMessageMapping())
+
+  def testErrorsOutsideFrames(self):
+    parser = compilation_server_lib.LatexErrorParser(self._source_map)
+    self._Feed(parser, "! Undefined control sequence.\nl.{} \\title".format(
+      self._GetLineNo("    \\title{Title}")))
+    self.assertEquals({}, parser.GetNodeIdAndErrorMessageMapping())
+    self.assertEquals({"ID_1": ["Undefined control sequence."]},
+                      parser.GetErrorsOutsideFrames())
+
+  def testErrorsOutsideNodes(self):
+    parser = compilation_server_lib.LatexErrorParser(self._source_map)
+    self._Feed(parser, "! Emergency stop.\nl.{} ".format(
+      self._source_map.num_lines + 1))
+    with self.assertRaises(KeyError):
+      parser.GetNodeIdAndErrorMessageMapping()
+
+  def testEnoughErrors(self):
+    parser = compilation_server_lib.LatexErrorParser(self._source_map, 1)
+    self.assertFalse(parser.FeedLineAndCheckEnough("! Missing $ inserted.\n"))
+    self.assertTrue(parser.FeedLineAndCheckEnough("l.12 content $\n"))
+
+
+class TestSourceMap(unittest.TestCase):
+
+  def testMappingLinesToNodes(self):
+    latex_content, source_map = convert_lib.Organization(
+      _MINDMAP_WITH_TWO_SLIDES).GetOutputAndSourceMap('beamer_latex')
+    lines = latex_content.split("\n")
+    self.assertEquals(len(lines), source_map.num_lines)
+    node_lines = source_map.GetNodeLines()
+    for node_id in ["ID_1", "ID_2", "ID_3", "ID_4", "ID_5", "ID_6"]:
+      first_line, last_line = node_lines[node_id]
+      self.assertLessEqual(first_line, last_line)
+    self.assertEquals(node_lines["ID_5"][0], node_lines["ID_5"][1])
+    self.assertEquals("ID_5", source_map.GetNodeId(node_lines["ID_5"][0]))
+    self.assertEquals("ID_4", source_map.GetFrameNodeId(node_lines["ID_6"][0]))
+    self.assertIn("Title", lines[node_lines["ID_1"][0] - 1])
+    self.assertEquals(
+      ["ID_2", "ID_4"],
+      [node_id for _, node_id in source_map.GetFrames()])
+    self.assertIsNone(source_map.GetNodeId(0))
+    self.assertIsNone(source_map.GetNodeId(source_map.num_lines + 1))
+
+
+class TestMindmapConverter(unittest.TestCase):
+
+  def testConvertingInWorkerProcess(self):
+    print_formats = ['beamer_latex', 'latex', 'html']
+    converter = compilation_server_lib.MindmapConverter(1)
+    self.addCleanup(converter.Close)
+    # Sent back from the worker process, the documents went through pickling.
+    pooled_map = converter.Convert(_MINDMAP_WITH_TWO_SLIDES, print_formats)
+    in_thread_map = compilation_server_lib.MindmapConverter(0).Convert(
+      _MINDMAP_WITH_TWO_SLIDES, print_formats)
+
+    org = convert_lib.Organization(_MINDMAP_WITH_TWO_SLIDES)
+    for print_format in print_formats:
+      pooled, in_thread = pooled_map[print_format], in_thread_map[print_format]
+      self.assertEquals(org.GetOutput(print_format), pooled.content)
+      self.assertEquals(in_thread.content, pooled.content)
+      self.assertEquals(in_thread.source_map.num_lines,
+                        pooled.source_map.num_lines)
+      self.assertEquals(in_thread.source_map.GetFrames(),
+                        pooled.source_map.GetFrames())
+      self.assertEquals(in_thread.source_map.GetNodeLines(),
+                        pooled.source_map.GetNodeLines())
+      for line_no in range(pooled.source_map.num_lines + 2):
+        self.assertEquals(in_thread.source_map.GetNodeId(line_no),
+                          pooled.source_map.GetNodeId(line_no))
+        self.assertEquals(in_thread.source_map.GetFrameNodeId(line_no),
+                          pooled.source_map.GetFrameNodeId(line_no))
+    self.assertEquals(
+      ["ID_2", "ID_4"],
+      [node_id for _, node_id in pooled_map['beamer_latex'].source_map.
+       GetFrames()])
+
+
+class TestEmbeddingErrors(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    fake_tex_test_lib.UseFakeTex(self)
+    self._work_dir = tempfile.mkdtemp()
+    compilation_server_lib.PrepareCompilationBaseDirectory(self._work_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self._work_dir)
+
+  def _Compile(self, mindmap_content):
+    with open(os.path.join(self._work_dir, "mindmap.mm"), 'w') as ofile:
+      ofile.write(mindmap_content)
+    return compilation_server_lib.CompileAtWorkDir(
+      self._work_dir, compilation_service_pb2.LatexCompilationRequest.BEAMER)
+
+  def testErrorsInTwoFrames(self):
+    gflags.FLAGS.max_latex_errors = 1
+    result = self._Compile(_MINDMAP_WITH_ERRORS_IN_TWO_SLIDES)
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.EMBEDDED, result.status)
+    self.assertEquals("PDF", result.pdf_content)
+    source = open(os.path.join(self._work_dir, "mindmap.tex")).read()
+    self.assertEquals(2, source.count("Error on page"))
+    self.assertNotIn("\\undefined", source)
+
+  def testErrorInTitle(self):
+    result = self._Compile(_MINDMAP_WITH_ERRORS_IN_TWO_SLIDES.replace(
+      'TEXT="Title"', 'TEXT="Title \\undefined"').replace(
+        'TEXT="\\undefined"', 'TEXT="Fine"'))
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.EMBEDDED, result.status)
+    self.assertEquals("PDF", result.pdf_content)
+    source = open(os.path.join(self._work_dir, "mindmap.tex")).read()
+    self.assertEquals(1, source.count("Error on page"))
+    self.assertNotIn("\\undefined", source)
+    self.assertIn("Another slide", source)
+
+  def testSuccess(self):
+    result = self._Compile(_MINDMAP)
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.SUCCESS, result.status)
+
+
+class TestCompilingHtml(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    self._work_dir = tempfile.mkdtemp()
+    with open(os.path.join(self._work_dir, "mindmap.mm"), 'w') as ofile:
+      ofile.write(_MINDMAP)
+
+  def tearDown(self):
+    shutil.rmtree(self._work_dir)
+
+  def testRenderingWithoutTeX(self):
+    result = compilation_server_lib.CompileAtWorkDir(
+      self._work_dir, compilation_service_pb2.LatexCompilationRequest.HTML)
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.SUCCESS, result.status)
+    self.assertIn("Some point", result.html_content)
+    self.assertFalse(result.pdf_content)
+
+  def _CompileCitation(self):
+    gflags.FLAGS.bib_file = os.path.join(self._work_dir, "missing.bib")
+    self.addCleanup(setattr, convert_lib.BibDatabase, "db",
+                    convert_lib.BibDatabase.db)
+    convert_lib.BibDatabase.db = None
+    with open(os.path.join(self._work_dir, "mindmap.mm"), 'w') as ofile:
+      ofile.write(_MINDMAP.replace("Some point", "Some point \\cite{knuth84}"))
+    result = compilation_server_lib.CompileAtWorkDir(
+      self._work_dir, compilation_service_pb2.LatexCompilationRequest.HTML)
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.SUCCESS, result.status)
+    return result.html_content
+
+  def testCitingTheSentEntries(self):
+    with open(os.path.join(self._work_dir, "bib.bib"), 'w') as ofile:
+      ofile.write("@book{knuth84,\n  author = {Knuth, Donald},\n"
+                  "  title = {The TeXbook},\n  year = {1984},\n}\n")
+    html_content = self._CompileCitation()
+    self.assertIn("Knuth, 1984", html_content)
+    self.assertIsNone(convert_lib.BibDatabase.db)
+
+  def testCitingWithoutBibFile(self):
+    self.assertIn("InvalidBibEntry:knuth84", self._CompileCitation())
+
+  def testTimingPhases(self):
+    request = compilation_service_pb2.LatexCompilationRequest()
+    request.compilation_mode = (
+      compilation_service_pb2.LatexCompilationRequest.HTML)
+    result = compilation_server_lib.CompileRequestedTargetsAtWorkDir(
+      self._work_dir, request)
+    self.assertEquals(
+      ["parse", "emit:html"],
+      [timing.phase for timing in result.phase_timings])
+
+  def testProfilingConversion(self):
+    gflags.FLAGS.profile_dir = os.path.join(self._work_dir, "profiles")
+    request = compilation_service_pb2.LatexCompilationRequest()
+    request.compilation_mode = (
+      compilation_service_pb2.LatexCompilationRequest.HTML)
+    job = compilation_server_lib.CompilationJob()
+    job.profile_id = "slow"
+    compilation_server_lib.CompileRequestedTargetsAtWorkDir(
+      self._work_dir, request, job=job)
+    self.assertEquals(
+      ["slow.convert.prof"], os.listdir(gflags.FLAGS.profile_dir))
+
+
+class _AbortedRpc(Exception):
+  pass
+
+
+class _FakeContext(object):
+
+  def __init__(self):
+    self.code = None
+    self.callbacks = []
+
+  def abort(self, code, details):
+    self.code = code
+    raise _AbortedRpc(details)
+
+  def add_callback(self, callback):
+    self.callbacks.append(callback)
+
+  def is_active(self):
+    return True
+
+  def invocation_metadata(self):
+    return []
+
+
+class TestRendering(unittest.TestCase):
+
+  def setUp(self):
+    self._server = compilation_server_lib.CompilationServer(
+      compilation_server_lib.CompilationLoad(1),
+      compilation_server_lib.MindmapConverter(0),
+      compilation_server_lib.RenderCache(10),
+      compilation_server_lib.BibtexCache(10))
+
+  def _Render(self, mindmap_content, context=None):
+    request = compilation_service_pb2.RenderRequest()
+    request.mindmap_content = mindmap_content
+    request.compilation_mode = (
+      compilation_service_pb2.LatexCompilationRequest.BEAMER)
+    return self._server.Render(request, context or _FakeContext())
+
+  def testRenderingTeXAndFrames(self):
+    response = self._Render(_MINDMAP)
+    self.assertIn("Some point", response.source)
+    self.assertEquals(["ID_2"], [frame.node_id for frame in response.frames])
+    self.assertEquals(
+      "%%frame: ID_2%%",
+      response.source.split("\n")[response.frames[0].line - 1])
+    node_lines = dict(
+      (node.node_id, (node.first_line, node.last_line))
+      for node in response.nodes)
+    self.assertIn(
+      "Some point",
+      response.source.split("\n")[node_lines["ID_3"][0] - 1])
+
+  def testCachingByContent(self):
+    hits = compilation_server_lib._RENDER_CACHE_HITS.GetValue()
+    first_response = self._Render(_MINDMAP)
+    self.assertIs(first_response, self._Render(_MINDMAP))
+    self.assertEquals(
+      hits + 1, compilation_server_lib._RENDER_CACHE_HITS.GetValue())
+
+  def testObservingRenderTime(self):
+    def GetCount():
+      return compilation_server_lib._RENDER_SECONDS.GetSeries().get(
+        ("BEAMER",), (None, 0, 0))[2]
+
+    count = GetCount()
+    self._Render(_MINDMAP)
+    self.assertEquals(count + 1, GetCount())
+
+  def testBrokenMindmap(self):
+    context = _FakeContext()
+    with self.assertRaises(_AbortedRpc):
+      self._Render("<map><node", context)
+    self.assertEquals(grpc.StatusCode.INVALID_ARGUMENT, context.code)
+
+
+_SEVERAL_TARGETS = [
+  compilation_service_pb2.LatexCompilationRequest.BEAMER,
+  compilation_service_pb2.LatexCompilationRequest.REPORT,
+  compilation_service_pb2.LatexCompilationRequest.HANDOUT,
+  compilation_service_pb2.LatexCompilationRequest.HTML]
+
+
+class TestCompilingPackages(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    fake_tex_test_lib.UseFakeTex(self)
+    self._project_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._project_dir)
+    self._mindmap_path = os.path.join(self._project_dir, "mindmap.mm")
+    with open(self._mindmap_path, 'w') as ofile:
+      ofile.write(_MINDMAP)
+    self._server = compilation_server_lib.CompilationServer(
+      compilation_server_lib.CompilationLoad(1),
+      compilation_server_lib.MindmapConverter(0),
+      compilation_server_lib.RenderCache(10),
+      compilation_server_lib.BibtexCache(10))
+
+  def _CreateRequest(self, local_path=False, pdf_output_path=None):
+    request = compilation_service_pb2.LatexCompilationRequest()
+    file_info = request.file_infos.add()
+    file_info.filepath = "mindmap.mm"
+    if local_path:
+      file_info.local_path = self._mindmap_path
+    else:
+      file_info.content = _MINDMAP
+    if pdf_output_path:
+      request.pdf_output_path = pdf_output_path
+    return request
+
+  def testCompilingContent(self):
+    result = self._server.CompilePackage(self._CreateRequest(), _FakeContext())
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.SUCCESS, result.status)
+    self.assertEquals("PDF", result.pdf_content)
+    self.assertFalse(result.pdf_path)
+
+  def testLocalPathsNeedAllowing(self):
+    for request in [
+        self._CreateRequest(local_path=True),
+        self._CreateRequest(
+          pdf_output_path=os.path.join(self._project_dir, "out.pdf"))]:
+      context = _FakeContext()
+      with self.assertRaises(_AbortedRpc):
+        self._server.CompilePackage(request, context)
+      self.assertEquals(grpc.StatusCode.PERMISSION_DENIED, context.code)
+    self.assertFalse(
+      os.path.exists(os.path.join(self._project_dir, "out.pdf")))
+
+  def testReadingAndWritingLocalPaths(self):
+    gflags.FLAGS.allow_local_paths = True
+    pdf_output_path = os.path.join(self._project_dir, "out.pdf")
+    context = _FakeContext()
+    result = self._server.CompilePackage(
+      self._CreateRequest(local_path=True, pdf_output_path=pdf_output_path),
+      context)
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.SUCCESS, result.status)
+    self.assertEquals(pdf_output_path, result.pdf_path)
+    self.assertFalse(result.pdf_content)
+    self.assertEquals("PDF", open(pdf_output_path).read())
+    self.assertEquals(1, len(context.callbacks))
+
+  def _AssertTargetResults(self, result):
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.SUCCESS, result.status)
+    self.assertEquals(
+      _SEVERAL_TARGETS, [target.mode for target in result.target_results])
+    for target in result.target_results:
+      self.assertEquals(
+        compilation_service_pb2.LatexCompilationResponse.SUCCESS,
+        target.status)
+    beamer, report, handout, html = result.target_results
+    self.assertIn("\\begin{frame}{A slide}", beamer.source_code)
+    self.assertNotIn("\\begin{frame}", report.source_code)
+    self.assertIn("\\begin{frame}{A slide}", handout.source_code)
+    self.assertIn("Some point", html.html_content)
+    self.assertFalse(html.pdf_content)
+    self.assertFalse(html.pdf_path)
+
+  def testCompilingSeveralTargets(self):
+    request = self._CreateRequest()
+    request.target_modes.extend(_SEVERAL_TARGETS)
+    hold_file = os.path.join(self._project_dir, "hold")
+    open(hold_file, 'w').close()
+    os.environ[fake_tex_test_lib.HOLD_FILE_ENV] = hold_file
+    self.addCleanup(os.environ.pop, fake_tex_test_lib.HOLD_FILE_ENV)
+
+    results = []
+    compile_thread = threading.Thread(
+      target=lambda: results.append(
+        self._server.CompilePackage(request, _FakeContext())))
+    compile_thread.start()
+    try:
+      # All the TeX targets are in pdflatex at once.
+      reached_path = hold_file + ".reached"
+      deadline = time.time() + 30
+      while not (os.path.exists(reached_path) and
+                 len(open(reached_path).read().split()) == 3):
+        self.assertLess(time.time(), deadline, "Targets compiling in turn")
+        time.sleep(0.01)
+      self.assertEquals(["handout", "report", "slides"],
+                        sorted(open(reached_path).read().split()))
+    finally:
+      os.remove(hold_file)
+      compile_thread.join()
+
+    result, = results
+    self._AssertTargetResults(result)
+    self.assertFalse(result.pdf_content)
+    for target in result.target_results[:3]:
+      self.assertEquals("PDF", target.pdf_content)
+      self.assertFalse(target.pdf_path)
+
+  def testWritingSeveralTargets(self):
+    gflags.FLAGS.allow_local_paths = True
+    request = self._CreateRequest(
+      pdf_output_path=os.path.join(self._project_dir, "talk.pdf"))
+    request.target_modes.extend(_SEVERAL_TARGETS)
+    result = self._server.CompilePackage(request, _FakeContext())
+
+    self._AssertTargetResults(result)
+    for target, filename in zip(
+        result.target_results,
+        ["talk.pdf", "talk.report.pdf", "talk.handout.pdf"]):
+      self.assertEquals(
+        os.path.join(self._project_dir, filename), target.pdf_path)
+      self.assertFalse(target.pdf_content)
+      self.assertEquals("PDF", open(target.pdf_path).read())
+
+  def testLinkingWorkDir(self):
+    work_dir = os.path.join(self._project_dir, "working")
+    os.makedirs(os.path.join(work_dir, "figs"))
+    with open(os.path.join(work_dir, "mindmap.tex"), 'w') as ofile:
+      ofile.write("TeX")
+    target_dir = os.path.join(
+      work_dir, compilation_server_lib._TARGETS_DIR_NAME, "report")
+    compilation_server_lib._LinkWorkDir(work_dir, target_dir)
+    self.assertEquals(["figs", "mindmap.tex"], sorted(os.listdir(target_dir)))
+    for filename in ["figs", "mindmap.tex"]:
+      self.assertEquals(
+        os.path.join(work_dir, filename),
+        os.readlink(os.path.join(target_dir, filename)))
+
+
+class TestProjectSnapshots(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    self._temp_dir = os.path.realpath(tempfile.mkdtemp())
+    self.addCleanup(shutil.rmtree, self._temp_dir)
+    self._allowed_root = os.path.join(self._temp_dir, "allowed")
+    self._project_root = os.path.join(self._allowed_root, "talk")
+    self._work_dir = os.path.join(self._temp_dir, "working")
+    for directory in [os.path.join(self._project_root, "figs"),
+                      self._work_dir]:
+      os.makedirs(directory)
+    self._WriteFile(os.path.join(self._project_root, "mindmap.mm"), _MINDMAP)
+    self._WriteFile(os.path.join(self._project_root, "figs", "plot.png"),
+                    "PNG")
+    self._WriteFile(os.path.join(self._temp_dir, "secret.txt"), "secret")
+
+  @staticmethod
+  def _WriteFile(path, content):
+    with open(path, 'w') as ofile:
+      ofile.write(content)
+
+  def testGettingPathsInside(self):
+    self.assertEquals(
+      os.path.join("/root", "figs", "plot.png"),
+      compilation_server_lib._GetPathInside("/root", "figs/../figs/plot.png"))
+    for relative_path in ["../secret.txt", "figs/../../secret.txt",
+                          "/etc/passwd"]:
+      with self.assertRaises(ValueError):
+        compilation_server_lib._GetPathInside("/root", relative_path)
+
+  def testAllowingProjectRoots(self):
+    self.assertFalse(
+      compilation_server_lib._IsAllowedProjectRoot(self._project_root))
+    gflags.FLAGS.allowed_project_roots = ",{}".format(self._allowed_root)
+    self.assertTrue(
+      compilation_server_lib._IsAllowedProjectRoot(self._project_root))
+    self.assertFalse(
+      compilation_server_lib._IsAllowedProjectRoot(self._allowed_root + "2"))
+    self.assertFalse(
+      compilation_server_lib._IsAllowedProjectRoot(self._temp_dir))
+    escaping_link = os.path.join(self._allowed_root, "escaping")
+    os.symlink(self._temp_dir, escaping_link)
+    self.assertFalse(
+      compilation_server_lib._IsAllowedProjectRoot(escaping_link))
+
+  def testSnapshotKeepsTheContent(self):
+    compilation_server_lib._SnapshotProjectFiles(
+      self._project_root, ["mindmap.mm", "figs/plot.png"], self._work_dir)
+    # Editors replace the files when saving.
+    plot_path = os.path.join(self._project_root, "figs", "plot.png")
+    os.remove(plot_path)
+    self._WriteFile(plot_path, "New PNG")
+    self.assertEquals(_MINDMAP, open(
+      os.path.join(self._work_dir, "mindmap.mm")).read())
+    self.assertEquals("PNG", open(
+      os.path.join(self._work_dir, "figs", "plot.png")).read())
+
+  def testFollowingLinksInsideTheProject(self):
+    os.symlink(os.path.join(self._project_root, "figs", "plot.png"),
+               os.path.join(self._project_root, "linked.png"))
+    compilation_server_lib._SnapshotProjectFiles(
+      self._project_root, ["linked.png"], self._work_dir)
+    self.assertEquals("PNG", open(
+      os.path.join(self._work_dir, "linked.png")).read())
+
+  def testRejectingLinksLeavingTheProject(self):
+    os.symlink(os.path.join(self._temp_dir, "secret.txt"),
+               os.path.join(self._project_root, "figs", "secret.png"))
+    with self.assertRaises(ValueError):
+      compilation_server_lib._SnapshotProjectFiles(
+        self._project_root, ["mindmap.mm", "figs/secret.png"],
+        self._work_dir)
+    self.assertEquals([], os.listdir(self._work_dir))
+
+  def testMissingFiles(self):
+    with self.assertRaises(compilation_server_lib.ProjectSnapshotError):
+      compilation_server_lib._SnapshotProjectFiles(
+        self._project_root, ["mindmap.mm", "figs/missing.png"],
+        self._work_dir)
+
+  def testCompilingFromProjectRoot(self):
+    gflags.FLAGS.allowed_project_roots = self._allowed_root
+    fake_tex_test_lib.UseFakeTex(self)
+    server = compilation_server_lib.CompilationServer(
+      compilation_server_lib.CompilationLoad(1),
+      compilation_server_lib.MindmapConverter(0),
+      compilation_server_lib.RenderCache(10),
+      compilation_server_lib.BibtexCache(10))
+    request = compilation_service_pb2.LatexCompilationRequest()
+    request.project_root = self._project_root
+    request.file_infos.add().filepath = "mindmap.mm"
+    result = server.CompilePackage(request, _FakeContext())
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.SUCCESS, result.status)
+    self.assertEquals(
+      "PDF", open(os.path.join(self._project_root, "talk.pdf")).read())
+
+    request.target_modes.extend(_SEVERAL_TARGETS)
+    result = server.CompilePackage(request, _FakeContext())
+    for target, filename in zip(
+        result.target_results,
+        ["talk.pdf", "talk.report.pdf", "talk.handout.pdf"]):
+      self.assertEquals(
+        os.path.join(self._project_root, filename), target.pdf_path)
+      self.assertEquals("PDF", open(target.pdf_path).read())
+    self.assertIn("Some point", result.target_results[3].html_content)
+    del request.target_modes[:]
+
+    request.file_infos.add().filepath = "figs/missing.png"
+    context = _FakeContext()
+    with self.assertRaises(_AbortedRpc):
+      server.CompilePackage(request, context)
+    self.assertEquals(grpc.StatusCode.INVALID_ARGUMENT, context.code)
+
+
+_SERVING_SCRIPT = """
+import sys
+
+import gflags
+from freemindlatex import compilation_server_lib
+gflags.FLAGS(sys.argv[:1] + ["--allow_local_paths"])
+compilation_server_lib.RunServer(sys.argv[1], ready_fd=int(sys.argv[2]))
+"""
+
+
+class TestRunningServer(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    self._temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._temp_dir)
+
+  def testServingAtUnixSocket(self):
+    fake_tex_test_lib.UseFakeTex(self)
+    mindmap_path = os.path.join(self._temp_dir, "mindmap.mm")
+    with open(mindmap_path, 'w') as ofile:
+      ofile.write(_MINDMAP)
+    pdf_output_path = os.path.join(self._temp_dir, "out.pdf")
+    listen_address = "unix:{}".format(
+      os.path.join(self._temp_dir, "compilation.sock"))
+
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    server_proc = subprocess.Popen(
+      [sys.executable, '-c', _SERVING_SCRIPT, listen_address, str(write_fd)],
+      env=env, close_fds=False)
+    os.close(write_fd)
+    try:
+      with os.fdopen(read_fd) as ready_file:
+        self.assertEquals(listen_address, ready_file.readline().strip())
+      request = compilation_service_pb2.LatexCompilationRequest()
+      file_info = request.file_infos.add()
+      file_info.filepath = "mindmap.mm"
+      file_info.local_path = mindmap_path
+      request.pdf_output_path = pdf_output_path
+      result = compilation_service_pb2_grpc.LatexCompilationStub(
+        grpc.insecure_channel(listen_address)).CompilePackage(request)
+    finally:
+      server_proc.kill()
+      server_proc.wait()
+    self.assertEquals(
+      compilation_service_pb2.LatexCompilationResponse.SUCCESS, result.status)
+    self.assertEquals(pdf_output_path, result.pdf_path)
+    self.assertEquals("PDF", open(pdf_output_path).read())
+
+  def testUnableToListen(self):
+    with self.assertRaises(compilation_server_lib.ServerBindError):
+      compilation_server_lib.RunServer("unix:{}".format(
+        os.path.join(self._temp_dir, "missing", "compilation.sock")))
+
+  def testGeventRejectsUnixSockets(self):
+    gflags.FLAGS.server_implementation = 'gevent'
+    with self.assertRaisesRegexp(ValueError, "unix domain socket"):
+      compilation_server_lib.RunServer('unix:/tmp/freemindlatex_test.sock')
+
+  def testGeventNeedsConversionProcesses(self):
+    gflags.FLAGS.server_implementation = 'gevent'
+    gflags.FLAGS.conversion_processes = 0
+    with self.assertRaisesRegexp(ValueError, "conversion_processes"):
+      compilation_server_lib.RunServerAtPort(0)
+
+  def testGeventNeedsSettingUpFirst(self):
+    gflags.FLAGS.server_implementation = 'gevent'
+    gflags.FLAGS.conversion_processes = 1
+    with self.assertRaisesRegexp(ValueError, "gevent_lib.SetUp"):
+      compilation_server_lib.RunServerAtPort(0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,12 +1,16 @@
+import bisect
 import codecs
+import collections
+import contextlib
 import logging
 import os
 import re
 import sys
+import threading
 from xml.dom import minidom
 
 import gflags
-from bibtexparser.bparser import BibTexParser
+from freemindlatex import bib_lib, profiling_lib
 
 gflags.DEFINE_string('mindmap_file', None, 'the mindmap filename')
 gflags.DEFINE_boolean('use_absolute_paths_for_images', False,
@@ -14,34 +18,260 @@ gflags.DEFINE_boolean('use_absolute_paths_for_images', False,
 gflags.DEFINE_string('html_file', None, 'the html filename')
 gflags.DEFINE_string('latex_file', None, 'the latex filename')
 gflags.DEFINE_string('beamer_latex_file', None, 'the beamer latex filename')
-gflags.DEFINE_string('bib_file', '~/Dropbox/bib.bib',
-                     'bib file location')
+
+
+_HTML_HEADER = """
+<meta charset="UTF-8">
+<style>
+span.citation {
+   color : blue;
+}
+span.footnote {
+   color : green;
+   font-size: 50%;
+   vertical-align: top;
+}
+span.sf {
+  font-family: "Arial Black", Gadget, sans-serif
+}
+</style>
+<script type="text/javascript" src="http://cdn.mathjax.org/mathjax/latest/MathJax.js?config=TeX-AMS-MML_HTMLorMML"></script>
+<script language="javascript">
+var should_hide = false;
+
+ window.onload = function() {
+   should_hide = true;
+   SetVisability();
+ }
+
+ function SetVisability() {
+  var cols = document.getElementsByClassName('help');
+  for(i=0; i<cols.length; i++) {
+    cols[i].hidden = should_hide;
+  }
+ }
+
+function ToggleComments() {
+  should_hide = !should_hide;
+  SetVisability();
+}
+</script>
+<button onclick="ToggleComments()">show/hide comments</button>
+            """
+
+
+class SourceMap(object):
+  """Tells which mindmap node printed each line of a document.
+
+  Each line belongs to the innermost node printing non-blank text on it.
+  Lookups bisect over ranges of lines, so they take O(log n).
+  """
+
+  def __init__(self, line_ranges, node_lines, parents, frame_node_ids):
+    """
+    Args:
+      line_ranges: a list of (first line, node id) of each range of lines
+        printed by the same node, in order. The last one, starting after the
+        last line, has no node.
+      node_lines: see GetNodeLines.
+      parents: a dictionary from the node ids to their parent's.
+      frame_node_ids: a set of the ids of the nodes printing a beamer frame.
+    """
+    self._range_starts = [first_line for first_line, _ in line_ranges]
+    self._range_node_ids = [node_id for _, node_id in line_ranges]
+    self._node_lines = node_lines
+    self._parents = parents
+    self._frame_node_ids = frame_node_ids
+    self.num_lines = self._range_starts[-1] - 1
+
+  def GetNodeId(self, line_no):
+    """The id of the node printing the line (from 1), or None."""
+    index = bisect.bisect_right(self._range_starts, line_no) - 1
+    if index < 0:
+      return None
+    return self._range_node_ids[index]
+
+  def GetFrameNodeId(self, line_no):
+    """The id of the beamer frame's node containing the line, or None."""
+    node_id = self.GetNodeId(line_no)
+    while node_id is not None and node_id not in self._frame_node_ids:
+      node_id = self._parents.get(node_id)
+    return node_id
+
+  def GetNodeLines(self):
+    """Where each node got printed.
+
+    Returns:
+      A dictionary from node ids to pairs of their first and last lines with
+      text, e.g. {"ID_2": (12, 15)}. Only for the nodes printing some text.
+    """
+    return self._node_lines
+
+  def GetFrames(self):
+    """The beamer frames, as a list of (first line, node id), in order."""
+    return sorted(
+      (self._node_lines[node_id][0], node_id)
+      for node_id in self._frame_node_ids if node_id in self._node_lines)
+
+
+# A printed document, as unicode, and its SourceMap.
+ConvertedDocument = collections.namedtuple(
+  'ConvertedDocument', ['content', 'source_map'])
+
+
+class _TextWriter(object):
+  """Collects the printed pieces of a document, to join them in the end.
+
+  Also builds the document's SourceMap, as the nodes' printers tell where
+  they begin and end.
+  """
+
+  def __init__(self):
+    self._pieces = []
+    self._line_no = 1
+    # The nodes being printed, from the outermost. Each entry is a list of
+    # [node id, first line with text, last line with text].
+    self._node_stack = []
+    self._num_nodes_with_text = 0
+    # Owner of the current line: (depth, node id). Depth -1 without text.
+    self._line_owner = (-1, None)
+    self._range_starts = []
+    self._range_node_ids = []
+    self._node_lines = {}
+    self._parents = {}
+    self._frame_node_ids = set()
+
+  def _GetCurrentNodeId(self):
+    if not self._node_stack:
+      return None
+    return self._node_stack[-1][0]
+
+  def _FinishLine(self):
+    owner = self._line_owner[1]
+    if not self._range_node_ids or self._range_node_ids[-1] != owner:
+      self._range_starts.append(self._line_no)
+      self._range_node_ids.append(owner)
+    self._line_no += 1
+    self._line_owner = (-1, self._GetCurrentNodeId())
+
+  def _RecordText(self):
+    depth = len(self._node_stack)
+    if depth > self._line_owner[0]:
+      self._line_owner = (depth, self._GetCurrentNodeId())
+    for entry in self._node_stack[self._num_nodes_with_text:]:
+      entry[1] = self._line_no
+    self._num_nodes_with_text = depth
+    if self._node_stack:
+      self._node_stack[-1][2] = self._line_no
+
+  def write(self, text):
+    self._pieces.append(text)
+    for index, part in enumerate(text.split('\n')):
+      if index > 0:
+        self._FinishLine()
+      if part.strip():
+        self._RecordText()
+
+  def BeginNode(self, node_id):
+    self._parents[node_id] = self._GetCurrentNodeId()
+    self._node_stack.append([node_id, None, None])
+    if self._line_owner[0] < 0:
+      self._line_owner = (-1, node_id)
+
+  def EndNode(self):
+    node_id, first_line, last_line = self._node_stack.pop()
+    self._num_nodes_with_text = min(
+      self._num_nodes_with_text, len(self._node_stack))
+    if first_line is not None:
+      self._node_lines[node_id] = (first_line, last_line)
+      if self._node_stack:
+        self._node_stack[-1][2] = max(self._node_stack[-1][2], last_line)
+    if self._line_owner[0] < 0:
+      self._line_owner = (-1, self._GetCurrentNodeId())
+
+  def MarkFrame(self):
+    """Marks the node being printed as a beamer frame."""
+    self._frame_node_ids.add(self._GetCurrentNodeId())
+
+  def getvalue(self):
+    return u''.join(self._pieces)
+
+  def GetSourceMap(self):
+    line_ranges = zip(self._range_starts, self._range_node_ids)
+    owner = self._line_owner[1]
+    if not self._range_node_ids or self._range_node_ids[-1] != owner:
+      line_ranges.append((self._line_no, owner))
+    line_ranges.append((self._line_no + 1, None))
+    return SourceMap(line_ranges, dict(self._node_lines), dict(self._parents),
+                     set(self._frame_node_ids))
 
 
 class BibDatabase(object):
 
   def __init__(self, bib_file_location=None):
+    """
+    Args:
+      bib_file_location: path of the bib file. By default, the bib_file
+        flag's. When it cannot be read, the citations show as invalid.
+    """
+    # Only needed for the citations in HTML, so not loaded upfront.
+    from bibtexparser.bparser import BibTexParser
+
     if bib_file_location is None:
-      bib_file_location = gflags.FLAGS.bib_file
+      bib_file_location = bib_lib.GetBibFilePath()
     bib_file_location = re.sub('~', os.environ['HOME'], bib_file_location)
-    with open(bib_file_location) as bibfile:
-      content = bibfile.read()
-      bp = BibTexParser(content)
     self.entry_map = {}
+    try:
+      with open(bib_file_location) as bibfile:
+        content = bibfile.read()
+    except IOError as e:
+      logging.warning("Unable to read the bib file: %s", e)
+      return
+    bp = BibTexParser(content)
     for ent in bp.get_entry_list():
-      self.entry_map[ent['id']] = ent
+      # bibtexparser 0.6 renamed the key of the entries from 'id' to 'ID'.
+      self.entry_map[ent.get('ID', ent.get('id'))] = ent
 
   def _RetrieveEntry(self, name):
     return self.entry_map[name]
 
   db = None
 
+  # The bib file of the conversions running in each thread, see Using.
+  _thread_state = threading.local()
+
   @staticmethod
   def GetTheDB():
+    if getattr(BibDatabase._thread_state, 'bib_file_location', None):
+      if BibDatabase._thread_state.db is None:
+        BibDatabase._thread_state.db = BibDatabase(
+          BibDatabase._thread_state.bib_file_location)
+      return BibDatabase._thread_state.db
     if BibDatabase.db is None:
       BibDatabase.db = BibDatabase()
     return BibDatabase.db
 
+  @staticmethod
+  @contextlib.contextmanager
+  def Using(bib_file_location):
+    """Within the with statement, the current thread cites from the file.
+
+    The file gets loaded upon the first citation.
+
+    Args:
+      bib_file_location: path of the bib file, e.g. the cited entries sent
+        along with the mindmap. When None, keeps the bib_file flag's.
+    """
+    state = BibDatabase._thread_state
+    saved_state = (getattr(state, 'bib_file_location', None),
+                   getattr(state, 'db', None))
+    if bib_file_location is not None:
+      state.bib_file_location, state.db = bib_file_location, None
+    try:
+      yield
+    finally:
+      state.bib_file_location, state.db = saved_state
+
   @staticmethod
   def GetFormattedAuthor(bib_authorname):
     names = bib_authorname.split(' and ')
@@ -255,7 +485,14 @@ class Node(object):
 
   def GetPrinter(self):
     assert self.printing_func is not None
-    return self.printing_func
+    printing_func = self.printing_func
+
+    def PrintTo(writer, *args, **kwargs):
+      writer.BeginNode(self.nodeid)
+      printing_func(writer, *args, **kwargs)
+      writer.EndNode()
+
+    return PrintTo
 
   def GetLevel(self):
     return self.level
@@ -418,7 +655,7 @@ class Organization(object):
     self.LabelAllIntoLayers(node)
     node.SetPrintingFunc(DirectlyPrintSub(node))
 
-  def LabelErrorsOnFrames(self, node_error_mapping):
+  def LabelErrorsOnFrames(self, node_error_mapping, other_node_errors=None):
     """Label frames in the graph to output error messages instead.
 
     It will label the frame in a way to print its contents as they are,
@@ -427,63 +664,61 @@ class Organization(object):
     Args:
       node_error_mapping: mappings between frames' corresponding
         node IDs and the error they produce.
+      other_node_errors: mappings between the IDs of other nodes, e.g. the
+        title or sections, and the errors of their own text. They show a
+        frame with the errors instead of their text, followed by their
+        children.
     """
+    other_node_errors = other_node_errors or {}
     for node in self._TraverseAllDescendents():
       if node.nodeid in node_error_mapping:
         node.SetPrintingFunc(
           OutputFrameAndDebugMessage(
             node, node_error_mapping[node.nodeid]))
+      elif node.nodeid in other_node_errors:
+        node.SetPrintingFunc(
+          OutputDebugMessageAndSub(node, other_node_errors[node.nodeid]))
 
-  def OutputToHTML(self, filename):
-    with codecs.open(filename, 'w', 'utf8') as outputfile:
-      print >> outputfile, """
-<meta charset="UTF-8">
-<style>
-span.citation {
-   color : blue;
-}
-span.footnote {
-   color : green;
-   font-size: 50%;
-   vertical-align: top;
-}
-span.sf {
-  font-family: "Arial Black", Gadget, sans-serif
-}
-</style>
-<script type="text/javascript" src="http://cdn.mathjax.org/mathjax/latest/MathJax.js?config=TeX-AMS-MML_HTMLorMML"></script>
-<script language="javascript">
-var should_hide = false;
+  def GetOutputAndSourceMap(self, print_format):
+    """Prints the document into a string, telling where each node went.
 
- window.onload = function() {
-   should_hide = true;
-   SetVisability();
- }
+    Args:
+      print_format: 'html', 'latex' or 'beamer_latex'
 
- function SetVisability() {
-  var cols = document.getElementsByClassName('help');
-  for(i=0; i<cols.length; i++) {
-    cols[i].hidden = should_hide;
-  }
- }
+    Returns:
+      A ConvertedDocument.
+    """
+    writer = _TextWriter()
+    if print_format == 'html':
+      writer.write(_HTML_HEADER)
+      writer.write('\n')
+      self.doc.GetPrinter()(writer)
+    else:
+      self.doc.GetPrinter()(writer, print_format)
+    return ConvertedDocument(writer.getvalue(), writer.GetSourceMap())
 
-function ToggleComments() {
-  should_hide = !should_hide;
-  SetVisability();
-}
-</script>
-<button onclick="ToggleComments()">show/hide comments</button>
-            """
+  def GetOutput(self, print_format):
+    """Prints the document into a string.
+
+    Args:
+      print_format: 'html', 'latex' or 'beamer_latex'
 
-      self.doc.GetPrinter()(outputfile)
+    Returns:
+      The printed document, as unicode.
+    """
+    return self.GetOutputAndSourceMap(print_format).content
+
+  def OutputToHTML(self, filename):
+    with codecs.open(filename, 'w', 'utf8') as outputfile:
+      outputfile.write(self.GetOutput('html'))
 
   def OutputToLatex(self, filename):
     with codecs.open(filename, 'w', 'utf8') as outputfile:
-      self.doc.GetPrinter()(outputfile, 'latex')
+      outputfile.write(self.GetOutput('latex'))
 
   def OutputToBeamerLatex(self, filename):
     with codecs.open(filename, 'w', 'utf8') as outputfile:
-      self.doc.GetPrinter()(outputfile, 'beamer_latex')
+      outputfile.write(self.GetOutput('beamer_latex'))
 
 
 def OutputOrderedList(current_node):
@@ -732,6 +967,7 @@ def OutputParagraph(current_node):
       PrintInBeamerLatexFormat(writer)
 
   def PrintInBeamerLatexFormat(writer):
+    writer.MarkFrame()
     writer.write("\n%%frame: {}%%\n".format(current_node.nodeid))
     writer.write(r'\begin{frame}{')
     current_node.PrintSelfToWriter(writer, 'beamer_latex')
@@ -811,15 +1047,47 @@ def OutputFrameAndDebugMessage(current_node, error_messages):
       logging.fatal("Unsupported format %s", format)
 
   def PrintInBeamerLatexFormat(writer):
-    writer.write(r'\begin{frame}[fragile]{Error on page\ldots}')
-    writer.write(r'\begin{verbatim}')
-    writer.write('\n')
-    for msg in error_messages:
-      writer.write(msg)
-      writer.write("\n")
-    writer.write(r'\end{verbatim}')
+    writer.MarkFrame()
+    _WriteErrorFrame(writer, error_messages)
+
+  return PrintTo
+
+
+def _WriteErrorFrame(writer, error_messages):
+  writer.write(r'\begin{frame}[fragile]{Error on page\ldots}')
+  writer.write(r'\begin{verbatim}')
+  writer.write('\n')
+  for msg in error_messages:
+    writer.write(msg)
+    writer.write("\n")
+  writer.write(r'\end{verbatim}')
+  writer.write('\n')
+  writer.write(r'\end{frame}')
+
+
+def OutputDebugMessageAndSub(current_node, error_messages):
+  """Output the error messages in a frame, instead of the node's own text.
+
+  This printer is used when there is an error in the text of a node outside
+  of the frames, e.g. the title or a section.
+
+  Args:
+    current_node: the current node.
+    error_messages: a list of latex compilation messages for errors in the
+      text of this node.
+
+  Returns:
+    A printer for printing the latex code into a writer.
+  """
+
+  def PrintTo(writer, print_format='beamer_latex'):
+    if print_format != 'beamer_latex':
+      logging.fatal("Unsupported format %s", print_format)
+    # Not a frame of the node, so that errors in its children outside of
+    # frames do not get attributed to it.
+    _WriteErrorFrame(writer, error_messages)
     writer.write('\n')
-    writer.write(r'\end{frame}')
+    DirectlyPrintSub(current_node)(writer, print_format)
 
   return PrintTo
 
@@ -966,6 +1234,29 @@ def PrintTopLevel(current_node):
   return PrintTo
 
 
+def RunConversion():
+  """Converts the mindmap into the formats specified by the flags.
+  """
+  if gflags.FLAGS.mindmap_file is None:
+    print 'Usage: %s ARGS\n%s' % (sys.argv[0], gflags.FLAGS)
+    sys.exit(1)
+
+  mindmap_content = codecs.open(
+    gflags.FLAGS.mindmap_file, 'r', 'utf8').read()
+  # With --profile_dir, e.g. reproducing a slow request offline.
+  with profiling_lib.Profile(profiling_lib.GetProfilePathPrefix(
+      os.path.basename(gflags.FLAGS.mindmap_file), "convert")):
+    org = Organization(mindmap_content)
+    if gflags.FLAGS.html_file is not None:
+      org.OutputToHTML(gflags.FLAGS.html_file)
+
+    if gflags.FLAGS.beamer_latex_file is not None:
+      org.OutputToBeamerLatex(gflags.FLAGS.beamer_latex_file)
+
+    if gflags.FLAGS.latex_file is not None:
+      org.OutputToLatex(gflags.FLAGS.latex_file)
+
+
 def main():
   try:
     gflags.FLAGS(sys.argv)
@@ -973,21 +1264,7 @@ def main():
     print '%s\nUsage: %s ARGS\n%s' % (e, sys.argv[0], gflags.FLAGS)
     sys.exit(1)
   logging.basicConfig(level=logging.INFO)
-
-  if gflags.FLAGS.mindmap_file is None:
-    print 'Usage: %s ARGS\n%s' % (sys.argv[0], gflags.FLAGS)
-    sys.exit(1)
-
-  org = Organization(
-    codecs.open(gflags.FLAGS.mindmap_file, 'r', 'utf8').read())
-  if gflags.FLAGS.html_file is not None:
-    org.OutputToHTML(gflags.FLAGS.html_file)
-
-  if gflags.FLAGS.beamer_latex_file is not None:
-    org.OutputToBeamerLatex(gflags.FLAGS.beamer_latex_file)
-
-  if gflags.FLAGS.latex_file is not None:
-    org.OutputToLatex(gflags.FLAGS.latex_file)
+  RunConversion()
 
 
 if __name__ == "__main__":
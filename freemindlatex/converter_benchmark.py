@@ -0,0 +1,147 @@
+"""Measures how the mindmap conversion scales with the size of the mindmap.
+
+For each size, a fresh interpreter converts a synthetic mindmap (see
+mindmap_generator_lib) into each format, and reports the time of each phase
+and the peak memory, so that super-linear phases stand out. Needs no TeX.
+
+Usage:
+  python converter_benchmark.py --benchmark_sizes 10,100,1000,10000,100000
+"""
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import gflags
+from freemindlatex import convert_lib, mindmap_generator_lib
+
+gflags.DEFINE_list("benchmark_sizes", ["10", "100", "1000", "10000", "100000"],
+                   "Numbers of nodes of the mindmaps to convert.")
+gflags.DEFINE_integer("benchmark_depth", 7, "Depth of the mindmaps.")
+gflags.DEFINE_integer("benchmark_fan_out", 6,
+                      "Number of children of the nodes of the mindmaps.")
+gflags.DEFINE_float("benchmark_formatting_share", 0.1,
+                    "Fraction of the nodes with a LIST, ULIST, HLIST or "
+                    "SECTIONS formatting node.")
+gflags.DEFINE_float("benchmark_citation_share", 0.05,
+                    "Fraction of the nodes citing an entry.")
+gflags.DEFINE_float("benchmark_math_share", 0.1,
+                    "Fraction of the nodes with an inline formula.")
+gflags.DEFINE_float("benchmark_image_share", 0.02,
+                    "Fraction of the leaves showing an image.")
+
+FLAGS = gflags.FLAGS
+
+PHASES = ['parse', 'label', 'html', 'latex', 'beamer_latex']
+
+_MEASURING_SCRIPT = """
+import json
+import sys
+
+import gflags
+from freemindlatex import converter_benchmark, mindmap_generator_lib
+gflags.FLAGS(sys.argv[:1])
+print json.dumps(converter_benchmark.MeasureConversion(
+  int(sys.argv[1]), mindmap_generator_lib.MindmapOptions(**json.loads(
+    sys.argv[2]))))
+"""
+
+
+class _TimedOrganization(convert_lib.Organization):
+  """Times the labeling apart from the parsing, within the construction."""
+
+  label_seconds = None
+
+  def LabelTree(self, node):
+    start_time = time.time()
+    convert_lib.Organization.LabelTree(self, node)
+    self.label_seconds = time.time() - start_time
+
+
+def _GetMaxRssMegabytes():
+  # In kilobytes on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def MeasureConversion(num_nodes, options=mindmap_generator_lib.DEFAULT_OPTIONS):
+  """Converts a synthetic mindmap into each format, in this process.
+
+  Args:
+    num_nodes: number of nodes of the mindmap.
+    options: the mindmap_generator_lib.MindmapOptions of the mindmap.
+
+  Returns:
+    A dictionary with the seconds of each of PHASES, and the peak memory
+    in megabytes of the process ('peak_mb') and of the conversion, beyond
+    the generated mindmap ('conversion_mb').
+  """
+  mindmap_content = mindmap_generator_lib.GenerateMindmap(
+    num_nodes, options).decode('utf8')
+
+  # The citations in HTML read the bib file upon the first one.
+  temp_dir = tempfile.mkdtemp()
+  try:
+    bib_path = os.path.join(temp_dir, "bib.bib")
+    with open(bib_path, 'w') as ofile:
+      ofile.write(mindmap_generator_lib.GenerateBibContent(
+        options.num_citation_keys))
+    convert_lib.BibDatabase.db = convert_lib.BibDatabase(bib_path)
+  finally:
+    shutil.rmtree(temp_dir)
+
+  measurement = {}
+  rss_before_mb = _GetMaxRssMegabytes()
+  start_time = time.time()
+  org = _TimedOrganization(mindmap_content)
+  measurement['parse'] = time.time() - start_time - org.label_seconds
+  measurement['label'] = org.label_seconds
+  for print_format in PHASES[2:]:
+    start_time = time.time()
+    org.GetOutput(print_format)
+    measurement[print_format] = time.time() - start_time
+  measurement['peak_mb'] = _GetMaxRssMegabytes()
+  measurement['conversion_mb'] = measurement['peak_mb'] - rss_before_mb
+  return measurement
+
+
+def MeasureConversionInNewProcess(
+    num_nodes, options=mindmap_generator_lib.DEFAULT_OPTIONS):
+  """See MeasureConversion. The new process gives a clean peak memory."""
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  output = subprocess.check_output(
+    [sys.executable, '-c', _MEASURING_SCRIPT, str(num_nodes),
+     json.dumps(options._asdict())],
+    env=env)
+  return json.loads(output)
+
+
+def main():
+  FLAGS(sys.argv)
+  options = mindmap_generator_lib.DEFAULT_OPTIONS._replace(
+    max_depth=FLAGS.benchmark_depth,
+    fan_out=FLAGS.benchmark_fan_out,
+    formatting_share=FLAGS.benchmark_formatting_share,
+    citation_share=FLAGS.benchmark_citation_share,
+    math_share=FLAGS.benchmark_math_share,
+    image_share=FLAGS.benchmark_image_share)
+  print "%8s %s %9s %8s %9s %9s" % (
+    "nodes", " ".join("%12s" % phase for phase in PHASES), "total",
+    "us/node", "peak MB", "conv. MB")
+  for num_nodes in [int(size) for size in FLAGS.benchmark_sizes]:
+    measurement = MeasureConversionInNewProcess(num_nodes, options)
+    total_seconds = sum(measurement[phase] for phase in PHASES)
+    print "%8d %s %8.3fs %8.1f %9.1f %9.1f" % (
+      num_nodes,
+      " ".join("%11.3fs" % measurement[phase] for phase in PHASES),
+      total_seconds, total_seconds / num_nodes * 1e6,
+      measurement['peak_mb'], measurement['conversion_mb'])
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+  main()
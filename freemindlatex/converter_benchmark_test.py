@@ -0,0 +1,17 @@
+import unittest
+
+from freemindlatex import converter_benchmark, mindmap_generator_lib
+
+
+class TestConverterBenchmark(unittest.TestCase):
+
+  def testMeasuringSmallMindmap(self):
+    measurement = converter_benchmark.MeasureConversionInNewProcess(
+      30, mindmap_generator_lib.DEFAULT_OPTIONS._replace(citation_share=0.5))
+    for phase in converter_benchmark.PHASES:
+      self.assertGreater(measurement[phase], 0)
+    self.assertGreater(measurement['peak_mb'], 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
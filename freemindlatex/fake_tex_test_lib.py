@@ -0,0 +1,61 @@
+"""Stand-ins for the TeX programs, for tests compiling without TeX.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+# Set to a path, makes the stand-in pdflatex append the basename of the main
+# TeX file to <path>.reached, and wait while the path exists. For tests
+# needing compilations still running.
+HOLD_FILE_ENV = "FAKE_PDFLATEX_HOLD_FILE"
+
+# Stand-in for pdflatex, reporting an error on each line of mindmap.tex with
+# \undefined, the way pdflatex does in nonstopmode.
+_FAKE_PDFLATEX = """#!{python}
+import os
+import sys
+import time
+
+basename = sys.argv[-1][:-len(".tex")]
+hold_file = os.environ.get("{hold_file_env}")
+if hold_file:
+  with open(hold_file + ".reached", "a") as reached_file:
+    reached_file.write(basename + "\\n")
+  while os.path.exists(hold_file):
+    time.sleep(0.01)
+
+lines = open("mindmap.tex").read().split("\\n")
+failed = False
+for line_no, line in enumerate(lines, 1):
+  if "\\\\undefined" in line:
+    print "! Undefined control sequence."
+    print "l.%d %s" % (line_no, line)
+    sys.stdout.flush()
+    failed = True
+if failed:
+  sys.exit(1)
+open(basename + ".pdf", "w").write("PDF")
+"""
+
+
+def UseFakeTex(test_case):
+  """Puts a stand-in pdflatex, and a bibtex doing nothing, in the PATH.
+
+  Args:
+    test_case: the unittest.TestCase, typically called from its setUp.
+  """
+  bin_dir = tempfile.mkdtemp()
+  test_case.addCleanup(shutil.rmtree, bin_dir)
+  for name, content in [
+      ("pdflatex", _FAKE_PDFLATEX.format(
+        python=sys.executable, hold_file_env=HOLD_FILE_ENV)),
+      ("bibtex", "#!/bin/sh\n")]:
+    path = os.path.join(bin_dir, name)
+    with open(path, 'w') as ofile:
+      ofile.write(content)
+    os.chmod(path, 0755)
+  original_path = os.environ["PATH"]
+  os.environ["PATH"] = os.pathsep.join([bin_dir, original_path])
+  test_case.addCleanup(os.environ.__setitem__, "PATH", original_path)
@@ -0,0 +1,19 @@
+"""Helpers for tests changing the values of flags.
+"""
+
+import gflags
+
+
+def RestoreFlagsAfterTest(test_case):
+  """Restores the values of all the flags once the test finishes.
+
+  Args:
+    test_case: the unittest.TestCase, typically called from its setUp.
+  """
+  saved_flag_values = gflags.FLAGS.FlagValuesDict()
+
+  def Restore():
+    for name, value in saved_flag_values.items():
+      setattr(gflags.FLAGS, name, value)
+
+  test_case.addCleanup(Restore)
@@ -7,24 +7,39 @@ Basic usage:
   recompile the freemind file into slides upon your modifications.
 
 Advanced usages:
-  freemindlatex local # Use your own computer for latex compilation
+  freemindlatex local # Use your own computer for latex compilation, within
+    the same process.
   freemindlatex --port 8000 server # Start the latex compilation server at a
     selected port
+  freemindlatex --unix_socket /tmp/fml.sock server # Start the server at a
+    unix domain socket
   freemindlatex --using_server localhost:8000 client # Compiles documents
     with a non-default server.
+  freemindlatex --mode html # Shows the mindmap as a web page, which reloads
+    upon changes, without running TeX.
+  freemindlatex --mindmap_file mindmap.mm --latex_file mindmap.tex convert #
+    Converts the mindmap, without compiling it.
 """
 
+# gevent patches threading and sockets before anything, e.g. logging, imports
+# them.
+import sys
+
+from freemindlatex import gevent_lib
+if __name__ == "__main__" and gevent_lib.IsRequested(sys.argv):
+  gevent_lib.SetUp()
+
+import importlib
 import logging
 import os
 import platform
+import shutil
 import subprocess
-import sys
+import tempfile
 import time
+import webbrowser
 
 import gflags
-import portpicker
-from freemindlatex import (compilation_client_lib, compilation_server_lib,
-                           compilation_service_pb2, init_dir_lib)
 
 gflags.DEFINE_string(
     "using_server",
@@ -38,6 +53,16 @@ gflags.DEFINE_integer(
     None,
     "Port to listen to, for the compilation request. "
     "When not set, will pick a random port.")
+gflags.DEFINE_string(
+    "unix_socket",
+    None,
+    "When set, the server listens to this unix domain socket instead of a "
+    "port.")
+gflags.DEFINE_integer(
+    "ready_fd",
+    None,
+    "When set, the server writes its port into this file descriptor once "
+    "it is listening.")
 gflags.DEFINE_string(
     "dir",
     "",
@@ -46,14 +71,24 @@ gflags.DEFINE_string(
 gflags.DEFINE_string(
     "mode",
     "beamer",
-    "Compiling mode: beamer, HTML or report")
+    "Compiling mode: beamer, HTML, report or handout. Several modes, "
+    "comma-separated, compile the same mindmap into one pdf each, e.g. "
+    "beamer,report writes <dir>.pdf and <dir>.report.pdf")
 
 
 FLAGS = gflags.FLAGS
 
-_COMPILATION_MODE_MAP = {
-    'beamer': compilation_service_pb2.LatexCompilationRequest.BEAMER,
-    'report': compilation_service_pb2.LatexCompilationRequest.REPORT,
+# Modules needed by each command. They are imported only for the command
+# being run, which keeps the startup fast, e.g. the client does not load the
+# server nor the converter. The modules define their flags when imported, so
+# we import them before parsing the flags.
+COMMAND_MODULES = {
+    '': ['compilation_client_lib', 'html_preview_lib', 'init_dir_lib'],
+    'client': ['compilation_client_lib', 'html_preview_lib', 'init_dir_lib'],
+    'local': ['compilation_client_lib', 'html_preview_lib', 'init_dir_lib',
+              'local_compilation_lib'],
+    'server': ['compilation_server_lib'],
+    'convert': ['convert_lib'],
 }
 
 
@@ -61,6 +96,72 @@ class UserExitedEditingEnvironment(Exception):
   pass
 
 
+def GetCommand(argv):
+  """Finds the command among the command-line arguments.
+
+  Args:
+    argv: the command-line arguments, e.g. ['freemindlatex', '--port', '8000',
+      'server']
+
+  Returns:
+    The command, e.g. 'server'. An empty string for the default command.
+  """
+  # Telling flag values apart needs the flags of the command, which may come
+  # anywhere after them, e.g. --allow_local_paths --port 0 server. Any
+  # argument naming a command may be it.
+  for arg in set(argv[1:]):
+    if arg in COMMAND_MODULES:
+      ImportCommandModules(arg)
+  positional_arg = _GetFirstPositionalArg(argv)
+  return positional_arg if positional_arg in COMMAND_MODULES else ''
+
+
+def _GetFirstPositionalArg(argv):
+  """The first argument that is neither a flag nor a flag's value, or None."""
+  index = 1
+  while index < len(argv):
+    arg = argv[index]
+    next_arg = argv[index + 1] if index + 1 < len(argv) else None
+    if arg == '--':
+      return next_arg
+    if not arg.startswith('-'):
+      return arg
+    if _IsFollowedByValue(arg):
+      index += 1
+    index += 1
+  return None
+
+
+def _IsFollowedByValue(flag_arg):
+  """Whether the flag, e.g. '--dir', takes the next argument as its value.
+
+  Booleans take no value, unlike the other flags when written without '='.
+  Flags we do not know of, e.g. of modules not imported, are assumed to take
+  one.
+
+  Args:
+    flag_arg: the argument naming the flag, e.g. '--dir' or '--port=8000'
+  """
+  name = flag_arg.lstrip('-')
+  if '=' in name:
+    return False
+  if name.startswith('no') and name not in FLAGS:
+    name = name[len('no'):]
+  if name in FLAGS:
+    return not FLAGS[name].boolean
+  return True
+
+
+def ImportCommandModules(command):
+  """Imports the modules needed for running the command.
+
+  Returns:
+    A list of the imported modules.
+  """
+  return [importlib.import_module('freemindlatex.{}'.format(module_name))
+          for module_name in COMMAND_MODULES.get(command, [])]
+
+
 def _LaunchViewerProcess(filename, log_file):
   """Launch the viewer application under the current platform
 
@@ -80,37 +181,73 @@ def _LaunchViewerProcess(filename, log_file):
                           [filename], stdout=log_file, stderr=log_file)
 
 
-def RunEditingEnvironment(directory, server_address):
+def RunEditingEnvironment(directory, latex_client):
   """Start the editing/previewing/compilation environment, monitor file changes.
 
   Args:
     directory: the directory user is editing at
-    server_address: address of latex compilation server,
-      e.g. http://127.0.0.1:8000
+    latex_client: a compilation_client_lib.BaseCompilationClient, e.g.
+      compilation_client_lib.LatexCompilationClient('127.0.0.1:8000')
   """
-  compilation_mode = _COMPILATION_MODE_MAP[gflags.FLAGS.mode]
+  from freemindlatex import (compilation_client_lib, compilation_service_pb2,
+                             html_preview_lib, init_dir_lib, metrics_lib)
+
+  if FLAGS.client_metrics_port is not None:
+    metrics_port = metrics_lib.StartMetricsServer(FLAGS.client_metrics_port)
+    logging.info("Serving the compilation metrics at "
+                 "http://127.0.0.1:%d/metrics", metrics_port)
+
+  compilation_modes = [
+      compilation_service_pb2.LatexCompilationRequest.Mode.Value(
+          mode.strip().upper())
+      for mode in gflags.FLAGS.mode.split(',')]
+  html_mode = compilation_service_pb2.LatexCompilationRequest.HTML
+  pdf_modes = [mode for mode in compilation_modes if mode != html_mode]
   mindmap_file_loc = os.path.join(directory, 'mindmap.mm')
   if not os.path.exists(mindmap_file_loc):
     logging.info("Empty directory... Initializing it")
-    init_dir_lib.InitDir(directory, compilation_mode)
-
-  latex_client = compilation_client_lib.LatexCompilationClient(server_address)
+    init_dir_lib.InitDir(directory, compilation_modes[0])
+
+  # The HTML page needs no TeX, so it compiles on its own, without waiting
+  # for the pdf files.
+  schedulers = []
+  if html_mode in compilation_modes:
+    latex_client.CompileDir(directory, html_mode)
+    schedulers.append(compilation_client_lib.LatestWinsCompilationScheduler(
+        latex_client, directory, html_mode))
+  if pdf_modes:
+    latex_client.CompileDir(directory, pdf_modes[0], pdf_modes[1:])
+    schedulers.append(compilation_client_lib.LatestWinsCompilationScheduler(
+        latex_client, directory, pdf_modes[0], pdf_modes[1:]))
 
-  latex_client.CompileDir(directory, compilation_mode)
   freemind_log_path = os.path.join(directory, 'freemind.log')
   freemind_log_file = open(freemind_log_path, 'w')
 
   viewer_log_path = os.path.join(directory, 'viewer.log')
   viewer_log_file = open(viewer_log_path, 'w')
 
-  compiled_doc_path = (
-      compilation_client_lib.LatexCompilationClient.GetCompiledDocPath(directory))
-  viewer_proc = _LaunchViewerProcess(
-      os.path.join(
-          directory,
-          compiled_doc_path
-      ),
-      viewer_log_file)
+  viewer_procs = []
+  if pdf_modes:
+    compiled_doc_path = (
+        compilation_client_lib.LatexCompilationClient.GetCompiledDocPath(
+            directory))
+    viewer_procs.append(_LaunchViewerProcess(
+        os.path.join(
+            directory,
+            compiled_doc_path
+        ),
+        viewer_log_file))
+
+  preview_server = None
+  if html_mode in compilation_modes:
+    preview_server = html_preview_lib.PreviewServer(
+        directory, FLAGS.html_preview_port)
+    preview_server.Start()
+    preview_url = preview_server.GetURL(os.path.basename(
+        compilation_client_lib.LatexCompilationClient.GetHtmlDocPath(
+            directory)))
+    logging.info("HTML preview at %s", preview_url)
+    webbrowser.open(preview_url)
 
   freemind_sh_path = os.path.realpath(
       os.path.join(
@@ -120,18 +257,29 @@ def RunEditingEnvironment(directory, server_address):
       ['sh', freemind_sh_path, mindmap_file_loc],
       stdout=freemind_log_file, stderr=freemind_log_file, cwd=directory)
 
-  mtime_list = compilation_client_lib.GetMTimeListForDir(directory)
+  manifest = latex_client.GetManifest(directory)
+  mtime_list = manifest.GetMTimeList()
   try:
     while True:
-      time.sleep(FLAGS.seconds_between_rechecking)
-      if freemind_proc.poll() is not None or viewer_proc.poll() is not None:
+      # Waking up as soon as the first busy compilation, e.g. the HTML one,
+      # finishes.
+      busy_schedulers = [
+          scheduler for scheduler in schedulers if scheduler.IsBusy()]
+      (busy_schedulers or schedulers)[0].Wait(
+          FLAGS.seconds_between_rechecking)
+      if freemind_proc.poll() is not None or any(
+          viewer_proc.poll() is not None for viewer_proc in viewer_procs):
         raise UserExitedEditingEnvironment
 
-      new_mtime_list = compilation_client_lib.GetMTimeListForDir(directory)
+      new_mtime_list = manifest.GetMTimeList()
       if new_mtime_list != mtime_list:
         time.sleep(0.5)         # Wait till files are fully written
         mtime_list = new_mtime_list
-        latex_client.CompileDir(directory, compilation_mode)
+        for scheduler in schedulers:
+          scheduler.Submit()
+      else:
+        for scheduler in schedulers:
+          scheduler.Poll()
 
   except KeyboardInterrupt as _:
     logging.info("User exiting with ctrl-c.")
@@ -141,18 +289,89 @@ def RunEditingEnvironment(directory, server_address):
 
   finally:
     logging.info("Exiting freemindlatex ...")
+    logging.info("Compilation metrics: %s", metrics_lib.GetCounterValues())
+    for scheduler in schedulers:
+      scheduler.Cancel()
+    if preview_server is not None:
+      preview_server.Stop()
     freemind_log_file.close()
     try:
       freemind_proc.kill()
     except OSError:
       pass
+    for viewer_proc in viewer_procs:
+      try:
+        viewer_proc.kill()
+      except OSError:
+        pass
+
+
+def _RunServer():
+  from freemindlatex import compilation_server_lib
+
+  if FLAGS.unix_socket:
+    compilation_server_lib.RunServer(
+        'unix:{}'.format(FLAGS.unix_socket), ready_fd=FLAGS.ready_fd)
+  else:
+    compilation_server_lib.RunServerAtPort(
+        FLAGS.port or 0, ready_fd=FLAGS.ready_fd)
+
+
+def _RunClient(directory):
+  from freemindlatex import compilation_client_lib
+
+  if not FLAGS.using_server:
+    logging.fatal(
+        "Please specify the server address when running in the client mode "
+        "via --using_server")
+  RunEditingEnvironment(
+      directory,
+      compilation_client_lib.LatexCompilationClient(FLAGS.using_server))
+
+
+def _RunLocally(directory):
+  from freemindlatex import local_compilation_lib
+
+  RunEditingEnvironment(
+      directory, local_compilation_lib.LocalCompilationClient())
+
+
+def _RunWithServerProcess(directory, argv0):
+  """Runs the server in a child process, on the same computer.
+
+  They talk through a unix domain socket, and the server reads and writes the
+  files in place.
+  """
+  from freemindlatex import compilation_client_lib
+
+  socket_dir = tempfile.mkdtemp()
+  server_proc, server_address = compilation_client_lib.LaunchServerProcess(
+      ["python", argv0],
+      ["--unix_socket", os.path.join(socket_dir, "compilation.sock"),
+       "--allow_local_paths"])
+  try:
+    RunEditingEnvironment(
+        directory,
+        compilation_client_lib.LatexCompilationClient(
+            server_address, share_filesystem=True))
+  finally:
     try:
-      viewer_proc.kill()
+      logging.info("Terminating latex compilation server.")
+      server_proc.kill()
     except OSError:
       pass
+    shutil.rmtree(socket_dir)
+
+
+def _RunConversion():
+  from freemindlatex import convert_lib
+
+  convert_lib.RunConversion()
 
 
 def main():
+  command = GetCommand(sys.argv)
+  ImportCommandModules(command)
   argv = FLAGS(sys.argv)
   logging.basicConfig(
       level=logging.INFO,
@@ -161,32 +380,19 @@ def main():
   directory = FLAGS.dir or os.getcwd()
 
   if argv[1:] == ['server']:
-    port = FLAGS.port or portpicker.pick_unused_port()
-    compilation_server_lib.RunServerAtPort(port)
+    _RunServer()
 
   elif argv[1:] == ['client']:
-    if not FLAGS.using_server:
-      logging.fatal(
-          "Please specify the server address when running in the client mode "
-          "via --using_server")
-    RunEditingEnvironment(directory, server_address=FLAGS.using_server)
+    _RunClient(directory)
+
+  elif argv[1:] == ['local']:
+    _RunLocally(directory)
+
+  elif argv[1:] == ['convert']:
+    _RunConversion()
 
   elif argv[1:] == []:
-    port = FLAGS.port or portpicker.pick_unused_port()
-    server_proc = subprocess.Popen(
-        ["python", argv[0], "--port", str(port), "server"])
-    server_address = '127.0.0.1:{}'.format(port)
-    compilation_client_lib.WaitTillHealthy(server_address)
-    try:
-      RunEditingEnvironment(
-          directory,
-          server_address=server_address)
-    finally:
-      try:
-        logging.info("Terminating latex compilation server.")
-        server_proc.kill()
-      except OSError:
-        pass
+    _RunWithServerProcess(directory, argv[0])
 
   else:
     print "Unable to recognize command %r" % argv
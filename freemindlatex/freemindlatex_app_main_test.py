@@ -0,0 +1,42 @@
+import unittest
+
+from freemindlatex import freemindlatex_app_main
+
+
+class TestGetCommand(unittest.TestCase):
+
+  def _AssertCommand(self, command, args):
+    self.assertEquals(
+      command, freemindlatex_app_main.GetCommand(['freemindlatex'] + args))
+
+  def testCommands(self):
+    self._AssertCommand('', [])
+    self._AssertCommand('server', ['server'])
+    self._AssertCommand('local', ['local', '--dir', 'server'])
+    self._AssertCommand('client', ['--', 'client'])
+
+  def testSkippingFlagValues(self):
+    self._AssertCommand('server', ['--port', '8000', 'server'])
+    self._AssertCommand('server', ['--port=8000', 'server'])
+    self._AssertCommand('', ['--dir', 'server', '--print_phase_timings'])
+    self._AssertCommand('', ['--mode', 'convert'])
+
+  def testBooleanFlagsTakeNoValue(self):
+    self._AssertCommand(
+      'server', ['--unix_socket', '/tmp/fml.sock', '--allow_local_paths',
+                 'server'])
+    self._AssertCommand('server', ['--noallow_local_paths', 'server'])
+
+  def testBooleanFlagsAwayFromTheCommand(self):
+    self._AssertCommand(
+      'server', ['--allow_local_paths', '--port', '0', 'server'])
+    self._AssertCommand(
+      'server', ['--noallow_local_paths', '--port', '0', 'server'])
+    self._AssertCommand(
+      'client', ['--hedge_compilations', '--using_server', 'a,b', 'client'])
+    self._AssertCommand(
+      'client', ['--nohedge_compilations', '--dir', 'talk', 'client'])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,170 @@
+"""Sets up gevent for the server, at the start of the process.
+
+gevent has to patch threading, sockets and subprocesses before other modules,
+e.g. logging or grpc, import them. So the entry point imports this module
+before anything else, and it imports nothing gevent patches until set up.
+
+CPU-bound work, which would hold up all the greenlets, goes to a ProcessPool.
+"""
+
+import sys
+
+
+def IsRequested(argv):
+  """Whether the command line asks for the gevent server implementation.
+
+  Runs before the flags get parsed (see compilation_server_lib's
+  server_implementation flag), as parsing them needs the modules to be
+  imported.
+
+  Args:
+    argv: the command-line arguments, e.g. ['freemindlatex',
+      '--server_implementation', 'gevent', 'server']
+  """
+  for index, arg in enumerate(argv[1:], 1):
+    if not arg.startswith('-'):
+      continue
+    name, equals, value = arg.lstrip('-').partition('=')
+    if name != 'server_implementation':
+      continue
+    if not equals:
+      value = argv[index + 1] if index + 1 < len(argv) else ''
+    return value == 'gevent'
+  return False
+
+
+def SetUp():
+  """Switches threads, sockets and subprocesses to gevent, including gRPC's.
+
+  The thread pool of the server then runs greenlets, so idle connections and
+  requests waiting for TeX processes cost no thread.
+  """
+  from gevent import monkey
+  monkey.patch_all()
+  import grpc.experimental.gevent as grpc_gevent
+  grpc_gevent.init_gevent()
+
+
+def IsSetUp():
+  """Whether SetUp has run in this process."""
+  if 'gevent' not in sys.modules:
+    return False
+  from gevent import monkey
+  return monkey.is_module_patched('socket')
+
+
+class _Worker(object):
+  """A worker process of a ProcessPool, with the pipes to talk to it."""
+
+  def __init__(self, process, task_writer, result_reader):
+    self.process = process
+    self.task_writer = task_writer
+    self.result_reader = result_reader
+
+
+def _ServeTasks(task_reader, result_writer, parent_ends, initializer):
+  """The loop of a worker process: runs the functions sent, until EOF.
+
+  The worker inherited the parent's ends of the pipes, which it closes, so
+  that it gets EOF when the parent exits.
+  """
+  for connection in parent_ends:
+    connection.close()
+  if initializer is not None:
+    initializer()
+  while True:
+    try:
+      func, args = task_reader.recv()
+    except EOFError:
+      return
+    try:
+      result = (True, func(*args))
+    except Exception as e:  # pylint: disable=broad-except
+      result = (False, e)
+    result_writer.send(result)
+
+
+class ProcessPool(object):
+  """Worker processes for CPU-bound work, like multiprocessing.Pool.
+
+  multiprocessing.Pool hands tasks and results over through threads of its
+  own, which hang once gevent turns them into greenlets, whether the pool
+  gets created before or after SetUp. Here, the calling greenlet talks to an
+  idle worker through pipes, and waits for the result in the event loop, so
+  the other greenlets keep running meanwhile.
+
+  The workers get forked upon creation, after SetUp, so create the pool
+  before starting gRPC.
+  """
+
+  def __init__(self, num_processes, initializer=None):
+    """
+    Args:
+      num_processes: number of worker processes.
+      initializer: if given, a function each worker calls when starting.
+    """
+    from gevent import queue
+    self._initializer = initializer
+    self._workers = set()
+    self._idle_workers = queue.Queue()
+    for _ in range(num_processes):
+      self._idle_workers.put(self._StartWorker())
+
+  def _StartWorker(self):
+    import multiprocessing
+    # One-way pipes are plain pipes, unlike the socket pair of a duplex one,
+    # which gevent makes non-blocking under the feet of the worker.
+    task_reader, task_writer = multiprocessing.Pipe(duplex=False)
+    result_reader, result_writer = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+      target=_ServeTasks,
+      args=(task_reader, result_writer, (task_writer, result_reader),
+            self._initializer))
+    process.daemon = True
+    process.start()
+    task_reader.close()
+    result_writer.close()
+    worker = _Worker(process, task_writer, result_reader)
+    self._workers.add(worker)
+    return worker
+
+  def _StopWorker(self, worker):
+    self._workers.discard(worker)
+    worker.task_writer.close()
+    worker.result_reader.close()
+    if worker.process.is_alive():
+      worker.process.terminate()
+    worker.process.join()
+
+  def apply(self, func, args=()):
+    """Runs func(*args) in a worker process, and returns its result.
+
+    Raises:
+      The exception func raised, or EOFError when the worker died.
+    """
+    from gevent import socket
+    worker = self._idle_workers.get()
+    try:
+      worker.task_writer.send((func, args))
+      socket.wait_read(worker.result_reader.fileno())
+      succeeded, value = worker.result_reader.recv()
+    except BaseException:
+      # E.g. the worker died, or the greenlet got killed while the worker
+      # still owes a result. Either way, the worker is no longer usable.
+      self._StopWorker(worker)
+      self._idle_workers.put(self._StartWorker())
+      raise
+    self._idle_workers.put(worker)
+    if not succeeded:
+      raise value
+    return value
+
+  def terminate(self):
+    """Stops the worker processes."""
+    for worker in list(self._workers):
+      self._StopWorker(worker)
+
+  def join(self):
+    """Waits for the worker processes, stopped by terminate, to exit."""
+    for worker in list(self._workers):
+      worker.process.join()
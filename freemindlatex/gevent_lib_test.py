@@ -0,0 +1,137 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+from freemindlatex import gevent_lib
+
+_SERVING_SCRIPT = """
+import sys
+
+from freemindlatex import gevent_lib
+gevent_lib.SetUp()
+
+import gflags
+from freemindlatex import compilation_server_lib
+gflags.FLAGS(sys.argv[:1] + ["--server_implementation", "gevent",
+                             "--conversion_processes", "1"])
+compilation_server_lib.RunServerAtPort(0, ready_fd=int(sys.argv[1]))
+"""
+
+# Runs two slow tasks in a ProcessPool, while a greenlet ticks. Prints the
+# results, and the longest time between two ticks.
+_POOL_SCRIPT = """
+import json
+import time
+
+from freemindlatex import gevent_lib
+gevent_lib.SetUp()
+
+import gevent
+from freemindlatex import gevent_lib_test
+
+pool = gevent_lib.ProcessPool(2)
+ticks = []
+
+def Tick():
+  while True:
+    ticks.append(time.time())
+    gevent.sleep(0.01)
+
+def ApplyOrDescribeError(args):
+  try:
+    return pool.apply(gevent_lib_test.SlowSquare, args)
+  except ValueError as e:
+    return str(e)
+
+ticker = gevent.spawn(Tick)
+gevent.sleep(0.05)
+tasks = [gevent.spawn(ApplyOrDescribeError, args) for args in [(3,), (-1,)]]
+gevent.joinall(tasks)
+gevent.sleep(0.05)
+ticker.kill()
+pool.terminate()
+pool.join()
+print json.dumps({
+  'results': [task.value for task in tasks],
+  'max_tick_gap': max(b - a for a, b in zip(ticks, ticks[1:])),
+})
+"""
+
+
+def SlowSquare(number):
+  """CPU-bound work for the ProcessPool, taking about a second."""
+  if number < 0:
+    raise ValueError("Negative: {}".format(number))
+  end_time = time.time() + 1
+  while time.time() < end_time:
+    pass
+  return number * number
+
+
+class TestIsRequested(unittest.TestCase):
+
+  def testFlagForms(self):
+    for argv in [
+        ['fml', '--server_implementation', 'gevent', 'server'],
+        ['fml', '--server_implementation=gevent', 'server'],
+        ['fml', '-server_implementation=gevent', 'server'],
+        ['fml', 'server', '--server_implementation', 'gevent']]:
+      self.assertTrue(gevent_lib.IsRequested(argv), argv)
+
+  def testNotRequested(self):
+    for argv in [
+        ['fml', 'server'],
+        ['fml', '--server_implementation', 'threads', 'server'],
+        ['fml', '--server_implementation'],
+        ['fml', '--dir', 'server_implementation', 'gevent']]:
+      self.assertFalse(gevent_lib.IsRequested(argv), argv)
+
+
+class TestServingWithGevent(unittest.TestCase):
+
+  def testServingHealthChecks(self):
+    import grpc
+    from freemindlatex import (compilation_client_lib, compilation_service_pb2,
+                               compilation_service_pb2_grpc)
+
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    server_proc = subprocess.Popen(
+      [sys.executable, '-c', _SERVING_SCRIPT, str(write_fd)], env=env,
+      close_fds=False)
+    os.close(write_fd)
+    try:
+      with os.fdopen(read_fd) as ready_file:
+        server_address = ready_file.readline().strip()
+      self.assertTrue(server_address.startswith('127.0.0.1:'))
+      self.assertTrue(compilation_client_lib.LatexCompilationClient(
+        server_address).CheckHealthy())
+      # Converting in the worker process.
+      response = compilation_service_pb2_grpc.LatexCompilationStub(
+        grpc.insecure_channel(server_address)).Render(
+          compilation_service_pb2.RenderRequest(
+            mindmap_content='<map version="1.0.1"><node TEXT="Title">'
+            '<node ID="ID_2" TEXT="A slide"><node TEXT="Point"/></node>'
+            '</node></map>'))
+      self.assertIn("Point", response.source)
+      self.assertEquals(["ID_2"], [frame.node_id for frame in response.frames])
+    finally:
+      server_proc.kill()
+      server_proc.wait()
+
+
+class TestProcessPool(unittest.TestCase):
+
+  def testOtherGreenletsRunMeanwhile(self):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = json.loads(subprocess.check_output(
+      [sys.executable, '-c', _POOL_SCRIPT], env=env))
+    self.assertEquals([9, "Negative: -1"], output['results'])
+    self.assertLess(output['max_tick_gap'], 0.5)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,131 @@
+"""Serves the page of the HTML mode, reloading it in the browser upon changes.
+"""
+
+import BaseHTTPServer
+import os
+import posixpath
+import SimpleHTTPServer
+import SocketServer
+import threading
+import urllib
+import urlparse
+
+import gflags
+
+gflags.DEFINE_integer(
+  "html_preview_port",
+  0,
+  "Port of the local HTTP server showing the page of the HTML mode. "
+  "0 for an unused port.")
+
+# The page asks for the modification time of its file, and reloads when it
+# changes.
+_LIVE_RELOAD_PATH = "/__freemindlatex_mtime"
+_LIVE_RELOAD_SCRIPT = """
+<script type="text/javascript">
+(function() {
+  var last_mtime = null;
+  setInterval(function() {
+    var request = new XMLHttpRequest();
+    request.onload = function() {
+      if (last_mtime !== null && request.responseText != last_mtime) {
+        window.location.reload();
+      }
+      last_mtime = request.responseText;
+    };
+    request.open("GET", "%s?page=" + encodeURIComponent(
+      window.location.pathname));
+    request.send();
+  }, 300);
+})();
+</script>
+""" % _LIVE_RELOAD_PATH
+
+
+class _PreviewRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+  """Serves the files of the directory, adding live reloading to the pages.
+  """
+
+  def translate_path(self, path):
+    # Like the base class, but under the served directory instead of the
+    # current working directory.
+    path = posixpath.normpath(urllib.unquote(path.split('?', 1)[0]))
+    result = self.server.directory
+    for word in path.split('/'):
+      if word and not os.path.dirname(word) and word not in (
+          os.curdir, os.pardir):
+        result = os.path.join(result, word)
+    return result
+
+  def do_GET(self):
+    path, _, query = self.path.partition('?')
+    if path == _LIVE_RELOAD_PATH:
+      page = urlparse.parse_qs(query).get('page', ['/'])[0]
+      self._SendContent(self._GetMTime(page), "text/plain")
+    elif path.endswith(".html"):
+      page_path = self.translate_path(path)
+      if not os.path.isfile(page_path):
+        self.send_error(404, "File not found")
+        return
+      with open(page_path) as page_file:
+        content = page_file.read()
+      self._SendContent(content + _LIVE_RELOAD_SCRIPT, "text/html")
+    else:
+      SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+  def _GetMTime(self, page):
+    try:
+      return repr(os.path.getmtime(self.translate_path(page)))
+    except OSError as _:
+      return "missing"
+
+  def _SendContent(self, content, content_type):
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(content)))
+    self.send_header("Cache-Control", "no-cache")
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass                        # Not flooding the terminal with polling.
+
+
+class _PreviewHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, directory, port):
+    BaseHTTPServer.HTTPServer.__init__(
+      self, ('127.0.0.1', port), _PreviewRequestHandler)
+    self.directory = os.path.abspath(directory)
+
+
+class PreviewServer(object):
+  """A local HTTP server, showing the files of a directory.
+
+  Its html pages reload themselves in the browser when their file changes.
+  """
+
+  def __init__(self, directory, port=0):
+    """
+    Args:
+      directory: the directory to serve, e.g. the user's directory.
+      port: the port to listen to, 0 for an unused one.
+    """
+    self._server = _PreviewHTTPServer(directory, port)
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+
+  def Start(self):
+    self._thread.start()
+
+  def GetURL(self, filename):
+    """The address of a file in the directory, e.g. talk.html
+    """
+    host, port = self._server.server_address
+    return "http://{}:{}/{}".format(host, port, urllib.quote(filename))
+
+  def Stop(self):
+    self._server.shutdown()
+    self._server.server_close()
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+from freemindlatex import html_preview_lib
+
+
+class TestPreviewServer(unittest.TestCase):
+
+  def setUp(self):
+    self._test_dir = tempfile.mkdtemp()
+    with open(os.path.join(self._test_dir, "talk.html"), 'w') as ofile:
+      ofile.write("<p>Hello</p>")
+    self._server = html_preview_lib.PreviewServer(self._test_dir)
+    self._server.Start()
+
+  def tearDown(self):
+    self._server.Stop()
+    shutil.rmtree(self._test_dir)
+
+  def _Fetch(self, filename, query=""):
+    return urllib2.urlopen(self._server.GetURL(filename) + query).read()
+
+  def testServingPagesWithLiveReloading(self):
+    content = self._Fetch("talk.html")
+    self.assertTrue(content.startswith("<p>Hello</p>"))
+    self.assertIn(html_preview_lib._LIVE_RELOAD_PATH, content)
+
+  def testReportingModificationTimes(self):
+    os.utime(os.path.join(self._test_dir, "talk.html"), (1, 2))
+    self.assertEquals(
+      "2.0", self._Fetch("__freemindlatex_mtime", "?page=/talk.html"))
+    self.assertEquals(
+      "missing", self._Fetch("__freemindlatex_mtime", "?page=/other.html"))
+
+  def testNotServingOutsideTheDirectory(self):
+    with self.assertRaises(urllib2.HTTPError):
+      self._Fetch("../passwd.html")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,114 @@
+"""Measures how downscaling the images changes the pdf and the TeX passes.
+
+Compiles slides showing a large generated image, once keeping it as it is
+and once downscaled to --image_dpi, then reports the pdf size, the time of
+the compilation and the time of one more pdflatex pass.
+
+Needs pdflatex and PIL.
+
+Usage:
+  python image_benchmark.py --image_dpi 150
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import gflags
+from freemindlatex import compilation_server_lib, compilation_service_pb2
+
+gflags.DEFINE_integer("benchmark_image_width", 5000,
+                      "Width of the generated image, in pixels.")
+gflags.DEFINE_integer("benchmark_image_height", 4000,
+                      "Height of the generated image, in pixels.")
+
+FLAGS = gflags.FLAGS
+
+_MINDMAP = """<map version="1.0.1">
+<node ID="ID_1" TEXT="Images">
+<node ID="ID_2" TEXT="A screenshot">
+<node ID="ID_3" TEXT="">
+<richcontent TYPE="NODE"><html><body><img src="screenshot.png"/></body></html>
+</richcontent>
+</node>
+</node>
+</node>
+</map>
+"""
+
+
+def _WriteScreenshot(path, width, height):
+  """Writes a PNG image, with large flat areas and some noise, like a photo
+  pasted into a screenshot.
+  """
+  from PIL import Image
+
+  image = Image.new('RGB', (width, height), (240, 240, 240))
+  noise = Image.effect_noise((width / 2, height / 2), 60).convert('RGB')
+  image.paste(noise, (width / 4, height / 4))
+  image.save(path)
+
+
+def MeasureCompilation(image_path, image_cache):
+  """Compiles the slides in a new working directory.
+
+  Args:
+    image_path: the image to show.
+    image_cache: a compilation_server_lib.ImageCache, or None for keeping the
+      image as it is.
+
+  Returns:
+    A tuple of the pdf size in bytes, the seconds of the compilation, and the
+    seconds of one more pdflatex pass.
+  """
+  work_dir = tempfile.mkdtemp()
+  try:
+    compilation_server_lib.PrepareCompilationBaseDirectory(work_dir)
+    with open(os.path.join(work_dir, "mindmap.mm"), 'w') as ofile:
+      ofile.write(_MINDMAP)
+    shutil.copyfile(image_path, os.path.join(work_dir, "screenshot.png"))
+
+    mode = compilation_service_pb2.LatexCompilationRequest.BEAMER
+    start_time = time.time()
+    result = compilation_server_lib.CompileAtWorkDir(
+      work_dir, mode, image_cache=image_cache)
+    compilation_seconds = time.time() - start_time
+
+    start_time = time.time()
+    compilation_server_lib._CompileLatexAtDir(
+      work_dir, mode, compilation_server_lib.CompilationJob())
+    pass_seconds = time.time() - start_time
+    return len(result.pdf_content), compilation_seconds, pass_seconds
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def main():
+  FLAGS(sys.argv)
+  image_cache = compilation_server_lib.CreateImageCache()
+  if image_cache is None:
+    print "Needs PIL, and a positive --image_dpi."
+    sys.exit(1)
+
+  temp_dir = tempfile.mkdtemp()
+  try:
+    image_path = os.path.join(temp_dir, "screenshot.png")
+    _WriteScreenshot(image_path, FLAGS.benchmark_image_width,
+                     FLAGS.benchmark_image_height)
+    print "Image of %dx%d pixels, %d bytes" % (
+      FLAGS.benchmark_image_width, FLAGS.benchmark_image_height,
+      os.path.getsize(image_path))
+    for name, cache in [("original", None),
+                        ("%d dpi" % FLAGS.image_dpi, image_cache)]:
+      pdf_bytes, compilation_seconds, pass_seconds = MeasureCompilation(
+        image_path, cache)
+      print "%-10s pdf %10d bytes, compilation %6.2fs, pass %6.2fs" % (
+        name, pdf_bytes, compilation_seconds, pass_seconds)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+  main()
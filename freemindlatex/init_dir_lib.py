@@ -7,6 +7,8 @@ from freemindlatex import compilation_service_pb2
 _TEMPLATE_BASENAME_MAPPING = {
   compilation_service_pb2.LatexCompilationRequest.BEAMER: "slides.mm",
   compilation_service_pb2.LatexCompilationRequest.REPORT: "report.mm",
+  compilation_service_pb2.LatexCompilationRequest.HANDOUT: "slides.mm",
+  compilation_service_pb2.LatexCompilationRequest.HTML: "slides.mm",
 }
 
 
@@ -0,0 +1,108 @@
+"""Compiles on the user's own computer, without a compilation server.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import traceback
+from concurrent import futures
+
+import gflags
+from freemindlatex import (
+  bib_lib,
+  compilation_client_lib,
+  compilation_server_lib,
+  compilation_service_pb2)
+
+
+class LocalCompilationClient(compilation_client_lib.BaseCompilationClient):
+  """Runs the compilation server's pipeline in this process.
+
+  Compilations happen on a worker thread. Instead of copying the user's files,
+  the working directory links to them, so there is neither serialization nor
+  copying of the project.
+  """
+
+  def __init__(self):
+    super(LocalCompilationClient, self).__init__()
+    self._executor = futures.ThreadPoolExecutor(max_workers=1)
+    self._bibtex_cache = compilation_server_lib.BibtexCache(
+      gflags.FLAGS.bibtex_cache_entries)
+    self._image_cache = compilation_server_lib.CreateImageCache()
+
+  def CheckHealthy(self):  # pylint: disable=no-self-use
+    return True
+
+  def StartCompilingDir(self, directory, mode, extra_modes=()):
+    """Like CompileDir, but does not wait for the compilation to finish.
+
+    Returns:
+      A concurrent.futures.Future of the
+      compilation_service_pb2.LatexCompilationResponse. Pass its result to
+      SaveCompilationResult.
+    """
+    filepaths = [
+      filepath for filepath, mtime in self.GetManifest(directory).GetMTimeList()
+      if mtime is not None]
+    request = compilation_service_pb2.LatexCompilationRequest()
+    request.compilation_mode = mode
+    if extra_modes:
+      request.target_modes.extend([mode] + list(extra_modes))
+    return self._executor.submit(
+      self._CompileFiles, os.path.abspath(directory), filepaths,
+      self.GetBibSubset(directory), request, self._bibtex_cache,
+      self._image_cache)
+
+  @staticmethod
+  def _CompileFiles(directory, filepaths, bib_subset, request, bibtex_cache,
+                    image_cache):
+    """Links the files into a temporary directory, and compiles there.
+
+    Args:
+      directory: absolute path of the user's directory.
+      filepaths: paths of the files to compile, relative to the directory.
+      bib_subset: the cited entries of the bib file, or None.
+      request: a compilation_service_pb2.LatexCompilationRequest, only telling
+        the modes.
+      bibtex_cache: the compilation_server_lib.BibtexCache, shared by the
+        compilations.
+      image_cache: the compilation_server_lib.ImageCache, or None.
+
+    Returns:
+      A compilation_service_pb2.LatexCompilationResponse object.
+    """
+    compile_dir = tempfile.mkdtemp()
+    work_dir = os.path.join(compile_dir, "working")
+    logging.info("Compiling at %s", work_dir)
+    compilation_server_lib.MkdirP(work_dir)
+
+    try:
+      job = compilation_server_lib.CompilationJob()
+      job.profile_id = gflags.FLAGS.profile_request_id
+      with job.timer.Time("write_files"):
+        compilation_server_lib.PrepareCompilationBaseDirectory(work_dir)
+        for filepath in filepaths:
+          target_loc = os.path.join(work_dir, filepath)
+          compilation_server_lib.MkdirP(os.path.dirname(target_loc))
+          os.symlink(os.path.join(directory, filepath), target_loc)
+        if bib_subset is not None:
+          with open(os.path.join(
+              work_dir, bib_lib.BIB_SUBSET_FILENAME), 'w') as ofile:
+            ofile.write(bib_subset)
+
+      return compilation_server_lib.CompileRequestedTargetsAtWorkDir(
+        work_dir, request, job=job, bibtex_cache=bibtex_cache,
+        image_cache=image_cache)
+
+    except Exception as _:  # pylint: disable=broad-except
+      # A server would turn it into an RPC error. Here, we report it as a
+      # compilation error rather than breaking the editing loop.
+      logging.exception("Error compiling %s", directory)
+      result = compilation_service_pb2.LatexCompilationResponse()
+      result.status = compilation_service_pb2.LatexCompilationResponse.ERROR
+      result.compilation_log = traceback.format_exc()
+      return result
+
+    finally:
+      shutil.rmtree(compile_dir)
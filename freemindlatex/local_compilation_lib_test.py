@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import gflags
+from freemindlatex import (compilation_client_lib, compilation_service_pb2,
+                           fake_tex_test_lib, flags_test_lib,
+                           local_compilation_lib)
+
+_MINDMAP = """<map version="1.0.1">
+<node ID="ID_1" TEXT="Title">
+<node ID="ID_2" TEXT="A slide">
+<node ID="ID_3" TEXT="{}"/>
+<richcontent TYPE="NODE"><html><body><img src="figs/plot.pdf"/></body></html>
+</richcontent>
+</node>
+</node>
+</map>
+"""
+
+_BEAMER = compilation_service_pb2.LatexCompilationRequest.BEAMER
+
+
+class TestLocalCompilationClient(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    fake_tex_test_lib.UseFakeTex(self)
+    self._temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._temp_dir)
+    self._project_dir = os.path.join(self._temp_dir, "talk")
+    os.makedirs(os.path.join(self._project_dir, "figs"))
+    with open(os.path.join(self._project_dir, "figs", "plot.pdf"),
+              'w') as ofile:
+      ofile.write("plot")
+    self._WriteMindmap("Some point")
+    self._client = local_compilation_lib.LocalCompilationClient()
+
+  def _WriteMindmap(self, point_text):
+    with open(os.path.join(self._project_dir, "mindmap.mm"), 'w') as ofile:
+      ofile.write(_MINDMAP.format(point_text))
+
+  def _ListProjectFiles(self):
+    return sorted(
+      os.path.relpath(os.path.join(dirpath, filename), self._project_dir)
+      for dirpath, _, filenames in os.walk(self._project_dir)
+      for filename in filenames)
+
+  def testCompilingLinkedFiles(self):
+    self.assertTrue(self._client.CompileDir(self._project_dir, _BEAMER))
+    self.assertEquals(
+      "PDF", open(os.path.join(self._project_dir, "talk.pdf")).read())
+
+    # Removing the working directory leaves the files it linked to.
+    self.assertEquals(
+      ["figs/plot.pdf", "mindmap.mm", "talk.pdf"], self._ListProjectFiles())
+    self.assertEquals(
+      "plot", open(os.path.join(self._project_dir, "figs", "plot.pdf")).read())
+    self.assertIn("Some point", open(
+      os.path.join(self._project_dir, "mindmap.mm")).read())
+
+  def testCompilingThroughLinkedProjectDir(self):
+    linked_dir = os.path.join(self._temp_dir, "linked")
+    os.symlink(self._project_dir, linked_dir)
+    self.assertTrue(self._client.CompileDir(linked_dir, _BEAMER))
+    self.assertEquals(
+      "PDF", open(os.path.join(linked_dir, "linked.pdf")).read())
+
+  def testLatestWins(self):
+    hold_file = os.path.join(self._temp_dir, "hold")
+    open(hold_file, 'w').close()
+    os.environ[fake_tex_test_lib.HOLD_FILE_ENV] = hold_file
+    self.addCleanup(os.environ.pop, fake_tex_test_lib.HOLD_FILE_ENV)
+    scheduler = compilation_client_lib.LatestWinsCompilationScheduler(
+      self._client, self._project_dir, _BEAMER)
+
+    # The first version fails to compile, and is in pdflatex when the second
+    # version comes: too late to cancel it.
+    self._WriteMindmap("\\undefined")
+    scheduler.Submit()
+    while not os.path.exists(hold_file + ".reached"):
+      time.sleep(0.01)
+    self._WriteMindmap("Fixed point")
+    scheduler.Submit()
+    os.remove(hold_file)
+
+    compilation_result = None
+    while compilation_result is None:
+      scheduler.Wait(1)
+      compilation_result = scheduler.Poll()
+    self.assertTrue(compilation_result)
+    self.assertFalse(scheduler.IsBusy())
+    self.assertNotIn(gflags.FLAGS.latex_error_log_filename,
+                     self._ListProjectFiles())
+
+
+if __name__ == "__main__":
+  unittest.main()
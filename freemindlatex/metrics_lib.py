@@ -0,0 +1,280 @@
+"""Counters of events in the client or the server, for monitoring.
+
+Besides counters, there are histograms of durations and gauges of the
+current state, e.g. the queue depth. The server exposes them all in the
+Prometheus text format (see StartMetricsServer), and so does the client with
+its --client_metrics_port, e.g. for the hedged compilations.
+"""
+
+import bisect
+import BaseHTTPServer
+import SocketServer
+import threading
+
+_COUNTERS = {}
+_HISTOGRAMS = {}
+_GAUGES = {}
+_COUNTERS_LOCK = threading.Lock()
+
+# Upper bounds of the buckets, in seconds: from a cached Render to a
+# compilation at the TeX time limit.
+DEFAULT_SECONDS_BUCKETS = (
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+  60, 120)
+
+_PROMETHEUS_PREFIX = "freemindlatex_"
+
+
+class Counter(object):
+  """A thread-safe counter of events.
+  """
+
+  def __init__(self, name, description):
+    self.name = name
+    self.description = description
+    self._lock = threading.Lock()
+    self._value = 0
+
+  def Increment(self, amount=1):
+    with self._lock:
+      self._value += amount
+
+  def GetValue(self):
+    with self._lock:
+      return self._value
+
+
+def GetCounter(name, description):
+  """Gets the counter of the name, creating it upon the first call.
+
+  Args:
+    name: name of the counter, e.g. 'hedged_compilations'
+    description: what the counter counts, e.g. 'Compilations sent twice.'
+
+  Returns:
+    A Counter.
+  """
+  with _COUNTERS_LOCK:
+    if name not in _COUNTERS:
+      _COUNTERS[name] = Counter(name, description)
+    return _COUNTERS[name]
+
+
+def GetCounterValues():
+  """The current values of all the counters.
+
+  Returns:
+    A dictionary, e.g. {'hedged_compilations': 3}
+  """
+  with _COUNTERS_LOCK:
+    counters = list(_COUNTERS.values())
+  return dict((counter.name, counter.GetValue()) for counter in counters)
+
+
+class Histogram(object):
+  """A thread-safe histogram of observed values, e.g. latencies.
+
+  Observations get counted in buckets per combination of label values, e.g.
+  per compilation mode. Observing costs a bisection over the buckets.
+  """
+
+  def __init__(self, name, description, label_names, buckets):
+    self.name = name
+    self.description = description
+    self.label_names = tuple(label_names)
+    self.buckets = tuple(buckets)
+    self._lock = threading.Lock()
+    # From label values to [bucket counts, sum, count].
+    self._series = {}
+
+  def Observe(self, value, *label_values):
+    """Counts the value, e.g. Observe(1.5, 'BEAMER') with a 'mode' label."""
+    assert len(label_values) == len(self.label_names)
+    index = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      series = self._series.get(label_values)
+      if series is None:
+        series = self._series[label_values] = [
+          [0] * (len(self.buckets) + 1), 0.0, 0]
+      series[0][index] += 1
+      series[1] += value
+      series[2] += 1
+
+  def GetSeries(self):
+    """The observations so far.
+
+    Returns:
+      A dictionary from the label values to triplets of the cumulative
+      counts of the buckets (ending with +Inf), the sum and the count.
+    """
+    with self._lock:
+      series_copy = dict(
+        (label_values, (list(counts), total, count))
+        for label_values, (counts, total, count) in self._series.items())
+    result = {}
+    for label_values, (counts, total, count) in series_copy.items():
+      cumulative_counts = []
+      for bucket_count in counts:
+        cumulative_counts.append(
+          bucket_count + (cumulative_counts[-1] if cumulative_counts else 0))
+      result[label_values] = (cumulative_counts, total, count)
+    return result
+
+
+def GetHistogram(name, description, label_names=(),
+                 buckets=DEFAULT_SECONDS_BUCKETS):
+  """Gets the histogram of the name, creating it upon the first call.
+
+  Args:
+    name: name of the histogram, e.g. 'compilation_seconds'
+    description: what it measures, e.g. 'Time to compile a package.'
+    label_names: names of the labels telling apart the observations,
+      e.g. ['mode']
+    buckets: the sorted upper bounds of the buckets.
+
+  Returns:
+    A Histogram.
+  """
+  with _COUNTERS_LOCK:
+    if name not in _HISTOGRAMS:
+      _HISTOGRAMS[name] = Histogram(name, description, label_names, buckets)
+    return _HISTOGRAMS[name]
+
+
+class Gauge(object):
+  """A thread-safe value of the current state, e.g. a queue depth.
+
+  Either kept up to date with Increment, or read from a function upon
+  collection.
+  """
+
+  def __init__(self, name, description):
+    self.name = name
+    self.description = description
+    self._lock = threading.Lock()
+    self._value = 0
+    self._value_fn = None
+
+  def Increment(self, amount=1):
+    with self._lock:
+      self._value += amount
+
+  def SetFunction(self, value_fn):
+    """Makes the gauge read its value from value_fn, which should be cheap.
+    """
+    with self._lock:
+      self._value_fn = value_fn
+
+  def GetValue(self):
+    with self._lock:
+      value_fn = self._value_fn
+      if value_fn is None:
+        return self._value
+    return value_fn()
+
+
+def GetGauge(name, description):
+  """Gets the gauge of the name, creating it upon the first call.
+
+  Args:
+    name: name of the gauge, e.g. 'queue_depth'
+    description: what it shows, e.g. 'Compilations waiting for a slot.'
+
+  Returns:
+    A Gauge.
+  """
+  with _COUNTERS_LOCK:
+    if name not in _GAUGES:
+      _GAUGES[name] = Gauge(name, description)
+    return _GAUGES[name]
+
+
+def _FormatLabels(label_names, label_values):
+  if not label_names:
+    return ''
+  return '{{{}}}'.format(','.join(
+    '{}="{}"'.format(
+      name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+    for name, value in zip(label_names, label_values)))
+
+
+def _FormatBound(bound):
+  return repr(float(bound))
+
+
+def FormatPrometheusText():
+  """All the counters, histograms and gauges, in the Prometheus text format.
+  """
+  with _COUNTERS_LOCK:
+    counters = sorted(_COUNTERS.values(), key=lambda metric: metric.name)
+    histograms = sorted(_HISTOGRAMS.values(), key=lambda metric: metric.name)
+    gauges = sorted(_GAUGES.values(), key=lambda metric: metric.name)
+
+  lines = []
+  for counter in counters:
+    name = "{}{}_total".format(_PROMETHEUS_PREFIX, counter.name)
+    lines.append("# HELP {} {}".format(name, counter.description))
+    lines.append("# TYPE {} counter".format(name))
+    lines.append("{} {}".format(name, counter.GetValue()))
+
+  for gauge in gauges:
+    name = _PROMETHEUS_PREFIX + gauge.name
+    lines.append("# HELP {} {}".format(name, gauge.description))
+    lines.append("# TYPE {} gauge".format(name))
+    lines.append("{} {}".format(name, gauge.GetValue()))
+
+  for histogram in histograms:
+    name = _PROMETHEUS_PREFIX + histogram.name
+    lines.append("# HELP {} {}".format(name, histogram.description))
+    lines.append("# TYPE {} histogram".format(name))
+    label_names = histogram.label_names + ('le',)
+    for label_values, (cumulative_counts, total, count) in sorted(
+        histogram.GetSeries().items()):
+      bounds = [_FormatBound(bound) for bound in histogram.buckets] + ['+Inf']
+      for bound, bucket_count in zip(bounds, cumulative_counts):
+        lines.append("{}_bucket{} {}".format(
+          name, _FormatLabels(label_names, label_values + (bound,)),
+          bucket_count))
+      labels = _FormatLabels(histogram.label_names, label_values)
+      lines.append("{}_sum{} {}".format(name, labels, repr(total)))
+      lines.append("{}_count{} {}".format(name, labels, count))
+
+  return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path.split('?', 1)[0] != "/metrics":
+      self.send_error(404, "Only /metrics here")
+      return
+    content = FormatPrometheusText()
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass                        # Not logging every scrape.
+
+
+class _MetricsHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+def StartMetricsServer(port):
+  """Serves the metrics at http://<host>:<port>/metrics, in the background.
+
+  Args:
+    port: the port to listen to. When 0, picks an unused port.
+
+  Returns:
+    The port listened to.
+  """
+  server = _MetricsHTTPServer(('', port), _MetricsRequestHandler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server.server_address[1]
@@ -0,0 +1,52 @@
+import unittest
+import urllib2
+
+from freemindlatex import metrics_lib
+
+
+class TestHistogram(unittest.TestCase):
+
+  def testCumulativeBuckets(self):
+    histogram = metrics_lib.Histogram(
+      "test_seconds", "Test.", ["mode"], [1, 10])
+    for value in [0.5, 1, 5, 50]:
+      histogram.Observe(value, "BEAMER")
+    histogram.Observe(2, "REPORT")
+    self.assertEquals(
+      {("BEAMER",): ([2, 3, 4], 56.5, 4), ("REPORT",): ([0, 1, 1], 2.0, 1)},
+      histogram.GetSeries())
+
+
+class TestPrometheusText(unittest.TestCase):
+
+  def testFormattingMetrics(self):
+    metrics_lib.GetCounter("test_events", "Events.").Increment(3)
+    metrics_lib.GetGauge("test_depth", "Depth.").SetFunction(lambda: 7)
+    metrics_lib.GetHistogram(
+      "test_latency_seconds", "Latency.", ["phase"], [0.5]).Observe(
+        0.25, 'say "hi"')
+
+    lines = metrics_lib.FormatPrometheusText().split("\n")
+    self.assertIn("# TYPE freemindlatex_test_events_total counter", lines)
+    self.assertIn("freemindlatex_test_events_total 3", lines)
+    self.assertIn("freemindlatex_test_depth 7", lines)
+    self.assertIn(
+      'freemindlatex_test_latency_seconds_bucket'
+      '{phase="say \\"hi\\"",le="0.5"} 1', lines)
+    self.assertIn(
+      'freemindlatex_test_latency_seconds_bucket'
+      '{phase="say \\"hi\\"",le="+Inf"} 1', lines)
+    self.assertIn(
+      'freemindlatex_test_latency_seconds_count{phase="say \\"hi\\""} 1',
+      lines)
+
+  def testServingMetrics(self):
+    metrics_lib.GetCounter("test_scrapes", "Scrapes.").Increment()
+    port = metrics_lib.StartMetricsServer(0)
+    content = urllib2.urlopen(
+      "http://127.0.0.1:{}/metrics".format(port)).read()
+    self.assertIn("freemindlatex_test_scrapes_total 1", content)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,143 @@
+"""Synthetic mindmaps, e.g. for measuring how the conversion scales.
+
+The nodes get added breadth-first, up to the fan-out of each node and the
+maximum depth, so that the shape only depends on the parameters. The content
+of the nodes (formatting nodes, citations, math and images) gets drawn from a
+seeded random generator.
+"""
+
+import collections
+import random
+from xml.sax import saxutils
+
+FORMATTING_TEXTS = ['LIST', 'ULIST', 'HLIST', 'SECTIONS']
+
+# The shape and content of the generated mindmaps:
+#   max_depth: depth of the deepest nodes, the root being at depth 0.
+#   fan_out: number of children of the nodes, besides their formatting node.
+#   formatting_share: fraction of the nodes with children getting a
+#     formatting node, one of FORMATTING_TEXTS.
+#   citation_share: fraction of the nodes citing an entry.
+#   math_share: fraction of the nodes with an inline formula.
+#   image_share: fraction of the leaves showing an image.
+#   num_citation_keys: number of distinct entries to cite, see
+#     GenerateBibContent.
+#   seed: seed of the random choices.
+MindmapOptions = collections.namedtuple('MindmapOptions', [
+  'max_depth', 'fan_out', 'formatting_share', 'citation_share', 'math_share',
+  'image_share', 'num_citation_keys', 'seed'])
+
+# E.g. DEFAULT_OPTIONS._replace(citation_share=0.5) for other options.
+DEFAULT_OPTIONS = MindmapOptions(
+  max_depth=7, fan_out=6, formatting_share=0.1, citation_share=0.05,
+  math_share=0.1, image_share=0.02, num_citation_keys=100, seed=0)
+
+_MATH = r'$x_{%d}^{2} + \alpha$'
+
+
+class _GeneratedNode(object):
+
+  def __init__(self, node_id, text):
+    self.node_id = node_id
+    self.text = text
+    self.is_image = False
+    self.children = []
+
+
+def GetCitationKey(index):
+  """The key of the index-th bib entry the generated mindmaps cite."""
+  return "ref{}".format(index)
+
+
+def GenerateBibContent(num_citation_keys):
+  """A bib file with the entries the generated mindmaps may cite.
+
+  Args:
+    num_citation_keys: see MindmapOptions.
+
+  Returns:
+    The content of the bib file.
+  """
+  return "".join(
+    "@article{%s,\n  author = {Author, A. and Other, B.},\n"
+    "  title = {Paper %d},\n  year = {2016},\n}\n\n" % (
+      GetCitationKey(index), index)
+    for index in range(num_citation_keys))
+
+
+def _WriteNode(node, lines):
+  if node.is_image:
+    lines.append(
+      '<node ID="{}" TEXT="">'
+      '<richcontent TYPE="NODE"><html><body><img src="images/{}.png"/>'
+      '</body></html></richcontent>'.format(node.node_id, node.node_id))
+  else:
+    lines.append('<node ID="{}" TEXT={}>'.format(
+      node.node_id, saxutils.quoteattr(node.text, {'\n': '&#xa;'})))
+  for child in node.children:
+    _WriteNode(child, lines)
+  lines.append('</node>')
+
+
+def GenerateMindmap(num_nodes, options=DEFAULT_OPTIONS):
+  """Generates the content of a mindmap.mm file.
+
+  Args:
+    num_nodes: number of nodes, including the root and the formatting nodes.
+    options: a MindmapOptions.
+
+  Returns:
+    The content of the mindmap, as a str.
+
+  Raises:
+    ValueError: when max_depth and fan_out do not leave room for num_nodes.
+  """
+  rand = random.Random(options.seed)
+  nodes = []
+
+  def AddNode(parent, text):
+    node = _GeneratedNode("ID_{}".format(len(nodes)), text)
+    nodes.append(node)
+    if parent is not None:
+      parent.children.append(node)
+    return node
+
+  def GetPointText():
+    text = "Point {}".format(len(nodes))
+    if rand.random() < options.citation_share:
+      text += " \\cite{{{}}}".format(
+        GetCitationKey(rand.randrange(options.num_citation_keys)))
+    if rand.random() < options.math_share:
+      text += " " + _MATH % len(nodes)
+    return text
+
+  root = AddNode(None, "Synthetic mindmap")
+  # Nodes to add children to, with their depth.
+  pending = [(root, 0)]
+  pending_index = 0
+  while len(nodes) < num_nodes:
+    if pending_index == len(pending):
+      raise ValueError(
+        "No room for {} nodes with depth {} and fan-out {}".format(
+          num_nodes, options.max_depth, options.fan_out))
+    node, depth = pending[pending_index]
+    pending_index += 1
+
+    if rand.random() < options.formatting_share:
+      AddNode(node, rand.choice(FORMATTING_TEXTS))
+    num_points = 0
+    while num_points < options.fan_out and len(nodes) < num_nodes:
+      child = AddNode(node, GetPointText())
+      num_points += 1
+      if depth + 1 < options.max_depth:
+        pending.append((child, depth + 1))
+
+  for node in nodes:
+    if (not node.children and node.text not in FORMATTING_TEXTS and
+        rand.random() < options.image_share):
+      node.is_image = True
+
+  lines = ['<map version="1.0.1">']
+  _WriteNode(root, lines)
+  lines.append('</map>')
+  return "\n".join(lines) + "\n"
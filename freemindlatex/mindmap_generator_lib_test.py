@@ -0,0 +1,34 @@
+import unittest
+
+from freemindlatex import convert_lib, mindmap_generator_lib
+
+
+class TestGeneratingMindmaps(unittest.TestCase):
+
+  def testNodeCountAndContent(self):
+    options = mindmap_generator_lib.DEFAULT_OPTIONS._replace(
+      formatting_share=0.5, citation_share=0.5, math_share=0.5,
+      image_share=0.5)
+    content = mindmap_generator_lib.GenerateMindmap(200, options)
+    self.assertEquals(200, content.count("<node "))
+    for piece in ['TEXT="LIST"', "\\cite{ref", "\\alpha$", "<img src="]:
+      self.assertIn(piece, content)
+    self.assertEquals(
+      content, mindmap_generator_lib.GenerateMindmap(200, options))
+
+  def testConverting(self):
+    org = convert_lib.Organization(
+      mindmap_generator_lib.GenerateMindmap(
+        50, mindmap_generator_lib.DEFAULT_OPTIONS._replace(
+          citation_share=0)).decode('utf8'))
+    self.assertIn("Point 49", org.GetOutput('beamer_latex'))
+
+  def testNoRoomForNodes(self):
+    with self.assertRaises(ValueError):
+      mindmap_generator_lib.GenerateMindmap(
+        100, mindmap_generator_lib.DEFAULT_OPTIONS._replace(
+          max_depth=2, fan_out=3))
+
+
+if __name__ == "__main__":
+  unittest.main()
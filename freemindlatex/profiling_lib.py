@@ -0,0 +1,113 @@
+"""Profiles of the Python work of single requests, e.g. slow mindmaps.
+
+A request gets profiled when the server has a --profile_dir, and the client
+asks for it with the PROFILE_ID_METADATA_KEY metadata (see the
+profile_request_id flag of the client). Each profiled part of the request,
+e.g. the conversion, writes <profile_id>.<part>.prof, to read with pstats,
+and with tracemalloc, the allocations in <profile_id>.<part>.allocations.txt.
+"""
+
+import contextlib
+import cProfile
+import logging
+import os
+import re
+
+import gflags
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None            # Python 2 without the pytracemalloc patch.
+
+gflags.DEFINE_string(
+  "profile_dir",
+  None,
+  "When set, where to write the profiles of the requests asking for it, "
+  "or of the conversion of convert_lib.")
+
+# The value is the id naming the profile files.
+PROFILE_ID_METADATA_KEY = "freemindlatex-profile-id"
+
+_NUM_ALLOCATION_LINES = 50
+
+
+def _SanitizeProfileId(profile_id):
+  """Keeps the ids from naming files outside of the profile_dir."""
+  return re.sub(r'[^\w.-]', '_', profile_id)[:100]
+
+
+def GetRequestProfileId(context):
+  """The profile id the client asked for, when the server profiles.
+
+  Args:
+    context: the grpc.ServicerContext of the request.
+
+  Returns:
+    The id naming the profile files, or None not to profile.
+  """
+  if gflags.FLAGS.profile_dir is None:
+    return None
+  for key, value in context.invocation_metadata():
+    if key == PROFILE_ID_METADATA_KEY:
+      return _SanitizeProfileId(value)
+  return None
+
+
+def GetProfilePathPrefix(profile_id, part):
+  """Where to write the profiles of the part of the request.
+
+  Args:
+    profile_id: the id of the request, or None when not profiling.
+    part: what gets profiled, e.g. 'convert'
+
+  Returns:
+    The path, without extension, or None when not profiling.
+  """
+  if profile_id is None or gflags.FLAGS.profile_dir is None:
+    return None
+  return os.path.join(
+    os.path.expanduser(gflags.FLAGS.profile_dir),
+    "{}.{}".format(_SanitizeProfileId(profile_id), _SanitizeProfileId(part)))
+
+
+def _WriteAllocations(snapshot, path):
+  with open(path, 'w') as ofile:
+    for stat in snapshot.statistics('lineno')[:_NUM_ALLOCATION_LINES]:
+      ofile.write("{}\n".format(stat))
+
+
+@contextlib.contextmanager
+def Profile(path_prefix):
+  """Profiles the with statement, in the current thread.
+
+  Args:
+    path_prefix: see GetProfilePathPrefix. When None, does nothing.
+  """
+  if path_prefix is None:
+    yield
+    return
+
+  trace_allocations = tracemalloc is not None and not tracemalloc.is_tracing()
+  if trace_allocations:
+    tracemalloc.start()
+  profile = cProfile.Profile()
+  profile.enable()
+  try:
+    yield
+  finally:
+    profile.disable()
+    snapshot = None
+    if trace_allocations:
+      snapshot = tracemalloc.take_snapshot()
+      tracemalloc.stop()
+
+    try:
+      profile_dir = os.path.dirname(path_prefix)
+      if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+      profile.dump_stats(path_prefix + ".prof")
+      if snapshot is not None:
+        _WriteAllocations(snapshot, path_prefix + ".allocations.txt")
+      logging.info("Wrote the profile %s.prof", path_prefix)
+    except (IOError, OSError) as e:
+      logging.warning("Unable to write the profile %s: %s", path_prefix, e)
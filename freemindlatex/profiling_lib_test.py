@@ -0,0 +1,56 @@
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import gflags
+from freemindlatex import flags_test_lib, profiling_lib
+
+
+class _FakeContext(object):
+
+  def __init__(self, metadata):
+    self._metadata = metadata
+
+  def invocation_metadata(self):
+    return self._metadata
+
+
+class TestProfiling(unittest.TestCase):
+
+  def setUp(self):
+    flags_test_lib.RestoreFlagsAfterTest(self)
+    self._temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._temp_dir)
+
+  def testProfilingOnlyWithProfileDir(self):
+    context = _FakeContext(
+      [(profiling_lib.PROFILE_ID_METADATA_KEY, "../slow map")])
+    self.assertIsNone(profiling_lib.GetRequestProfileId(context))
+    self.assertIsNone(profiling_lib.GetProfilePathPrefix("slow", "convert"))
+
+    gflags.FLAGS.profile_dir = self._temp_dir
+    self.assertEquals(
+      ".._slow_map", profiling_lib.GetRequestProfileId(context))
+    self.assertIsNone(profiling_lib.GetRequestProfileId(_FakeContext([])))
+    self.assertEquals(
+      os.path.join(self._temp_dir, ".._slow_map.convert"),
+      profiling_lib.GetProfilePathPrefix("../slow map", "convert"))
+
+  def testWritingProfile(self):
+    gflags.FLAGS.profile_dir = os.path.join(self._temp_dir, "profiles")
+    path_prefix = profiling_lib.GetProfilePathPrefix("slow", "convert")
+    with profiling_lib.Profile(path_prefix):
+      sorted(range(1000), key=lambda number: -number)
+
+    stats = pstats.Stats(path_prefix + ".prof")
+    self.assertTrue(any(
+      function_name == "<lambda>"
+      for _, _, function_name in stats.stats))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,75 @@
+"""Stand-in compilation servers, for testing clients with several backends.
+"""
+
+import time
+from concurrent import futures
+
+import grpc
+from freemindlatex import compilation_service_pb2, compilation_service_pb2_grpc
+
+
+class StandInServer(compilation_service_pb2_grpc.LatexCompilationServicer,
+                    compilation_service_pb2_grpc.HealthServicer):
+  """Answers compilations right away, with its address as the pdf content.
+
+  Tests set its serving status, load and delay, and read the requests it got.
+  """
+
+  def __init__(self):
+    self.address = None
+    self.delay_seconds = 0
+    self.serving = True
+    self.queue_depth = 0
+    self.running_compilations = 0
+    self.requests = []
+
+  def CompilePackage(self, request, context):
+    self.requests.append(request)
+    time.sleep(self.delay_seconds)
+    response = compilation_service_pb2.LatexCompilationResponse()
+    response.status = compilation_service_pb2.LatexCompilationResponse.SUCCESS
+    response.pdf_content = self.address
+    return response
+
+  def Check(self, request, context):
+    response = compilation_service_pb2.HealthCheckResponse()
+    response.status = (
+      compilation_service_pb2.HealthCheckResponse.SERVING if self.serving
+      else compilation_service_pb2.HealthCheckResponse.NOT_SERVING)
+    response.queue_depth = self.queue_depth
+    response.running_compilations = self.running_compilations
+    return response
+
+
+class StandInServerFleet(object):
+  """Several StandInServers, each listening at a port of localhost.
+  """
+
+  def __init__(self, num_servers):
+    self.servers = []
+    self._grpc_servers = []
+    for _ in range(num_servers):
+      stand_in_server = StandInServer()
+      grpc_server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+      compilation_service_pb2_grpc.add_LatexCompilationServicer_to_server(
+        stand_in_server, grpc_server)
+      compilation_service_pb2_grpc.add_HealthServicer_to_server(
+        stand_in_server, grpc_server)
+      port = grpc_server.add_insecure_port('127.0.0.1:0')
+      grpc_server.start()
+      stand_in_server.address = '127.0.0.1:{}'.format(port)
+      self.servers.append(stand_in_server)
+      self._grpc_servers.append(grpc_server)
+
+  def GetAddresses(self):
+    return [server.address for server in self.servers]
+
+  def GetServerAt(self, address):
+    for server in self.servers:
+      if server.address == address:
+        return server
+    raise KeyError(address)
+
+  def Stop(self):
+    for grpc_server in self._grpc_servers:
+      grpc_server.stop(0)
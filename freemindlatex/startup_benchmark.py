@@ -0,0 +1,58 @@
+"""Measures how long each freemindlatex command takes to start.
+
+For each command, a fresh interpreter imports the modules the command needs,
+the same way freemindlatex_app_main.main does, and reports the time spent and
+the modules loaded.
+
+Usage:
+  python startup_benchmark.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from freemindlatex import freemindlatex_app_main
+
+_MEASURING_SCRIPT = """
+import json
+import sys
+import time
+
+start_time = time.time()
+from freemindlatex import freemindlatex_app_main
+freemindlatex_app_main.ImportCommandModules(sys.argv[1])
+print json.dumps({
+  'seconds': time.time() - start_time,
+  'modules': sorted(name for name, module in sys.modules.items() if module),
+})
+"""
+
+
+def MeasureStartup(command):
+  """Imports the modules of a command in a new interpreter.
+
+  Args:
+    command: the freemindlatex command, e.g. 'client'. An empty string for the
+      default command.
+
+  Returns:
+    A pair of the seconds spent importing, and the set of loaded modules.
+  """
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  output = subprocess.check_output(
+    [sys.executable, '-c', _MEASURING_SCRIPT, command], env=env)
+  measurement = json.loads(output)
+  return measurement['seconds'], set(measurement['modules'])
+
+
+def main():
+  for command in sorted(freemindlatex_app_main.COMMAND_MODULES):
+    seconds, modules = MeasureStartup(command)
+    print "%-8s %6.3fs %4d modules" % (command or '(default)', seconds,
+                                        len(modules))
+
+
+if __name__ == "__main__":
+  main()
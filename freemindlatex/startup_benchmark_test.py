@@ -0,0 +1,32 @@
+import unittest
+
+from freemindlatex import freemindlatex_app_main, startup_benchmark
+
+# Generous, as test machines vary. Importing everything takes several times
+# longer than any single command needs.
+_STARTUP_SECONDS_BUDGET = 1.5
+
+
+class TestStartup(unittest.TestCase):
+
+  def testStartingWithinBudget(self):
+    for command in freemindlatex_app_main.COMMAND_MODULES:
+      seconds, _ = startup_benchmark.MeasureStartup(command)
+      self.assertLess(seconds, _STARTUP_SECONDS_BUDGET,
+                      "Command %r took %.3fs to start" % (command, seconds))
+
+  def testClientsDoNotLoadTheServer(self):
+    for command in ['', 'client']:
+      _, modules = startup_benchmark.MeasureStartup(command)
+      self.assertNotIn('freemindlatex.compilation_server_lib', modules)
+      self.assertNotIn('freemindlatex.convert_lib', modules)
+      self.assertNotIn('bibtexparser', modules)
+
+  def testServerDoesNotLoadBibtexParser(self):
+    _, modules = startup_benchmark.MeasureStartup('server')
+    self.assertIn('freemindlatex.convert_lib', modules)
+    self.assertNotIn('bibtexparser', modules)
+
+
+if __name__ == "__main__":
+  unittest.main()